@@ -0,0 +1,272 @@
+#Space accounting for happili cleanup
+
+from __future__ import print_function
+
+"""
+Space accounting for happili cleanup
+
+In a practice run, the sizes of all targets are found with a parallel
+os.scandir / lstat walker, rather than running du by hand.
+Reclaimable space is reported per mount, obsid, beam and category,
+with the footprint of archived models estimated from a sampled
+compression ratio.
+"""
+
+import os
+import threading
+from collections import namedtuple, OrderedDict
+import queue
+from modules.inventory import iter_beams
+from modules.functions import get_beam_work_items
+from modules.archive import estimate_compression_ratio, choose_archive_format
+from modules.archive import DEFAULT_FORMAT, DEFAULT_TARGET_RATIO, AUTO_SAMPLE
+from modules.deletion import get_disk_usage
+from modules.paths import get_mount
+from modules.state import CATEGORY_SUBDIRS
+
+# default number of threads walking directory trees
+DEFAULT_WALK_WORKERS = 16
+
+# size of a single target
+TargetSize = namedtuple('TargetSize', ['path', 'nbytes', 'nfiles', 'errors'])
+
+# reported category names
+CATEGORY_LABELS = OrderedDict([('cal_vis', 'cal vis'),
+                               ('scal_inter', 'selfcal intermediates'),
+                               ('scal_final', 'selfcal final cycle'),
+                               ('cont_inter', 'continuum intermediates'),
+                               ('archive', 'archived models')])
+
+
+def get_sizes(path_list, workers=DEFAULT_WALK_WORKERS):
+    """
+    Find the size of many directory trees at once
+
+    Every directory is a separate work item for a pool of threads,
+    so a single deep tree (CASA MS, MIRIAD dataset) is also walked
+    in parallel. Symbolic links are not followed.
+
+    Parameters
+    ----------
+    path_list : list (str)
+        Targets, directories or files
+    workers : int
+        Number of walker threads
+        Default is DEFAULT_WALK_WORKERS
+
+    Returns
+    -------
+    size_list : list of TargetSize
+        Size of each target, in the order given
+    """
+    totals = OrderedDict((path, [0, 0, 0]) for path in path_list)
+    lock = threading.Lock()
+    work = queue.Queue()
+
+    def add(top, nbytes, nfiles, errors):
+        with lock:
+            total = totals[top]
+            total[0] += nbytes
+            total[1] += nfiles
+            total[2] += errors
+
+    def walk():
+        while True:
+            item = work.get()
+            if item is None:
+                work.task_done()
+                return
+            top, path = item
+            nbytes = 0
+            nfiles = 0
+            errors = 0
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                            nbytes += get_disk_usage(st)
+                            if entry.is_dir(follow_symlinks=False):
+                                work.put((top, entry.path))
+                            else:
+                                nfiles += 1
+                        except OSError:
+                            errors += 1
+            except OSError:
+                errors += 1
+            add(top, nbytes, nfiles, errors)
+            work.task_done()
+
+    for path in totals:
+        try:
+            st = os.lstat(path)
+        except OSError:
+            totals[path][2] += 1
+            continue
+        totals[path][0] += get_disk_usage(st)
+        if os.path.isdir(path) and not os.path.islink(path):
+            work.put((path, path))
+        else:
+            totals[path][1] += 1
+
+    threads = [threading.Thread(target=walk) for i in range(max(1, workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    work.join()
+    for thread in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+
+    size_list = [TargetSize(path, totals[path][0], totals[path][1], totals[path][2])
+                 for path in totals]
+
+    return size_list
+
+
+def get_space_report(inventory, categories=None,
+                     workers=DEFAULT_WALK_WORKERS, sample=3, manifest=None,
+                     archive_format=DEFAULT_FORMAT, target_ratio=DEFAULT_TARGET_RATIO):
+    """
+    Find the space that a cleanup would free
+
+    Parameters
+    ----------
+    inventory : OrderedDict
+        Inventory from get_inventory
+    categories : list (str) (optional)
+        Cleanup categories to include; default is all
+    workers : int
+        Number of walker threads
+    sample : int
+        Number of archive targets to sample for the compression ratio
+    manifest : Manifest (optional)
+        Manifests whose policies limit the categories of an obsid
+    archive_format : str
+        Format the archive targets will be archived in, and sampled with;
+        with 'auto', the format the run would choose
+    target_ratio : float
+        Compression ratio to reach with the auto format
+
+    Returns
+    -------
+    report : dict
+        'ratio' : sampled compression ratio (or None),
+        'format' : archive format sampled,
+        'rows' : list of (mount, obsid, beam, category, nbytes, nfiles),
+        where archive targets have category 'archive'
+    """
+    target_list = []
+    for beam_inv in iter_beams(inventory):
+        beam_categories = categories
+        if manifest is not None:
+            beam_categories = manifest.get_categories(
+                beam_inv['obsid'], categories or list(CATEGORY_SUBDIRS))
+        for item in get_beam_work_items(beam_inv, categories=beam_categories):
+            if item.action == 'archive':
+                category = 'archive'
+            elif item.requires == item.path:
+                # original of an archive, counted with the archive
+                continue
+            else:
+                category = item.category
+            target_list.append((item.obsid, item.beam, category, item.path))
+
+    size_list = get_sizes([target[3] for target in target_list], workers=workers)
+    archive_list = [target[3] for target in target_list if target[2] == 'archive']
+    if archive_format == 'auto':
+        archive_format = choose_archive_format(archive_list[:AUTO_SAMPLE],
+                                               target_ratio=target_ratio)
+    ratio = estimate_compression_ratio(archive_list, sample=sample,
+                                       archive_format=archive_format)
+
+    mount_cache = {}
+    rows = []
+    for target, size in zip(target_list, size_list):
+        obsid, beam, category, path = target
+        rows.append((get_mount(path, mount_cache), obsid, beam, category,
+                     size.nbytes, size.nfiles))
+    report = {'ratio': ratio, 'format': archive_format, 'rows': rows}
+
+    return report
+
+
+def format_bytes(nbytes):
+    """
+    Format a number of bytes in human readable units, as du -h
+    """
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if abs(nbytes) < 1024. or unit == 'T':
+            break
+        nbytes = nbytes / 1024.
+    if unit == 'B':
+        return '{0:d}{1}'.format(int(nbytes), unit)
+
+    return '{0:.1f}{1}'.format(nbytes, unit)
+
+
+def summarise_report(report, level='mount'):
+    """
+    Sum reclaimable bytes per category at a given level
+
+    Archived models free their size less the estimated archive size
+
+    Parameters
+    ----------
+    report : dict
+        Report from get_space_report
+    level : str
+        One of mount, obsid, beam (obsid/beam)
+
+    Returns
+    -------
+    summary : OrderedDict
+        For each key, a dict of freed bytes per category
+    """
+    ratio = report['ratio']
+    if ratio is None:
+        ratio = 1.
+    summary = OrderedDict()
+    for mount, obsid, beam, category, nbytes, nfiles in sorted(report['rows']):
+        if level == 'mount':
+            key = mount
+        elif level == 'obsid':
+            key = obsid
+        else:
+            key = '{0}/{1:02d}'.format(obsid, beam)
+        if category == 'archive':
+            nbytes = nbytes * (1. - ratio)
+        totals = summary.setdefault(key, OrderedDict((c, 0) for c in CATEGORY_LABELS))
+        totals[category] += nbytes
+
+    return summary
+
+
+def print_space_report(report, levels=('mount', 'obsid')):
+    """
+    Print reclaimable space per category
+
+    Parameters
+    ----------
+    report : dict
+        Report from get_space_report
+    levels : list (str)
+        Levels to print, from mount, obsid and beam
+    """
+    if report['ratio'] is not None:
+        archive_bytes = sum(row[4] for row in report['rows'] if row[3] == 'archive')
+        print('Sampled compression ratio {0:.2f} ({1}); archived models {2} -> {3}'.format(
+            report['ratio'], report['format'], format_bytes(archive_bytes),
+            format_bytes(archive_bytes * report['ratio'])))
+    header = ['{0:>24}'.format(CATEGORY_LABELS[c]) for c in CATEGORY_LABELS]
+    for level in levels:
+        summary = summarise_report(report, level=level)
+        print('')
+        print('{0:<24}'.format('Reclaimable per ' + level) + ''.join(header) +
+              '{0:>10}'.format('total'))
+        for key in summary:
+            totals = summary[key]
+            print('{0:<24}'.format(key) +
+                  ''.join('{0:>24}'.format(format_bytes(totals[c])) for c in totals) +
+                  '{0:>10}'.format(format_bytes(sum(totals.values()))))
@@ -0,0 +1,263 @@
+#Node-local cleanup agents
+
+from __future__ import print_function
+
+"""
+Node-local cleanup agents
+
+In happili-01 mode, beams 10-39 are reached over NFS, so every stat,
+unlink and archive read and write crosses the network. Instead, an
+agent can be started on each node (python -m modules.agent --node ...,
+by default over ssh). It scans and cleans the beams on its own /data
+at local disk speed, with its own cleanup state index. All nodes
+work at the same time.
+
+The coordinator sends the obsid selection and policy as a single JSON line
+on stdin. The agent prints its log to stderr, and writes a compact
+JSON summary on stdout when it is done.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+from modules.paths import NODE_BEAMS, set_data_root
+from modules.functions import get_obsid_array, iter_work_items
+from modules.executor import execute_work_items
+from modules.plan import get_status
+from modules.deletion import DEFAULT_WORKERS
+from modules.archive import DEFAULT_FORMAT, DEFAULT_TARGET_RATIO
+from modules.manifest import Manifest
+from modules.preflight import AdminTarget, get_admin_failed, print_admin_report
+from modules.state import open_state, record_cleaned, record_archives
+from modules.throttle import configure_throttle
+from modules.metrics import get_metrics
+from modules.accounting import format_bytes
+from modules.trash import get_trash_dirs, start_reaper
+from modules.trash import DEFAULT_REAP_WORKERS, DEFAULT_REAP_RATE
+
+# directory of this code, the same on every node
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# command starting an agent; {node} and {repo} are filled in
+AGENT_COMMAND = "ssh {node} 'cd {repo} && python3 -m modules.agent --node {node}'"
+
+
+def get_agent_request(selection=None, categories=None, run=False,
+                      verbose=True, workers=DEFAULT_WORKERS, mount_workers=None,
+                      archive_workers=None,
+                      archive_format=DEFAULT_FORMAT, target_ratio=DEFAULT_TARGET_RATIO,
+                      bytes_rate=None, ops_rate=None, mount_rates=None,
+                      latency=None, state=True, state_dir=None, manifest=None,
+                      trash=False, reap_workers=DEFAULT_REAP_WORKERS,
+                      reap_rate=DEFAULT_REAP_RATE, inode_order=None):
+    """
+    Make the request sent to the agents: obsid selection and cleanup policy
+
+    Parameters are as for run_cleanup.py; selection holds the keyword
+    arguments of get_obsid_array (date ranges, taskids, cutoff), which
+    each agent resolves itself. mount_workers and mount_rates are keyed
+    by the mount as seen on the node (e.g. /data). The manifest, if any, is sent
+    in full, so agents need no access to the manifest files. With trash,
+    each agent starts a reaper on its node for its own trash.
+
+    Returns
+    -------
+    request : dict
+        Request, to be sent as JSON
+    """
+    request = {'selection': selection or {},
+               'categories': categories, 'run': run, 'verbose': verbose,
+               'workers': workers, 'mount_workers': mount_workers,
+               'archive_workers': archive_workers,
+               'archive_format': archive_format, 'target_ratio': target_ratio,
+               'bytes_rate': bytes_rate, 'ops_rate': ops_rate,
+               'mount_rates': mount_rates, 'latency': latency,
+               'state': state, 'state_dir': state_dir,
+               'manifest': None if manifest is None else manifest.to_dict(),
+               'trash': trash, 'reap_workers': reap_workers, 'reap_rate': reap_rate,
+               'inode_order': inode_order}
+
+    return request
+
+
+def run_agent(request, node):
+    """
+    Scan and clean the beams on the local disk of a node
+
+    Parameters
+    ----------
+    request : dict
+        Request from get_agent_request
+    node : str
+        Node this runs on, one of NODE_BEAMS
+
+    Returns
+    -------
+    summary : dict
+        Work items, beams, failed obsid / beam / category,
+        bytes freed, archives made, errors by errno, targets
+        that need an admin, the pid of the reaper started (if any)
+        and metrics
+    """
+    configure_throttle(bytes_rate=request['bytes_rate'], ops_rate=request['ops_rate'],
+                       mount_rates=request['mount_rates'], latency=request['latency'])
+    categories = request['categories']
+    state = None
+    if request['state'] is True:
+        state = open_state(state_dir=request['state_dir'])
+
+    beam_list = []
+    admin_list = []
+    manifest = None
+    if request['manifest'] is not None:
+        manifest = Manifest(**request['manifest'])
+    obsid_array = get_obsid_array(manifest=manifest, **request['selection'])
+    item_iter = iter_work_items(obsid_array=obsid_array, manifest=manifest, mode='local',
+                                categories=categories, state=state,
+                                beam_list=beam_list, beams=NODE_BEAMS[node],
+                                admin_list=admin_list)
+    n_items = 0
+    archive_results = []
+    nbytes = 0
+    errors = {}
+    failed = set()
+    for item, result in execute_work_items(item_iter, run=request['run'],
+                                           verbose=request['verbose'],
+                                           workers=request['workers'],
+                                           mount_workers=request['mount_workers'],
+                                           archive_workers=request['archive_workers'],
+                                           archive_format=request['archive_format'],
+                                           target_ratio=request['target_ratio'],
+                                           trash=request['trash'],
+                                           inode_order=request['inode_order']):
+        n_items += 1
+        # same rule as a direct run: a target that is already gone is done
+        status = get_status(item, result)
+        if status == 'fail':
+            failed.add((item.obsid, item.beam, item.category))
+        if item.action == 'archive':
+            if result.archived is True:
+                archive_results.append(result)
+        elif status != 'gone':
+            nbytes += result.nbytes
+            for name, count in result.errors.items():
+                errors[name] = errors.get(name, 0) + count
+    if state is not None and request['run'] is True:
+        skipped = set()
+        if manifest is not None:
+            skipped = manifest.get_skipped(beam_list, categories)
+        skipped |= get_admin_failed(admin_list)
+        record_cleaned(state, beam_list, categories, failed | skipped)
+        record_archives(state, archive_results)
+    reaper = None
+    if request['trash'] is True and request['run'] is True:
+        reaper = start_reaper(get_trash_dirs(mode='local'),
+                              workers=request['reap_workers'], ops_rate=request['reap_rate'])
+
+    summary = {'node': node, 'items': n_items, 'beams': len(beam_list),
+               'failed': sorted(failed), 'nbytes': nbytes,
+               'archived': len(archive_results), 'errors': errors,
+               'needs_admin': [list(target) for target in admin_list],
+               'reaper': None if reaper is None else reaper.pid,
+               'metrics': get_metrics(), 'error': None}
+
+    return summary
+
+
+def run_agents(nodes, request, command=AGENT_COMMAND):
+    """
+    Run agents on several nodes at once, and collect their summaries
+
+    Parameters
+    ----------
+    nodes : list (str)
+        Nodes to run on, from NODE_BEAMS
+    request : dict
+        Request from get_agent_request
+    command : str
+        Command starting an agent, with {node} and {repo} filled in;
+        e.g. 'python -m modules.agent --node {node}' to run locally
+
+    Returns
+    -------
+    summaries : list of dict
+        Summary of each node, in the order given. If an agent failed,
+        'error' says how
+    """
+    line = json.dumps(request) + '\n'
+    processes = []
+    for node in nodes:
+        args = shlex.split(command.format(node=node, repo=REPO_DIR))
+        # from the repository, so modules.agent is found when run locally
+        process = subprocess.Popen(args, cwd=REPO_DIR, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, universal_newlines=True)
+        process.stdin.write(line)
+        process.stdin.close()
+        processes.append((node, process))
+
+    summaries = []
+    for node, process in processes:
+        output = process.stdout.read()
+        process.stdout.close()
+        status = process.wait()
+        try:
+            summary = json.loads(output)
+        except ValueError:
+            summary = {'node': node, 'error': 'agent exited with status {} '
+                                              'without a summary'.format(status)}
+        summaries.append(summary)
+
+    return summaries
+
+
+def print_agent_summaries(summaries):
+    """
+    Print one line per node, the failures, and the targets that need an admin
+    """
+    for summary in summaries:
+        if summary.get('error') is not None:
+            print('{0:<12} failed: {1}'.format(summary['node'], summary['error']))
+            continue
+        print('{0:<12} {1:6d} work items for {2:4d} beams; {3:4d} archived; '
+              '{4} freed; failures in {5} beam/category combinations{6}'.format(
+                  summary['node'], summary['items'], summary['beams'],
+                  summary['archived'], format_bytes(summary['nbytes']),
+                  len(summary['failed']),
+                  '' if len(summary['errors']) == 0 else ' ({})'.format(', '.join(
+                      '{0} {1}'.format(k, v) for k, v in sorted(summary['errors'].items())))))
+        for obsid, beam, category in summary['failed']:
+            print('    {0} {1:02d} {2}'.format(obsid, beam, category))
+        if summary.get('reaper') is not None:
+            print('    reaper {} is emptying the trash'.format(summary['reaper']))
+    print_admin_report([AdminTarget(*target) for summary in summaries
+                        for target in summary.get('needs_admin', [])])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Clean up the Apercal data on the local disk of a happili node')
+    parser.add_argument("--node", required=True, choices=sorted(NODE_BEAMS),
+                        help='Node this agent runs on')
+    parser.add_argument("--data_root", default=None, type=str,
+                        help='Directory holding the local data directory, '
+                             'for testing on synthetic data')
+    args = parser.parse_args()
+
+    if args.data_root is not None:
+        set_data_root(args.data_root)
+    request = json.loads(sys.stdin.readline())
+    # the log goes to stderr; stdout only carries the summary
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        summary = run_agent(request, args.node)
+    except Exception as e:
+        summary = {'node': args.node, 'error': '{0}: {1}'.format(type(e).__name__, e)}
+    out.write(json.dumps(summary) + '\n')
+    out.flush()
+
+
+if __name__ == '__main__':
+    main()
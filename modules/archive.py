@@ -0,0 +1,757 @@
+#Archiving of kept models and masks
+
+from __future__ import print_function
+
+"""
+Archiving of kept models and masks
+
+shutil.make_archive(..., 'gztar', ...) compresses with single-threaded zlib,
+one directory after another. Here many directories are archived at once
+with a process pool, and a single large archive can be compressed in
+parallel blocks (as pigz does). The output is a standard single-member
+.tar.gz, with the same layout as shutil.make_archive(d, 'gztar', d).
+
+Other formats can be chosen: gztar at a lower level, uncompressed tar,
+bztar and xztar. With 'auto', the first few directories are sampled
+and the fastest format that reaches a target compression ratio is used.
+Each archive is written in a single pass to a temporary name, taking
+a SHA-256 digest of the archive and a CRC32 of every member while it
+is written, and only renamed into place once complete. The format,
+digest and member manifest are recorded next to it, in
+<directory>.archive.json, for restore tooling and later audits.
+
+Reading of the data is within the I/O limits of the mount,
+if these are set (see modules.throttle).
+
+On local disks, directories are read in inode order rather than name
+order (see modules.deletion.use_inode_order), so the many small files
+of a measurement set are read with less seeking. The archive then
+holds the same members, in a different order.
+"""
+
+import os
+import bz2
+import hashlib
+import io
+import json
+import lzma
+import struct
+import tarfile
+import time
+import zlib
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from modules.throttle import get_throttle, throttled_op, ThrottledReader
+from modules.throttle import get_throttle_config, configure_throttle_share
+from modules.deletion import use_inode_order
+
+# compression level, as used by shutil.make_archive
+DEFAULT_LEVEL = 9
+# size of independently compressed blocks
+BLOCK_SIZE = 512 * 1024
+# deflate window, carried over between blocks as a dictionary
+WINDOW_SIZE = 32 * 1024
+
+# archive formats: extension, compression and level;
+# in order of increasing cost, for the auto format
+ARCHIVE_FORMATS = OrderedDict([('tar', ('.tar', None, None)),
+                               ('gztar1', ('.tar.gz', 'gz', 1)),
+                               ('gztar6', ('.tar.gz', 'gz', 6)),
+                               ('gztar', ('.tar.gz', 'gz', DEFAULT_LEVEL)),
+                               ('bztar', ('.tar.bz2', 'bz2', 9)),
+                               ('xztar', ('.tar.xz', 'xz', 6))])
+DEFAULT_FORMAT = 'gztar'
+# the auto format samples this many directories,
+# up to SAMPLE_BYTES of tar stream each
+AUTO_SAMPLE = 3
+SAMPLE_BYTES = 64 * 1024 * 1024
+# default compression ratio (compressed over uncompressed) for auto
+DEFAULT_TARGET_RATIO = 0.5
+# suffix of the file recording how a directory was archived
+INFO_SUFFIX = '.archive.json'
+# suffix of an archive while it is written
+PARTIAL_SUFFIX = '.partial'
+
+# outcome of archiving a single directory;
+# digest is the SHA-256 of the archive file, nbytes its size,
+# nbytes_read the size of the files read into it
+ArchiveResult = namedtuple('ArchiveResult', ['path', 'archive', 'archived', 'error',
+                                             'format', 'digest', 'nbytes', 'nbytes_read'])
+
+
+def get_default_workers():
+    """
+    Get the default number of archiving workers, one per core
+
+    Returns
+    -------
+    workers : int
+        Number of cores available
+    """
+    try:
+        workers = len(os.sched_getaffinity(0))
+    except AttributeError:
+        workers = os.cpu_count() or 1
+
+    return workers
+
+
+def _compress_block(block, zdict, level, last):
+    """
+    Compress one block as raw deflate, primed with the previous window
+
+    Non-final blocks end on a byte boundary (sync flush),
+    so the compressed blocks can simply be concatenated
+    """
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                                      zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                      zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block)
+    if last:
+        data += compressor.flush(zlib.Z_FINISH)
+    else:
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    return data
+
+
+class ParallelGzipWriter(object):
+    """
+    Write-only file object producing a gzip stream,
+    compressing blocks in parallel threads
+
+    zlib releases the GIL while compressing, so threads are enough.
+    The output is a single gzip member, readable by gzip, tarfile and pigz.
+    """
+
+    def __init__(self, fileobj, workers=None, level=DEFAULT_LEVEL,
+                 block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or get_default_workers()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.window = b''
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        # gzip header; XFL 2 flags maximum compression
+        xfl = 2 if level == 9 else (4 if level == 1 else 0)
+        self.fileobj.write(struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0,
+                                       int(time.time()), xfl, 3))
+
+    def _submit(self, block, last=False):
+        self.pending.append(self.pool.submit(_compress_block, block,
+                                             self.window, self.level, last))
+        self.window = block[-WINDOW_SIZE:]
+        # keep a bounded number of blocks in flight
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._submit(bytes(self.buffer), last=True)
+        self.buffer = bytearray()
+        while len(self.pending) > 0:
+            self.fileobj.write(self.pending.popleft().result())
+        self.pool.shutdown()
+        self.fileobj.write(struct.pack('<LL', self.crc & 0xffffffff,
+                                       self.size & 0xffffffff))
+        self.closed = True
+
+
+def write_tar(srcdir, fileobj, manifest=None, inode_order=None):
+    """
+    Write a tar stream of a directory
+
+    Members are relative to the directory,
+    as for shutil.make_archive(srcdir, 'gztar', srcdir)
+
+    Parameters
+    ----------
+    srcdir : str
+        Directory to archive
+    fileobj : file object
+        Writable (compressing) file object
+    manifest : list (optional)
+        Each member is appended as (name, type, size, CRC32 of the data)
+    inode_order : Boolean (optional)
+        Add the entries of each directory in inode order rather than
+        name order; by default on local filesystems only
+    """
+    throttle = get_throttle(srcdir)
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        _add_members(tar, srcdir, os.curdir, throttle, manifest,
+                     use_inode_order(srcdir, inode_order))
+
+
+class _ChecksumReader(object):
+    """
+    Read-only file object keeping a CRC32 of what is read
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.crc = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.crc = zlib.crc32(data, self.crc)
+        return data
+
+
+def _add_members(tar, path, arcname, throttle=None, manifest=None, inode_order=False):
+    """
+    Add a path to a tar archive
+
+    Follows TarFile.add (sorted directory contents, links not followed),
+    or with inode_order, directory contents sorted by inode.
+    Within I/O limits, a metadata token is taken for each member
+    and byte tokens for the data read
+    """
+    tarinfo = throttled_op(throttle, tar.gettarinfo, path, arcname)
+    if tarinfo is None:
+        return
+    crc = None
+    if tarinfo.isreg():
+        with open(path, 'rb') as f:
+            reader = _ChecksumReader(f if throttle is None else ThrottledReader(f, throttle))
+            tar.addfile(tarinfo, reader)
+        crc = reader.crc & 0xffffffff
+    else:
+        tar.addfile(tarinfo)
+    if manifest is not None:
+        manifest.append((tarinfo.name, tarinfo.type.decode('ascii'), tarinfo.size, crc))
+    if tarinfo.isdir():
+        if inode_order is True:
+            with os.scandir(path) as it:
+                name_list = [entry.name for entry in
+                             sorted(it, key=lambda entry: entry.inode())]
+        else:
+            name_list = sorted(os.listdir(path))
+        for name in name_list:
+            _add_members(tar, os.path.join(path, name),
+                         os.path.join(arcname, name), throttle, manifest, inode_order)
+
+
+class _DigestWriter(object):
+    """
+    Write-only file object taking a SHA-256 digest of what is written
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+
+def get_archive_name(srcdir, archive_format=DEFAULT_FORMAT):
+    """
+    Get the archive file of a directory for a format
+    """
+    return srcdir + ARCHIVE_FORMATS[archive_format][0]
+
+
+def get_archive_info(srcdir):
+    """
+    Read how a directory was archived
+
+    Parameters
+    ----------
+    srcdir : str
+        Directory that was archived (it may no longer exist)
+
+    Returns
+    -------
+    info : dict or None
+        'format', 'archive' (file name), 'compression', 'level',
+        'sha256' and 'nbytes' of the archive, and 'members' as a list of
+        [name, type, size, crc32]; None if nothing was recorded
+    """
+    try:
+        with open(srcdir + INFO_SUFFIX) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _fsync_dir(path):
+    """
+    Sync a directory, so the renames in it survive a crash
+    """
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_archive_info(srcdir, info):
+    """
+    Record how a directory was archived, next to the archive
+
+    The record is synced before it is renamed into place;
+    the directory is synced by the caller
+    """
+    info_file = srcdir + INFO_SUFFIX
+    with open(info_file + PARTIAL_SUFFIX, 'w') as f:
+        json.dump(info, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(info_file + PARTIAL_SUFFIX, info_file)
+
+
+def is_archive_complete(srcdir):
+    """
+    Check that a directory was archived completely, from its record
+
+    Only the record and the size of the archive are checked,
+    the archive is not read
+
+    Parameters
+    ----------
+    srcdir : str
+        Directory that was archived
+
+    Returns
+    -------
+    complete : Boolean
+        Whether the recorded archive exists with the recorded size
+    """
+    info = get_archive_info(srcdir)
+    if info is None or 'nbytes' not in info:
+        return False
+    try:
+        size = os.path.getsize(os.path.join(os.path.dirname(srcdir), info['archive']))
+    except OSError:
+        return False
+
+    return size == info['nbytes']
+
+
+def verify_archive(srcdir, sha256=None):
+    """
+    Verify an archive against the digest recorded when it was written
+
+    Parameters
+    ----------
+    srcdir : str
+        Directory that was archived
+    sha256 : str (optional)
+        Digest recorded elsewhere (e.g. the state index),
+        which must match as well
+
+    Returns
+    -------
+    error : str or None
+        What is wrong with the archive; None if it matches its record
+    """
+    info = get_archive_info(srcdir)
+    if info is None or 'sha256' not in info:
+        return 'no archive record'
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with open(os.path.join(os.path.dirname(srcdir), info['archive']), 'rb') as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+                sha.update(block)
+                size += len(block)
+    except OSError as e:
+        return str(e)
+    if size != info['nbytes']:
+        return 'size {0} does not match recorded {1}'.format(size, info['nbytes'])
+    if sha.hexdigest() != info['sha256']:
+        return 'digest does not match record'
+    if sha256 is not None and sha256 != info['sha256']:
+        return 'record does not match the state index'
+
+    return None
+
+
+def open_compressor(fileobj, archive_format=DEFAULT_FORMAT, block_workers=1):
+    """
+    Open a compressing file object for an archive format
+
+    Parameters
+    ----------
+    fileobj : file object
+        Writable file object for the compressed stream
+    archive_format : str
+        One of ARCHIVE_FORMATS
+    block_workers : int
+        Number of threads compressing blocks (gzip formats only)
+
+    Returns
+    -------
+    compressor : file object
+        Writable file object; must be closed to finish the stream
+    """
+    extension, compression, level = ARCHIVE_FORMATS[archive_format]
+    if compression == 'gz':
+        return ParallelGzipWriter(fileobj, workers=block_workers, level=level)
+    if compression == 'bz2':
+        return bz2.BZ2File(fileobj, 'wb', compresslevel=level)
+    if compression == 'xz':
+        return lzma.LZMAFile(fileobj, 'wb', preset=level)
+
+    return _Uncompressed(fileobj)
+
+
+class _Uncompressed(object):
+    """
+    Write-only file object passing data through, for plain tar
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+def make_archive(srcdir, archive_format=DEFAULT_FORMAT, block_workers=1,
+                 inode_order=None):
+    """
+    Archive a directory next to it, and record the format and digests
+
+    The archive and its record are written to temporary names, synced,
+    and only then renamed into place, so an archive under its final name
+    is complete. The directory holding them is synced after the renames,
+    so both are on disk before the source can be deleted
+
+    Parameters
+    ----------
+    srcdir : str
+        Directory to archive
+    archive_format : str
+        One of ARCHIVE_FORMATS, default is DEFAULT_FORMAT
+    block_workers : int
+        Number of threads compressing blocks of this archive (gzip).
+        With 1, this is plain single-threaded gzip
+    inode_order : Boolean (optional)
+        Read directories in inode order; by default on local filesystems only
+
+    Returns
+    -------
+    info : dict
+        Record of the archive, as from get_archive_info
+    """
+    archive = get_archive_name(srcdir, archive_format)
+    partial = archive + PARTIAL_SUFFIX
+    manifest = []
+    try:
+        with open(partial, 'wb') as f:
+            digest = _DigestWriter(f)
+            compressor = open_compressor(digest, archive_format,
+                                         block_workers=block_workers)
+            try:
+                write_tar(srcdir, compressor, manifest=manifest,
+                          inode_order=inode_order)
+            finally:
+                compressor.close()
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(partial, archive)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    extension, compression, level = ARCHIVE_FORMATS[archive_format]
+    info = OrderedDict([('format', archive_format),
+                        ('archive', os.path.basename(archive)),
+                        ('compression', compression),
+                        ('level', level),
+                        ('created', time.time()),
+                        ('sha256', digest.sha.hexdigest()),
+                        ('nbytes', digest.size),
+                        ('members', manifest)])
+    write_archive_info(srcdir, info)
+    _fsync_dir(os.path.dirname(os.path.abspath(archive)))
+
+    return info
+
+
+def archive_dir(srcdir, block_workers=1, archive_format=DEFAULT_FORMAT,
+                inode_order=None):
+    """
+    Archive a single directory, catching errors for the result
+
+    Parameters
+    ----------
+    srcdir : str
+        Directory to archive
+    block_workers : int
+        Number of threads compressing blocks of this archive
+    archive_format : str
+        One of ARCHIVE_FORMATS, default is DEFAULT_FORMAT
+    inode_order : Boolean (optional)
+        Read directories in inode order; by default on local filesystems only
+
+    Returns
+    -------
+    result : ArchiveResult
+        Outcome of archiving; archived is only True once the
+        archive and its record are complete
+    """
+    archive = get_archive_name(srcdir, archive_format)
+    try:
+        info = make_archive(srcdir, archive_format, block_workers=block_workers,
+                            inode_order=inode_order)
+        # regular files are the members with a CRC32 of their data
+        nbytes_read = sum(size for name, member_type, size, crc in info['members']
+                          if crc is not None)
+        result = ArchiveResult(srcdir, archive, True, None, archive_format,
+                               info['sha256'], info['nbytes'], nbytes_read)
+    except Exception as e:
+        result = ArchiveResult(srcdir, archive, False, str(e), archive_format, None, 0, 0)
+
+    return result
+
+
+def archive_dirs(dir_list, workers=None, archive_format=DEFAULT_FORMAT,
+                 target_ratio=DEFAULT_TARGET_RATIO, inode_order=None):
+    """
+    Archive many directories at once
+
+    Directories are spread over a pool of processes.
+    When there are fewer directories than workers,
+    the spare workers compress blocks of each archive in parallel,
+    so a single large archive also uses all cores
+
+    Parameters
+    ----------
+    dir_list : list (str)
+        Directories to archive
+    workers : int (optional)
+        Total number of workers; default is one per core
+    archive_format : str
+        One of ARCHIVE_FORMATS or 'auto', default is DEFAULT_FORMAT
+    target_ratio : float
+        Compression ratio to reach with the auto format
+    inode_order : Boolean (optional)
+        Read directories in inode order; by default on local filesystems only
+
+    Returns
+    -------
+    result_list : list of ArchiveResult
+        Outcome for each directory, in the order given
+    """
+    if len(dir_list) == 0:
+        return []
+    if archive_format == 'auto':
+        archive_format = choose_archive_format(dir_list[:AUTO_SAMPLE],
+                                               target_ratio=target_ratio)
+    if workers is None:
+        workers = get_default_workers()
+    workers = max(1, workers)
+    processes = min(workers, len(dir_list))
+    block_workers = max(1, workers // processes)
+
+    if processes == 1:
+        return [archive_dir(srcdir, block_workers, archive_format, inode_order)
+                for srcdir in dir_list]
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=configure_throttle_share,
+                             initargs=(get_throttle_config(), 1. / processes,
+                                       1. / processes)) as pool:
+        futures = [pool.submit(archive_dir, srcdir, block_workers, archive_format,
+                               inode_order)
+                   for srcdir in dir_list]
+        result_list = [future.result() for future in futures]
+
+    return result_list
+
+
+class _CountingSink(object):
+    """
+    Write-only file object that counts bytes,
+    passing them on to another file object if given
+    """
+
+    def __init__(self, fileobj=None):
+        self.fileobj = fileobj
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+        return len(data)
+
+
+def estimate_compression_ratio(dir_list, sample=3, workers=None,
+                               archive_format=DEFAULT_FORMAT):
+    """
+    Estimate the compression ratio of archiving from a sample of directories
+
+    The sampled directories are compressed in memory, nothing is written
+
+    Parameters
+    ----------
+    dir_list : list (str)
+        Directories that will be archived
+    sample : int
+        Number of directories to sample, spread over the list
+    workers : int (optional)
+        Number of compression threads (gzip formats); default is one per core
+    archive_format : str
+        One of ARCHIVE_FORMATS, the format the directories will be
+        archived in; default is DEFAULT_FORMAT
+
+    Returns
+    -------
+    ratio : float or None
+        Compressed size over uncompressed tar size,
+        None if nothing could be sampled
+    """
+    if len(dir_list) == 0 or sample < 1:
+        return None
+    step = max(1, len(dir_list) // sample)
+    raw_size = 0
+    compressed_size = 0
+    for srcdir in dir_list[::step][:sample]:
+        sink = _CountingSink()
+        compressor = open_compressor(sink, archive_format,
+                                     block_workers=workers or get_default_workers())
+        raw = _CountingSink(compressor)
+        try:
+            write_tar(srcdir, raw)
+        except (OSError, tarfile.TarError):
+            continue
+        finally:
+            compressor.close()
+        raw_size += raw.size
+        compressed_size += sink.size
+    if raw_size == 0:
+        return None
+
+    return float(compressed_size) / raw_size
+
+
+class _SampleFull(Exception):
+    pass
+
+
+class _LimitedBuffer(object):
+    """
+    Write-only file object keeping data up to a limit, then stopping the writer
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data[:self.limit - self.buffer.tell()])
+        if self.buffer.tell() >= self.limit:
+            raise _SampleFull()
+        return len(data)
+
+
+def measure_archive_formats(dir_list, formats=None, sample_bytes=SAMPLE_BYTES):
+    """
+    Measure compression ratio and speed of archive formats on sample directories
+
+    The tar stream of each directory (up to sample_bytes) is built
+    once in memory, then compressed with every format, single-threaded
+
+    Parameters
+    ----------
+    dir_list : list (str)
+        Directories to sample
+    formats : list (str) (optional)
+        Formats to measure; default is all ARCHIVE_FORMATS
+    sample_bytes : int
+        Maximum size of the tar stream sampled per directory
+
+    Returns
+    -------
+    measurements : OrderedDict
+        For each format, (ratio, bytes per second); empty if nothing
+        could be sampled
+    """
+    if formats is None:
+        formats = list(ARCHIVE_FORMATS)
+    samples = []
+    for srcdir in dir_list:
+        sink = _LimitedBuffer(sample_bytes)
+        try:
+            write_tar(srcdir, sink)
+        except _SampleFull:
+            pass
+        except (OSError, tarfile.TarError):
+            continue
+        samples.append(sink.buffer.getvalue())
+    raw_size = sum(len(data) for data in samples)
+    measurements = OrderedDict()
+    if raw_size == 0:
+        return measurements
+    for archive_format in formats:
+        compressed_size = 0
+        start = time.time()
+        for data in samples:
+            counter = _CountingSink()
+            compressor = open_compressor(counter, archive_format)
+            compressor.write(data)
+            compressor.close()
+            compressed_size += counter.size
+        elapsed = max(time.time() - start, 1e-9)
+        measurements[archive_format] = (float(compressed_size) / raw_size,
+                                        raw_size / elapsed)
+
+    return measurements
+
+
+def choose_archive_format(dir_list, target_ratio=DEFAULT_TARGET_RATIO,
+                          sample_bytes=SAMPLE_BYTES):
+    """
+    Choose the fastest archive format that reaches a compression ratio
+
+    Parameters
+    ----------
+    dir_list : list (str)
+        Sample directories, e.g. the first few to be archived
+    target_ratio : float
+        Compressed over uncompressed size to reach
+    sample_bytes : int
+        Maximum size of the tar stream sampled per directory
+
+    Returns
+    -------
+    archive_format : str
+        Fastest format reaching target_ratio; if none does,
+        the format with the best ratio. DEFAULT_FORMAT if
+        nothing could be sampled
+    """
+    measurements = measure_archive_formats(dir_list, sample_bytes=sample_bytes)
+    if len(measurements) == 0:
+        return DEFAULT_FORMAT
+    meeting = [f for f in measurements if measurements[f][0] <= target_ratio]
+    if len(meeting) > 0:
+        return max(meeting, key=lambda f: measurements[f][1])
+
+    return min(measurements, key=lambda f: measurements[f][0])
@@ -0,0 +1,385 @@
+#Compact, array backed cleanup plans
+
+from __future__ import print_function
+
+"""
+Compact, array backed cleanup plans
+
+A plan for all of the archive is millions of work items, each holding a
+full path such as /data3/apertif/200512041/27/continuum/model_mf_03,
+most of which is the same prefix over and over. Here a plan is held as
+NumPy columns instead: obsid, beam, category, action and cycle number,
+with an index into an interned table of apertif roots and one of
+suffix patterns (the path below the beam directory, with the cycle
+number taken out, e.g. continuum/model_mf_{0:02d}). A work item takes
+about 20 bytes rather than a few hundred, and its paths are only built
+when it is used.
+
+Sorting, selecting and counting per mount, obsid or category work on
+the columns at once.
+"""
+
+import re
+from array import array
+from collections import OrderedDict
+import numpy as np
+from modules.executor import WorkItem
+from modules.paths import get_mount
+from modules.state import CATEGORY_SUBDIRS
+
+ACTIONS = ['delete', 'archive']
+CATEGORIES = list(CATEGORY_SUBDIRS)
+# columns that plans can be sorted, selected and grouped on
+GROUP_KEYS = ['mount', 'obsid', 'beam', 'category', 'action']
+
+# cycle numbers: selfcal/NN and the _NN of continuum products
+_cycle_pattern = re.compile(r'^(selfcal/)([0-9]{2})(?=/|$)|_([0-9]{2})(\.fits)?$')
+
+
+def split_cycle(suffix):
+    """
+    Take the cycle number out of a path below a beam directory
+
+    Parameters
+    ----------
+    suffix : str
+        Path below the beam directory, e.g. continuum/model_mf_03
+
+    Returns
+    -------
+    pattern : str
+        Suffix with the cycle as a format field, e.g. continuum/model_mf_{0:02d}
+    cycle : int
+        Cycle number, or -1 if the suffix has none
+    """
+    escaped = suffix.replace('{', '{{').replace('}', '}}')
+    m = _cycle_pattern.search(escaped)
+    if m is None:
+        return escaped, -1
+    if m.group(2) is not None:
+        return escaped[:m.start(2)] + '{0:02d}' + escaped[m.end(2):], int(m.group(2))
+
+    return escaped[:m.start(3)] + '{0:02d}' + escaped[m.end(3):], int(m.group(3))
+
+
+class CompactPlan(object):
+    """
+    Cleanup work items held as columns
+
+    Iterating a plan gives its WorkItems, with their paths built
+    on the fly. Use CompactPlan.from_items to build one.
+    """
+
+    def __init__(self):
+        self.obsid = np.zeros(0, dtype=np.uint32)
+        self.beam = np.zeros(0, dtype=np.uint8)
+        self.category = np.zeros(0, dtype=np.uint8)
+        self.action = np.zeros(0, dtype=np.uint8)
+        self.root = np.zeros(0, dtype=np.uint8)
+        self.cycle = np.zeros(0, dtype=np.int8)
+        self.suffix = np.zeros(0, dtype=np.uint32)
+        # pattern of the archive required, -1 for none
+        self.requires = np.zeros(0, dtype=np.int32)
+        self.requires_cycle = np.zeros(0, dtype=np.int8)
+        self.roots = []
+        self.patterns = []
+        self._mounts = None
+
+    @classmethod
+    def from_items(cls, item_iter):
+        """
+        Build a compact plan from work items
+
+        Parameters
+        ----------
+        item_iter : iterable of WorkItem
+            Work items, e.g. from functions.iter_work_items or plan.iter_plan;
+            they are consumed one at a time
+
+        Returns
+        -------
+        plan : CompactPlan
+            The work items, in the same order
+        """
+        plan = cls()
+        columns = dict((name, array(typecode)) for name, typecode in
+                       [('obsid', 'L'), ('beam', 'B'), ('category', 'B'),
+                        ('action', 'B'), ('root', 'B'), ('cycle', 'b'),
+                        ('suffix', 'L'), ('requires', 'l'), ('requires_cycle', 'b')])
+        root_index = {}
+        pattern_index = {}
+
+        def intern(table, index, value):
+            if value not in index:
+                index[value] = len(table)
+                table.append(value)
+            return index[value]
+
+        for item in item_iter:
+            marker = '/{0}/{1:02d}/'.format(item.obsid, item.beam)
+            pos = item.path.find(marker)
+            if pos < 0:
+                raise ValueError('{0} is not in the directory of beam {1:02d} of {2}'.format(
+                    item.path, item.beam, item.obsid))
+            beamdir = item.path[:pos + len(marker)]
+            pattern, cycle = split_cycle(item.path[len(beamdir):])
+            if item.requires is None:
+                requires, requires_cycle = -1, -1
+            elif item.requires.startswith(beamdir):
+                requires_pattern, requires_cycle = split_cycle(item.requires[len(beamdir):])
+                requires = intern(plan.patterns, pattern_index, requires_pattern)
+            else:
+                raise ValueError('{0} is not in the directory of beam {1:02d} of {2}'.format(
+                    item.requires, item.beam, item.obsid))
+            columns['obsid'].append(int(item.obsid))
+            columns['beam'].append(item.beam)
+            columns['category'].append(CATEGORIES.index(item.category))
+            columns['action'].append(ACTIONS.index(item.action))
+            columns['root'].append(intern(plan.roots, root_index, item.path[:pos]))
+            columns['cycle'].append(cycle)
+            columns['suffix'].append(intern(plan.patterns, pattern_index, pattern))
+            columns['requires'].append(requires)
+            columns['requires_cycle'].append(requires_cycle)
+        for name, column in columns.items():
+            setattr(plan, name, np.array(column, dtype=getattr(plan, name).dtype))
+
+        return plan
+
+    def __len__(self):
+        return len(self.obsid)
+
+    def __iter__(self):
+        return self.iter_items()
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the columns and tables, in bytes
+        """
+        return (sum(column.nbytes for column in self._columns().values()) +
+                sum(len(s) for s in self.roots) + sum(len(s) for s in self.patterns))
+
+    def _columns(self):
+        return OrderedDict((name, getattr(self, name)) for name in
+                           ['obsid', 'beam', 'category', 'action', 'root', 'cycle',
+                            'suffix', 'requires', 'requires_cycle'])
+
+    def _build_path(self, i, pattern, cycle):
+        return '{0}/{1:09d}/{2:02d}/{3}'.format(
+            self.roots[self.root[i]], self.obsid[i], self.beam[i],
+            self.patterns[pattern].format(cycle))
+
+    def get_path(self, i):
+        """
+        Build the path of the i-th work item
+        """
+        return self._build_path(i, self.suffix[i], self.cycle[i])
+
+    def get_item(self, i):
+        """
+        Build the i-th work item
+        """
+        requires = None
+        if self.requires[i] >= 0:
+            requires = self._build_path(i, self.requires[i], self.requires_cycle[i])
+        return WorkItem('{0:09d}'.format(self.obsid[i]), int(self.beam[i]),
+                        CATEGORIES[self.category[i]], ACTIONS[self.action[i]],
+                        self.get_path(i), requires)
+
+    def iter_items(self, index=None):
+        """
+        Build work items one at a time
+
+        Parameters
+        ----------
+        index : array (int) (optional)
+            Work items to build, in this order; default is all, in plan order
+
+        Returns
+        -------
+        item : iterator of WorkItem
+            Work items
+        """
+        if index is None:
+            index = range(len(self))
+        for i in index:
+            yield self.get_item(i)
+
+    def take(self, index):
+        """
+        Get a plan of some of the work items
+
+        Parameters
+        ----------
+        index : array (int or bool)
+            Positions (in the new order) or a mask of the work items to keep
+
+        Returns
+        -------
+        plan : CompactPlan
+            The work items kept, sharing the tables of this plan
+        """
+        plan = CompactPlan()
+        for name, column in self._columns().items():
+            setattr(plan, name, column[index])
+        plan.roots = self.roots
+        plan.patterns = self.patterns
+        plan._mounts = self._mounts
+
+        return plan
+
+    def get_mounts(self):
+        """
+        Get the mount of every work item
+
+        Returns
+        -------
+        mount_codes : array (int)
+            Index of the mount of each work item in mount_list
+        mount_list : list (str)
+            Mount points, looked up once per apertif root
+        """
+        if self._mounts is None or len(self._mounts[0]) < len(self.roots):
+            mount_cache = {}
+            mount_list = []
+            root_mounts = []
+            for root in self.roots:
+                mount = get_mount(root, mount_cache)
+                if mount not in mount_list:
+                    mount_list.append(mount)
+                root_mounts.append(mount_list.index(mount))
+            self._mounts = (np.array(root_mounts, dtype=np.uint8), mount_list)
+        root_mounts, mount_list = self._mounts
+
+        return root_mounts[self.root], mount_list
+
+    def get_key(self, key):
+        """
+        Get a column to sort, select or group on
+
+        Parameters
+        ----------
+        key : str
+            One of GROUP_KEYS
+
+        Returns
+        -------
+        codes : array (int)
+            Value (obsid, beam) or code of each work item
+        labels : list (str) or None
+            Label of each code (mount, category, action);
+            None if the codes are the values
+        """
+        if key == 'mount':
+            return self.get_mounts()
+        if key == 'category':
+            return self.category, CATEGORIES
+        if key == 'action':
+            return self.action, ACTIONS
+        if key in ('obsid', 'beam'):
+            return getattr(self, key), None
+        raise ValueError('Cannot group a plan by {}'.format(key))
+
+    def sort(self, keys=('obsid', 'beam')):
+        """
+        Sort the work items, keeping their order within equal keys
+
+        Items that require an archive stay after it as long as the keys
+        do not split a beam (mount, obsid and beam are safe).
+
+        Parameters
+        ----------
+        keys : list (str)
+            Keys from GROUP_KEYS, most significant first
+
+        Returns
+        -------
+        plan : CompactPlan
+            Sorted plan
+        """
+        if len(keys) == 0:
+            return self.take(np.arange(len(self)))
+        # lexsort is stable, and sorts on the last key first
+        order = np.lexsort([self.get_key(key)[0] for key in reversed(keys)])
+
+        return self.take(order)
+
+    def select(self, obsids=None, beams=None, categories=None, actions=None,
+               mounts=None):
+        """
+        Select work items
+
+        Parameters
+        ----------
+        obsids, beams, categories, actions, mounts : list (optional)
+            Values to keep for each key; None keeps all
+
+        Returns
+        -------
+        plan : CompactPlan
+            Work items matching all given values, in plan order
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for key, values in [('obsid', obsids), ('beam', beams),
+                            ('category', categories), ('action', actions),
+                            ('mount', mounts)]:
+            if values is None:
+                continue
+            codes, labels = self.get_key(key)
+            if labels is None:
+                values = [int(v) for v in values]
+            else:
+                values = [labels.index(v) for v in values if v in labels]
+            mask &= np.isin(codes, values)
+
+        return self.take(mask)
+
+    def count(self, key):
+        """
+        Count the work items per value of a key
+
+        Parameters
+        ----------
+        key : str
+            One of GROUP_KEYS
+
+        Returns
+        -------
+        counts : OrderedDict
+            Number of work items (delete, archive) per value, in value order
+        """
+        codes, labels = self.get_key(key)
+        values, inverse = np.unique(codes, return_inverse=True)
+        counts = np.zeros((len(values), len(ACTIONS)), dtype=np.int64)
+        np.add.at(counts, (inverse, self.action), 1)
+        result = OrderedDict()
+        for value, row in zip(values, counts):
+            if labels is not None:
+                label = labels[value]
+            elif key == 'obsid':
+                label = '{0:09d}'.format(value)
+            else:
+                label = '{0:02d}'.format(value)
+            result[label] = tuple(int(n) for n in row)
+
+        return result
+
+
+def print_plan_summary(plan, levels=('mount', 'category')):
+    """
+    Print the number of work items of a plan per mount, obsid or category
+
+    Parameters
+    ----------
+    plan : CompactPlan
+        Plan to summarise
+    levels : list (str)
+        Keys from GROUP_KEYS to count per
+    """
+    print('Plan of {0} work items, {1:.1f} MB in memory'.format(
+        len(plan), plan.nbytes / 1024. ** 2))
+    for level in levels:
+        print('')
+        print('{0:<24}{1:>12}{2:>12}'.format('Items per ' + level, ACTIONS[0], ACTIONS[1]))
+        for label, counts in plan.count(level).items():
+            print('{0:<24}{1:>12d}{2:>12d}'.format(label, counts[0], counts[1]))
@@ -0,0 +1,315 @@
+#Deletion engine for happili cleanup
+
+from __future__ import print_function
+
+"""
+Deletion engine for happili cleanup
+
+In happili-01 mode beams are spread over /data, /data2, /data3 and /data4.
+Deleting targets one after another keeps only one of these busy at a time,
+so targets are grouped by device (st_dev) and each device
+gets its own bounded pool of workers (see modules.executor).
+
+Trees are removed with os.scandir relative to an open directory fd
+(unlinkat / rmdirat semantics), so no full path is built or resolved
+again for each entry, and the reason for any failure is kept.
+Each unlink / rmdir is within the metadata rate limit of the mount,
+if one is set (see modules.throttle).
+
+On local disks, the entries of each directory are removed in inode
+order rather than listing order: the inodes of the many small files
+of a measurement set are then visited in the order they lie on disk,
+with less seeking. This is the default on local filesystems only;
+over NFS, the order on disk is up to the server.
+"""
+
+import os
+import errno
+import shutil
+import stat
+import threading
+from collections import namedtuple
+from modules.throttle import get_throttle, throttled_op
+from modules.paths import get_mount, get_fs_type
+
+# default number of parallel deletions per device
+DEFAULT_WORKERS = 4
+
+# outcome of deleting a single target;
+# errors counts failures by errno name, e.g. {'EACCES': 3}
+DeleteResult = namedtuple('DeleteResult', ['path', 'device', 'deleted', 'error',
+                                           'nfiles', 'nbytes', 'errors'])
+
+# whether removal relative to directory fds is available here
+_use_fd_functions = (os.scandir in os.supports_fd and
+                     os.unlink in os.supports_dir_fd and
+                     os.rmdir in os.supports_dir_fd and
+                     os.open in os.supports_dir_fd)
+_O_DIRECTORY = getattr(os, 'O_DIRECTORY', 0)
+_O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+# filesystems on local disks, where inode order follows the layout on disk
+LOCAL_FS_TYPES = ['ext2', 'ext3', 'ext4', 'xfs', 'btrfs']
+
+_mount_cache = {}
+_local_mounts = {}
+_lock = threading.Lock()
+
+
+def parse_mount_workers(mount_workers_str):
+    """
+    Parse per-mount worker counts from the command line
+
+    Parameters
+    ----------
+    mount_workers_str : str
+        Comma separated mount=workers, e.g. '/data2=8,/data3=8'
+
+    Returns
+    -------
+    mount_workers : dict
+        Number of workers for each mount
+    """
+    mount_workers = {}
+    if mount_workers_str is None:
+        return mount_workers
+    for item in mount_workers_str.split(','):
+        if item.strip() == '':
+            continue
+        mount, workers = item.rsplit('=', 1)
+        mount_workers[mount.strip()] = int(workers)
+
+    return mount_workers
+
+
+def get_device_workers(mount_workers=None):
+    """
+    Translate per-mount worker counts to per-device worker counts
+
+    Parameters
+    ----------
+    mount_workers : dict (optional)
+        Number of workers for each mount
+
+    Returns
+    -------
+    device_workers : dict
+        Number of workers for each device
+    """
+    device_workers = {}
+    if mount_workers is None:
+        return device_workers
+    for mount in mount_workers:
+        try:
+            device_workers[os.stat(mount).st_dev] = mount_workers[mount]
+        except OSError:
+            print('Unable to find mount {}; using default workers'.format(mount))
+
+    return device_workers
+
+
+def use_inode_order(path, inode_order=None):
+    """
+    Decide whether to visit the entries below a target in inode order
+
+    Parameters
+    ----------
+    path : str
+        Target to remove or archive
+    inode_order : Boolean (optional)
+        Force inode order on or off; by default it is on
+        for targets on a local filesystem (LOCAL_FS_TYPES)
+
+    Returns
+    -------
+    inode_order : Boolean
+        Whether to sort directory entries by inode
+    """
+    if inode_order is not None:
+        return inode_order
+    with _lock:
+        mount = get_mount(path, _mount_cache)
+        if mount not in _local_mounts:
+            _local_mounts[mount] = get_fs_type(mount) in LOCAL_FS_TYPES
+        return _local_mounts[mount]
+
+
+def get_disk_usage(st):
+    """
+    Get the space used on disk for a stat result, as du does
+    """
+    try:
+        return st.st_blocks * 512
+    except AttributeError:
+        return st.st_size
+
+
+def _record_error(counts, e):
+    """
+    Count a failure by errno name, keeping the first message
+    """
+    name = errno.errorcode.get(e.errno, str(e.errno))
+    counts['errors'][name] = counts['errors'].get(name, 0) + 1
+    if counts['error'] is None:
+        counts['error'] = str(e)
+
+
+def _remove_contents(dir_fd, counts, throttle=None, inode_order=False):
+    """
+    Remove everything in an open directory, relative to its fd
+    """
+    # read the whole listing first, so only one listing is open per level
+    with os.scandir(dir_fd) as it:
+        entry_list = list(it)
+    if inode_order is True:
+        # from the listing, no stat needed
+        entry_list.sort(key=lambda entry: entry.inode())
+    for entry in entry_list:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError as e:
+            _record_error(counts, e)
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                fd = os.open(entry.name, os.O_RDONLY | _O_DIRECTORY | _O_NOFOLLOW,
+                             dir_fd=dir_fd)
+            except OSError as e:
+                _record_error(counts, e)
+                continue
+            try:
+                _remove_contents(fd, counts, throttle, inode_order)
+            except OSError as e:
+                _record_error(counts, e)
+            finally:
+                os.close(fd)
+            try:
+                throttled_op(throttle, os.rmdir, entry.name, dir_fd=dir_fd)
+                counts['nbytes'] += get_disk_usage(st)
+            except OSError as e:
+                _record_error(counts, e)
+        else:
+            try:
+                throttled_op(throttle, os.unlink, entry.name, dir_fd=dir_fd)
+                counts['nfiles'] += 1
+                counts['nbytes'] += get_disk_usage(st)
+            except OSError as e:
+                _record_error(counts, e)
+
+
+def is_target_gone(result):
+    """
+    Was a deletion target already gone before it was deleted?
+
+    A target that no longer exists counts as done, not as a failure:
+    it may have been removed just before an interruption, or by someone
+    else between the scan and the deletion
+    """
+    return result.errors == {'ENOENT': 1} and result.nfiles == 0
+
+
+def remove_tree(path, device=None, inode_order=None):
+    """
+    Remove a directory tree or a single file
+
+    Directories are walked with os.scandir and entries are removed
+    relative to an open directory fd. Symbolic links are removed,
+    never followed. Removal carries on past failures, which are
+    counted by errno rather than stopping at the first one.
+
+    Parameters
+    ----------
+    path : str
+        Target to remove
+    device : int (optional)
+        Device of the target, recorded in the result
+    inode_order : Boolean (optional)
+        Remove the entries of each directory in inode order;
+        by default on local filesystems only (see use_inode_order)
+
+    Returns
+    -------
+    result : DeleteResult
+        Files removed, bytes freed and failures by errno
+    """
+    counts = {'nfiles': 0, 'nbytes': 0, 'errors': {}, 'error': None}
+    try:
+        st = os.lstat(path)
+    except OSError as e:
+        _record_error(counts, e)
+        return DeleteResult(path, device, False, counts['error'], 0, 0, counts['errors'])
+
+    throttle = get_throttle(path)
+    if not stat.S_ISDIR(st.st_mode):
+        try:
+            throttled_op(throttle, os.unlink, path)
+            counts['nfiles'] += 1
+            counts['nbytes'] += get_disk_usage(st)
+        except OSError as e:
+            _record_error(counts, e)
+    elif not _use_fd_functions:
+        def onerror(function, p, exc_info):
+            _record_error(counts, exc_info[1])
+        shutil.rmtree(path, onerror=onerror)
+    else:
+        parent, name = os.path.split(os.path.normpath(path))
+        try:
+            parent_fd = os.open(parent or os.curdir, os.O_RDONLY | _O_DIRECTORY)
+        except OSError as e:
+            _record_error(counts, e)
+            parent_fd = None
+        if parent_fd is not None:
+            try:
+                fd = os.open(name, os.O_RDONLY | _O_DIRECTORY | _O_NOFOLLOW,
+                             dir_fd=parent_fd)
+                try:
+                    _remove_contents(fd, counts, throttle,
+                                     use_inode_order(path, inode_order))
+                finally:
+                    os.close(fd)
+                throttled_op(throttle, os.rmdir, name, dir_fd=parent_fd)
+                counts['nbytes'] += get_disk_usage(st)
+            except OSError as e:
+                _record_error(counts, e)
+            finally:
+                os.close(parent_fd)
+
+    deleted = len(counts['errors']) == 0
+    result = DeleteResult(path, device, deleted, counts['error'],
+                          counts['nfiles'], counts['nbytes'], counts['errors'])
+
+    return result
+
+
+def delete_target(path, device=None, verbose=True, inode_order=None):
+    """
+    Delete a single target, directory or file
+
+    Parameters
+    ----------
+    path : str
+        Target to delete
+    device : int (optional)
+        Device of the target, recorded in the result
+    verbose : Boolean
+        Print a record of what is deleted?
+        Default is True
+    inode_order : Boolean (optional)
+        Remove entries in inode order; by default on local filesystems only
+
+    Returns
+    -------
+    result : DeleteResult
+        Outcome of the deletion
+    """
+    # may not have permission to delete data;
+    # the reason is kept in the result
+    result = remove_tree(path, device=device, inode_order=inode_order)
+    if verbose is True:
+        if result.deleted is True:
+            print('Deleting {}'.format(path))
+        elif not is_target_gone(result):
+            print('Unable to delete {0} ({1})'.format(path, result.error))
+
+    return result
+
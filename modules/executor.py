@@ -0,0 +1,320 @@
+#Streaming execution of cleanup work items
+
+from __future__ import print_function
+
+"""
+Streaming execution of cleanup work items
+
+The planners yield work items beam by beam, and they are executed
+as they arrive: deletions go to a bounded pool of workers per device,
+archives to a pool of processes. Deletions that depend on an archive
+(e.g. the original of a gztarred model) wait only for that archive.
+Only a bounded number of items is in flight at any time,
+so deletion starts straight away and memory does not grow
+with the width of the date range.
+"""
+
+import os
+import errno
+import time
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import wait, FIRST_COMPLETED
+from modules.deletion import delete_target, get_device_workers
+from modules.deletion import DeleteResult, DEFAULT_WORKERS, is_target_gone
+from modules.trash import trash_target
+from modules.archive import archive_dir, ArchiveResult, get_default_workers
+from modules.archive import get_archive_name, choose_archive_format
+from modules.archive import DEFAULT_FORMAT, DEFAULT_TARGET_RATIO, AUTO_SAMPLE
+from modules.metrics import record_phase, get_path_mount
+from modules.throttle import get_throttle_config, configure_throttle_share
+from modules.throttle import ARCHIVE_OPS_SHARE
+
+# a single cleanup action
+# action is 'archive' or 'delete';
+# requires is the path of an archive that must succeed first, or None
+WorkItem = namedtuple('WorkItem', ['obsid', 'beam', 'category', 'action',
+                                   'path', 'requires'])
+
+# default number of items in flight, per worker
+PENDING_PER_WORKER = 4
+
+
+def _error_name(e):
+    return errno.errorcode.get(e.errno, str(e.errno))
+
+
+def _timed(function, *args, **kwargs):
+    """
+    Call a function in a worker, returning its start and end time with the result
+    """
+    start = time.time()
+    result = function(*args, **kwargs)
+
+    return start, time.time(), result
+
+
+def _record_result(item, start, end, result):
+    """
+    Record the metrics of an executed work item
+    """
+    if item.action == 'archive':
+        # bytes read, as for deletions, so the phases can be compared
+        record_phase('archive', start, end, nbytes=result.nbytes_read,
+                     errors=0 if result.archived is True else 1,
+                     mount=get_path_mount(item.path))
+    else:
+        # a target that was already gone is not an error
+        record_phase('delete', start, end, nbytes=result.nbytes,
+                     errors=0 if is_target_gone(result) else sum(result.errors.values()),
+                     mount=get_path_mount(item.path))
+
+
+def execute_work_items(item_iter, run=False, verbose=True,
+                       workers=DEFAULT_WORKERS, mount_workers=None,
+                       archive_workers=None, archived=None,
+                       archive_format=DEFAULT_FORMAT,
+                       target_ratio=DEFAULT_TARGET_RATIO, trash=False, inode_order=None):
+    """
+    Execute a stream of work items
+
+    Parameters
+    ----------
+    item_iter : iterable of WorkItem
+        Work items, e.g. from functions.iter_work_items
+    run : Boolean
+        Actually run and do archiving / deletion?
+        Default is False
+    verbose : Boolean
+        Print a record of what is (to be) done?
+        Default is True
+    workers : int
+        Number of parallel deletions per device
+        Default is DEFAULT_WORKERS
+    mount_workers : dict (optional)
+        Number of parallel deletions for specific mounts
+    archive_workers : int (optional)
+        Number of parallel archiving processes; default is one per core.
+        With fewer processes than cores, each archive is compressed
+        by several threads
+    archived : set (str) (optional)
+        Archives already made, e.g. before a resumed run.
+        May be added to while the items are streamed
+    archive_format : str
+        Archive format (see modules.archive), default is DEFAULT_FORMAT.
+        With 'auto', the first AUTO_SAMPLE directories to archive are
+        held back and sampled to choose the format
+    target_ratio : float
+        Compression ratio to reach with the auto format
+    trash : Boolean
+        Move targets into the trash of their mount (see modules.trash),
+        leaving their removal to the reaper, rather than deleting them
+        Default is False
+    inode_order : Boolean (optional)
+        Visit directory entries in inode order when deleting and archiving;
+        by default on local filesystems only (see deletion.use_inode_order)
+
+    Returns
+    -------
+    item_result : iterator of (WorkItem, ArchiveResult or DeleteResult)
+        Outcome of each item, in order of completion
+    """
+    if run is not True:
+        for item in item_iter:
+            if verbose is True:
+                if item.action == 'archive':
+                    print('Practice run only; {0} {1}'.format(archive_format, item.path))
+                else:
+                    print('Practice run only; deleting {}'.format(item.path))
+            if item.action == 'archive':
+                practice_format = DEFAULT_FORMAT if archive_format == 'auto' else archive_format
+                yield item, ArchiveResult(item.path, get_archive_name(item.path, practice_format),
+                                          False, None, practice_format, None, 0, 0)
+            else:
+                yield item, DeleteResult(item.path, None, False, None, 0, 0, {})
+        return
+
+    if archive_workers is None:
+        archive_workers = get_default_workers()
+    # cores left over by the archiving processes compress blocks
+    # of each archive in parallel
+    block_workers = max(1, get_default_workers() // max(1, archive_workers))
+    if archived is None:
+        archived = set()
+    device_workers = get_device_workers(mount_workers)
+    remove = trash_target if trash is True else delete_target
+    # limits of this process, shared with the archiving processes
+    # while archives are in flight
+    throttle_config = get_throttle_config()
+    device_pools = {}
+    archive_pool = [None]
+    archives_in_flight = [0]
+    max_pending = PENDING_PER_WORKER * (workers * 4 + archive_workers)
+    # futures in flight, with their items
+    pending = {}
+    # deletions waiting for an archive, and archives that finished
+    waiting = {}
+    archive_done = {}
+    # results ready to hand out
+    ready = deque()
+
+    def submit_delete(item):
+        try:
+            device = os.lstat(item.path).st_dev
+        except OSError as e:
+            if verbose is True and e.errno != errno.ENOENT:
+                print('Unable to delete {0} ({1})'.format(item.path, e))
+            result = DeleteResult(item.path, None, False, str(e),
+                                  0, 0, {_error_name(e): 1})
+            now = time.time()
+            _record_result(item, now, now, result)
+            ready.append((item, result))
+            return
+        if device not in device_pools:
+            device_pools[device] = ThreadPoolExecutor(
+                max_workers=max(1, device_workers.get(device, workers)))
+        future = device_pools[device].submit(_timed, remove, item.path,
+                                             device=device, verbose=verbose,
+                                             inode_order=inode_order)
+        pending[future] = item
+
+    def release(archive_path, ok):
+        archive_done[archive_path] = ok
+        for item in waiting.pop(archive_path, []):
+            if ok is True:
+                submit_delete(item)
+            else:
+                ready.append((item, DeleteResult(
+                    item.path, None, False,
+                    'archive {} failed'.format(archive_path), 0, 0, {})))
+
+    def collect(block):
+        if len(pending) == 0:
+            return
+        done, not_done = wait(list(pending), timeout=None if block else 0,
+                              return_when=FIRST_COMPLETED)
+        for future in done:
+            item = pending.pop(future)
+            start, end, result = future.result()
+            _record_result(item, start, end, result)
+            if item.action == 'archive':
+                archives_in_flight[0] -= 1
+                if archives_in_flight[0] == 0:
+                    # deletions get the full limits back while no archive runs
+                    configure_throttle_share(throttle_config)
+                if verbose is True:
+                    if result.archived is True:
+                        print('{0} {1}'.format(fmt[0], item.path))
+                    else:
+                        print('Unable to {0} {1} ({2})'.format(fmt[0], item.path,
+                                                               result.error))
+                release(item.path, result.archived)
+            ready.append((item, result))
+
+    # archive format, once chosen; and archives held back to choose it
+    fmt = [None if archive_format == 'auto' else archive_format]
+    held = []
+
+    def submit_archive(item):
+        if fmt[0] is None:
+            held.append(item)
+            if len(held) < AUTO_SAMPLE:
+                return
+            choose_format()
+            return
+        if archive_pool[0] is None:
+            # the archiving processes split the bytes of a mount and take
+            # a small part of its metadata operations
+            archive_pool[0] = ProcessPoolExecutor(
+                max_workers=archive_workers, initializer=configure_throttle_share,
+                initargs=(throttle_config, 1. / archive_workers,
+                          ARCHIVE_OPS_SHARE / archive_workers))
+        if archives_in_flight[0] == 0:
+            # deletions in this process take no bytes, and keep the
+            # other metadata operations
+            configure_throttle_share(throttle_config, ops_share=1. - ARCHIVE_OPS_SHARE)
+        archives_in_flight[0] += 1
+        pending[archive_pool[0].submit(_timed, archive_dir, item.path, block_workers,
+                                       fmt[0], inode_order)] = item
+
+    def choose_format():
+        fmt[0] = choose_archive_format([item.path for item in held],
+                                       target_ratio=target_ratio)
+        if verbose is True:
+            print('Archiving as {0}, sampled from {1} directories'.format(
+                fmt[0], len(held)))
+        while len(held) > 0:
+            submit_archive(held.pop(0))
+
+    try:
+        for item in item_iter:
+            if item.action == 'archive':
+                submit_archive(item)
+            elif item.requires is not None and item.requires in archived:
+                submit_delete(item)
+            elif item.requires is not None and item.requires not in archive_done:
+                waiting.setdefault(item.requires, []).append(item)
+            elif item.requires is not None and archive_done[item.requires] is not True:
+                ready.append((item, DeleteResult(
+                    item.path, None, False,
+                    'archive {} failed'.format(item.requires), 0, 0, {})))
+            else:
+                submit_delete(item)
+            # hand out what has finished, and wait when too much is in flight
+            collect(block=len(pending) >= max_pending)
+            while len(ready) > 0:
+                yield ready.popleft()
+        if len(held) > 0:
+            choose_format()
+        while len(pending) > 0 or len(ready) > 0:
+            collect(block=True)
+            while len(ready) > 0:
+                yield ready.popleft()
+        # deletions waiting on archives that were never planned
+        for archive_path in list(waiting):
+            release(archive_path, False)
+        while len(ready) > 0:
+            yield ready.popleft()
+    finally:
+        for pool in device_pools.values():
+            pool.shutdown()
+        if archive_pool[0] is not None:
+            archive_pool[0].shutdown()
+            configure_throttle_share(throttle_config)
+
+
+def delete_paths(path_list, run=False, verbose=True,
+                 workers=DEFAULT_WORKERS, mount_workers=None):
+    """
+    Delete a list of targets, with a pool of workers per device
+
+    Parameters
+    ----------
+    path_list : iterable (str)
+        Targets to delete
+    run : Boolean
+        Actually run and do deletion?
+        Default is False
+    verbose : Boolean
+        Print a record of what is (to be) deleted?
+        Default is True
+    workers : int
+        Number of parallel deletions per device
+        Default is DEFAULT_WORKERS
+    mount_workers : dict (optional)
+        Number of parallel deletions for specific mounts,
+        overriding workers
+
+    Returns
+    -------
+    result_list : list of DeleteResult
+        Outcome for each target, in order of completion
+    """
+    item_iter = (WorkItem(None, None, None, 'delete', path, None)
+                 for path in path_list)
+    result_list = [result for item, result in
+                   execute_work_items(item_iter, run=run, verbose=verbose,
+                                      workers=workers,
+                                      mount_workers=mount_workers)]
+
+    return result_list
@@ -16,14 +16,75 @@ Main things to address / think about:
 import numpy as np
 import os
 import glob
-import shutil
+import fnmatch
 import re
+import time
+from modules.paths import get_beam_root
+from modules.inventory import iter_inventory, scan_inventory, iter_beams, match_names
+from modules.state import CATEGORY_SUBDIRS
+from modules.deletion import DEFAULT_WORKERS
+from modules.archive import DEFAULT_FORMAT
+from modules.executor import execute_work_items, WorkItem
+from modules.metrics import record_phase, get_path_mount
+from modules.manifest import is_in_sorted
+from modules.preflight import check_work_items
+
+
+def parse_date_ranges(ranges_str):
+    """
+    Parse date ranges from the command line
+
+    Parameters
+    ----------
+    ranges_str : str
+        Comma separated YYMMDD-YYMMDD ranges or single YYMMDD dates,
+        e.g. '190701-190731,190906,190907-190930'; either end of
+        a range can be left open, e.g. '211201-'
+
+    Returns
+    -------
+    ranges : list of (str, str)
+        Start and end date of each range; None for an open end
+    """
+    ranges = []
+    if ranges_str is None:
+        return ranges
+    for item in ranges_str.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        if '-' in item:
+            startdate, enddate = [date.strip() or None for date in item.split('-', 1)]
+        else:
+            startdate, enddate = item, item
+        ranges.append((startdate, enddate))
 
+    return ranges
 
-def get_obsid_array(startdate=None, enddate=None):
+
+def parse_taskids(taskids_str):
+    """
+    Parse a comma separated list of taskids from the command line
+
+    Returns
+    -------
+    taskids : list (str)
+        Taskids, e.g. ['210904041', '210905041']
+    """
+    if taskids_str is None:
+        return []
+    return [taskid.strip() for taskid in taskids_str.split(',') if taskid.strip() != '']
+
+
+def get_obsid_array(startdate=None, enddate=None, ranges=None, include=None,
+                    exclude=None, cutoff=None, manifest=None):
     """
     Get array of obsids on happili node
-    Optionally between startdate and enddate
+    Optionally between startdate and enddate,
+    or in any of several date ranges
+
+    The obsid directories are listed once, and each range, taskid
+    and the cutoff is found by binary search in the sorted obsids
 
     Parameters
     ----------
@@ -31,55 +92,105 @@ def get_obsid_array(startdate=None, enddate=None):
          Optional startdate in YYMMDD format
     enddate : str (optional)
          Optional enddate in YYMMDD format
+    ranges : list of (str, str) (optional)
+         Date ranges, as (startdate, enddate) in YYMMDD format,
+         either of which can be None; from parse_date_ranges
+    include : list (str) (optional)
+         Taskids to clean in addition to the date ranges;
+         on their own, only these taskids are cleaned
+    exclude : list (str) (optional)
+         Taskids never to clean
+    cutoff : str (optional)
+         Last taskid that can be cleaned (e.g. the last one
+         sent to cold storage)
+    manifest : Manifest (optional)
+         Manifests of archived and excluded taskids (modules.manifest);
+         obsids it does not allow are dropped before any scanning
 
     Returns
     -------
     obsid_array : array
          Array of obsids as strings
     """
+    start = time.time()
     # do as full ObsID directory to start
-    taskdirlist = glob.glob(
-        "/data/apertif/[1-2][0-9][0-1][0-9][0-3][0-9][0-9][0-9][0-9]")
+    # (beam 00 is on /data in every mode)
+    taskdirlist = glob.glob(os.path.join(
+        get_beam_root(0), "[1-2][0-9][0-1][0-9][0-3][0-9][0-9][0-9][0-9]"))
     # and return it in sorted order
     taskdirlist.sort()
     # take only the ObsID part
     obsid_list = [x[-9:] for x in taskdirlist]
     # create arrays, more useful later
     obsid_array = np.array(obsid_list)
-    obsid_int_array = np.array(obsid_list,dtype=int)
-
-    # now check for date range
-    if startdate is not None:
-        # put startdate into taskid format
-        # so can do numerical comparison
-        startid_str = startdate + '000'
-        startid = np.int(startid_str)
-        # find indices of sources that comes after startid
-        ind_start = np.where(obsid_int_array > startid)[0]
-        if len(ind_start) == 0:
-            print('Start date comes after last obs. Starting from first obs')
-        else:
-            # keep obs that comes after start
-            # do for both arrays, since one is returned
-            # and the other is used in next call
-            obsid_array = obsid_array[ind_start]
-            obsid_int_array = obsid_int_array[ind_start]
-    # and repeat for enddate
-    if enddate is not None:
-        endid_str = enddate + '999'
-        endid = np.int(endid_str)
-        ind_end = np.where(obsid_int_array < endid)[0]
-        if len(ind_end) == 0:
-            print('End date comes before first obs. Going to last obs')
-        else:
-            # keep obs only before end
-            obsid_array = obsid_array[ind_end]
-            # for completeness, int array also
-            obsid_int_array = obsid_int_array[ind_end]
-    
+    obsid_int_array = np.array(obsid_list, dtype=np.int64)
+    n_obsids = len(obsid_int_array)
+
+    if startdate is not None or enddate is not None:
+        # a single range given by its dates falls back to the first / last obs
+        # when the date is outside the obs, as it always has
+        ind_start = 0
+        if startdate is not None:
+            # put startdate into taskid format
+            # so can do numerical comparison
+            # and keep obs that come after it
+            ind_start = np.searchsorted(obsid_int_array, int(startdate + '000'),
+                                        side='right')
+            if ind_start == n_obsids:
+                print('Start date comes after last obs. Starting from first obs')
+                ind_start = 0
+        ind_end = n_obsids
+        if enddate is not None:
+            # and keep obs only before end; as the end is looked for
+            # in the obs after the start, it falls back to the last obs
+            # if no obs after the start comes before the end
+            ind_end = np.searchsorted(obsid_int_array, int(enddate + '999'),
+                                      side='left')
+            if ind_end <= ind_start:
+                print('End date comes before first obs. Going to last obs')
+                ind_end = n_obsids
+        ranges = [(ind_start, ind_end)] + list(_iter_range_indices(
+            obsid_int_array, ranges or []))
+    elif ranges or include:
+        ranges = list(_iter_range_indices(obsid_int_array, ranges or []))
+    else:
+        ranges = [(0, n_obsids)]
+
+    selected = np.zeros(n_obsids, dtype=bool)
+    for ind_start, ind_end in ranges:
+        selected[ind_start:ind_end] = True
+    if include:
+        selected |= is_in_sorted(obsid_int_array, np.unique(
+            np.array(include, dtype=np.int64)))
+    if exclude:
+        selected &= ~is_in_sorted(obsid_int_array, np.unique(
+            np.array(exclude, dtype=np.int64)))
+    if cutoff is not None:
+        selected[np.searchsorted(obsid_int_array, int(cutoff), side='right'):] = False
+    if manifest is not None:
+        selected &= manifest.get_eligible(obsid_int_array)
+    obsid_array = obsid_array[selected]
+    record_phase('discover', start, time.time(), items=len(obsid_array))
+
     return obsid_array
 
 
+def _iter_range_indices(obsid_int_array, ranges):
+    """
+    Find the slice of the sorted obsids in each date range
+    """
+    for startdate, enddate in ranges:
+        ind_start = 0
+        if startdate is not None:
+            ind_start = np.searchsorted(obsid_int_array, int(startdate + '000'),
+                                        side='right')
+        ind_end = len(obsid_int_array)
+        if enddate is not None:
+            ind_end = np.searchsorted(obsid_int_array, int(enddate + '999'),
+                                      side='left')
+        yield ind_start, ind_end
+
+
 def get_obsid_beam_dir(obsid, beam, mode='happili-01'):
     """
     Get directory path for obsid + beam
@@ -102,23 +213,117 @@ def get_obsid_beam_dir(obsid, beam, mode='happili-01'):
         path to obsid / beam
     """
 
-    if mode == 'happili-05':
-        obsid_beam_dir = '/data/apertif/{0}/{1:02d}'.format(obsid, beam)
-    else:
-        # if not happili-05 mode, default to happili-01 mode
-        if beam < 10:
-            obsid_beam_dir = '/data/apertif/{0}/{1:02d}'.format(obsid, beam)
-        elif beam < 20:
-            obsid_beam_dir = '/data2/apertif/{0}/{1:02d}'.format(obsid, beam)
-        elif beam < 30:
-            obsid_beam_dir = '/data3/apertif/{0}/{1:02d}'.format(obsid, beam)
-        else:
-            obsid_beam_dir = '/data4/apertif/{0}/{1:02d}'.format(obsid, beam)
+    obsid_beam_dir = os.path.join(get_beam_root(beam, mode=mode),
+                                  str(obsid), '{0:02d}'.format(beam))
 
     return obsid_beam_dir
 
 
-def get_cal_vis(startdate=None, enddate=None, mode='happili-01'):
+def get_inventory(startdate=None, enddate=None, mode='happili-01',
+                  state=None, categories=None, obsid_array=None):
+    """
+    Scan every obsid / beam once, optionally between startdate and enddate
+
+    The result can be passed to all the get_* / delete_* / cleanup_* functions,
+    so that they share a single scan of the filesystem
+
+    Parameters
+    ----------
+    startdate : str (optional)
+         Optional startdate in YYMMDD format
+    enddate : str (optional)
+         Optional enddate in YYMMDD format
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    state : sqlite3.Connection (optional)
+        Cleanup state index from open_state; beams cleaned before
+        and unchanged since are not scanned again
+    categories : list (str) (optional)
+        Cleanup categories of this run, used with state
+    obsid_array : array (optional)
+        Obsids from get_obsid_array, e.g. for several date ranges;
+        found from startdate and enddate if not given
+
+    Returns
+    -------
+    inventory : OrderedDict
+        Inventory of each beam for each obsid
+    """
+    if obsid_array is None:
+        obsid_array = get_obsid_array(startdate=startdate, enddate=enddate)
+    inventory = scan_inventory(obsid_array, mode=mode, state=state,
+                               categories=categories)
+
+    return inventory
+
+
+def iter_inventory_beams(startdate=None, enddate=None, mode='happili-01',
+                         inventory=None, state=None, categories=None,
+                         beams=None, obsid_array=None):
+    """
+    Iterate over the inventory of every obsid / beam
+
+    Uses a given inventory, or otherwise scans beams
+    one at a time as they are consumed
+
+    Parameters
+    ----------
+    startdate : str (optional)
+         Optional startdate in YYMMDD format
+    enddate : str (optional)
+         Optional enddate in YYMMDD format
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned as needed if not given
+    state : sqlite3.Connection (optional)
+        Cleanup state index, used when scanning
+    categories : list (str) (optional)
+        Cleanup categories of this run, used with state
+    beams : list (int) (optional)
+        Only scan these beams; default is all beams
+    obsid_array : array (optional)
+        Obsids from get_obsid_array, e.g. for several date ranges;
+        found from startdate and enddate if not given
+
+    Returns
+    -------
+    beam_inv : iterator of dict
+        Inventory of each beam, in obsid and beam order
+    """
+    if inventory is not None:
+        return iter_beams(inventory)
+    if obsid_array is None:
+        obsid_array = get_obsid_array(startdate=startdate, enddate=enddate)
+
+    return iter_inventory(obsid_array, mode=mode, state=state,
+                          categories=categories, beams=beams)
+
+
+def get_beam_cal_vis(beam_inv):
+    """
+    Get calibrator visibilities for a single beam
+
+    Parameters
+    ----------
+    beam_inv : dict
+        Inventory of the beam, from get_inventory
+
+    Returns
+    -------
+    beam_cal_list : list
+         List of calibrator visibilities, in sorted order
+    """
+    beam_cal_list = [os.path.join(beam_inv['path'], 'raw', name)
+                     for name in match_names(beam_inv['raw'], '3C*MS')]
+
+    return beam_cal_list
+
+
+def get_cal_vis(startdate=None, enddate=None, mode='happili-01',
+                inventory=None):
     """
     Get calibrator visibilities
 
@@ -135,6 +340,8 @@ def get_cal_vis(startdate=None, enddate=None, mode='happili-01'):
     mode : string
         Running mode - happili-01 or happili-05
         Default is happili-01
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned beam by beam if not given
 
     Returns
     -------
@@ -142,32 +349,18 @@ def get_cal_vis(startdate=None, enddate=None, mode='happili-01'):
          List of all calibrator visibilities in date range
     """
 
-    # first get obsid array
-    obsid_array = get_obsid_array(startdate=startdate, enddate=enddate)
-
-    # then get initial path for each beam / obsid combination
-    obs_beam_dir_list = []
-    for obsid in obsid_array:
-        for b in range(40):
-            obdir = get_obsid_beam_dir(obsid, b, mode=mode)
-            if os.path.isdir(obdir):
-                obs_beam_dir_list.append(obdir)
-
-    # then need to find selfcal directories
-    cal_vis_list = []
-    for beamdir in obs_beam_dir_list:
-        beam_cal_list = glob.glob(
-            os.path.join(beamdir, "raw/3C*MS"))
-        # need to sort into order
-        beam_cal_list.sort()
-        # and add to list
-        cal_vis_list = cal_vis_list + beam_cal_list
+    # find the calibrator visibilities for each beam
+    cal_vis_list = [item.path for item in
+                    iter_work_items(startdate=startdate, enddate=enddate,
+                                    mode=mode, inventory=inventory,
+                                    categories=['cal_vis'])]
 
     return cal_vis_list
 
 
 def delete_cal_vis(startdate=None, enddate=None, mode='happili-01',
-                   run=False, verbose=True):
+                   run=False, verbose=True, inventory=None,
+                   workers=DEFAULT_WORKERS, mount_workers=None):
     """
     Delete calibrator visibilities
 
@@ -192,31 +385,62 @@ def delete_cal_vis(startdate=None, enddate=None, mode='happili-01',
     verbose : Boolean
         Print a record of what is (to be) deleted?
         Default is True
-    """
-    # first get directories for deletion
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned beam by beam if not given
+    workers : int
+        Number of parallel deletions per device
+        Default is DEFAULT_WORKERS
+    mount_workers : dict (optional)
+        Number of parallel deletions for specific mounts
 
-    cal_vis_list = get_cal_vis(startdate=startdate, enddate=enddate, mode=mode)
+    Returns
+    -------
+    result_list : list of DeleteResult
+        Outcome for each deletion
+    """
+    # stream directories for deletion, beam by beam
+    item_iter = iter_work_items(startdate=startdate, enddate=enddate,
+                                mode=mode, inventory=inventory,
+                                categories=['cal_vis'])
 
-    # then iterate through each directory
+    # then delete as they come, in parallel over devices
     # print statement and delete, as set by flags
-    for cvis in cal_vis_list:
-        if run is True:
-            # do a try/except
-            # because may not have permission to delete data
-            try:
-                shutil.rmtree(cvis)
-                if verbose is True:
-                    print('Deleting {}'.format(cvis))
-            except:
-                if verbose is True:
-                    print('Unable to delete {}'.format(cvis))
-        else:
-            if verbose is True:
-                print('Practice run only; deleting {}'.format(cvis))
+    result_list = [result for item, result in
+                   execute_work_items(item_iter, run=run, verbose=verbose,
+                                      workers=workers,
+                                      mount_workers=mount_workers)]
+
+    return result_list
+
+
+def get_beam_scal_intermediate_dirs(beam_inv):
+    """
+    Get the intermediate selfcal directories for a single beam
+
+    Everything in selfcal/00-0N, where N is the second to last
+    major cycle of selfcal
+
+    Parameters
+    ----------
+    beam_inv : dict
+        Inventory of the beam, from get_inventory
+
+    Returns
+    -------
+    beam_scal_list : list
+         List of intermediate selfcal directories, in sorted order
+    """
+    major_selfcal_list = match_names(beam_inv['selfcal'], '0[0-9]')
+    # updating to only keep last directory,
+    # so list needs to be at least two elements long
+    beam_scal_list = [os.path.join(beam_inv['path'], 'selfcal', name)
+                      for name in major_selfcal_list[0:-1]]
+
+    return beam_scal_list
 
 
 def get_scal_intermediate_dirs(startdate=None, enddate=None,
-                               mode='happili-01'):
+                               mode='happili-01', inventory=None):
     """
     Get the intermediate selfcal directories
 
@@ -237,6 +461,8 @@ def get_scal_intermediate_dirs(startdate=None, enddate=None,
     mode : string
         Running mode - happili-01 or happili-05
         Default is happili-01
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned beam by beam if not given
 
     Returns
     -------
@@ -244,33 +470,11 @@ def get_scal_intermediate_dirs(startdate=None, enddate=None,
          List of all intermediate selfcal directories in date range
     """
 
-    # first get obsid array
-    obsid_array = get_obsid_array(startdate=startdate, enddate=enddate)
-
-    # then get initial path for each beam / obsid combination
-    obs_beam_dir_list = []
-    for obsid in obsid_array:
-        for b in range(40):
-            obdir = get_obsid_beam_dir(obsid,b,mode=mode)
-            if os.path.isdir(obdir):
-                obs_beam_dir_list.append(obdir)
-
-    # then need to find selfcal directories
-    selfcal_dir_list = []
-    for beamdir in obs_beam_dir_list:
-        major_selfcal_list = glob.glob(
-            os.path.join(beamdir, "selfcal/0[0-9]"))
-        # need to sort into order
-        major_selfcal_list.sort()
-        # check length of list
-        # updating to only keep last directory,
-        # so list needs to be at least two elements long
-        if len(major_selfcal_list) > 1:
-            # slice out everything except last element
-            intermediate_selfcal_list = major_selfcal_list[0:-1]
-            # append to list, but avoid nesting
-            for scdir in intermediate_selfcal_list:
-                selfcal_dir_list.append(scdir)
+    # find selfcal directories for each beam
+    selfcal_dir_list = [item.path for item in
+                        iter_work_items(startdate=startdate, enddate=enddate,
+                                        mode=mode, inventory=inventory,
+                                        categories=['scal_inter'])]
 
     return selfcal_dir_list
 
@@ -278,7 +482,10 @@ def get_scal_intermediate_dirs(startdate=None, enddate=None,
 def delete_intermediate_scal_dirs(startdate=None, enddate=None,
                                   mode='happili-01',
                                   run=False,
-                                  verbose=True):
+                                  verbose=True,
+                                  inventory=None,
+                                  workers=DEFAULT_WORKERS,
+                                  mount_workers=None):
     """
     Delete the intermediate selfcal directories
 
@@ -309,33 +516,98 @@ def delete_intermediate_scal_dirs(startdate=None, enddate=None,
     verbose : Boolean
         Print a record of what is (to be) deleted?
         Default is True
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned beam by beam if not given
+    workers : int
+        Number of parallel deletions per device
+        Default is DEFAULT_WORKERS
+    mount_workers : dict (optional)
+        Number of parallel deletions for specific mounts
+
+    Returns
+    -------
+    result_list : list of DeleteResult
+        Outcome for each deletion
     """
-    # first get directories for deletion
-    
-    scal_dir_list = get_scal_intermediate_dirs(startdate=startdate,
-                                               enddate=enddate,
-                                               mode=mode)
+    # stream directories for deletion, beam by beam
+    item_iter = iter_work_items(startdate=startdate, enddate=enddate,
+                                mode=mode, inventory=inventory,
+                                categories=['scal_inter'])
 
-    # then iterate through each directory
+    # then delete as they come, in parallel over devices
     # print statement and delete, as set by flags
-    for scdir in scal_dir_list:
-        if run is True:
-            # do a try/except
-            # because may not have permission to delete data
-            try:
-                shutil.rmtree(scdir)
-                if verbose is True:
-                    print('Deleting {}'.format(scdir))
-            except:
-                if verbose is True:
-                    print('Unable to delete {}'.format(scdir))
+    result_list = [result for item, result in
+                   execute_work_items(item_iter, run=run, verbose=verbose,
+                                      workers=workers,
+                                      mount_workers=mount_workers)]
+
+    return result_list
+
+
+def get_beam_final_scal(beam_inv):
+    """
+    Get the final selfcal cleanup for a single beam
+
+    This is the parametric directory (pm) to delete,
+    plus for the last major cycle and the amp cycle
+    the last model to gztar and the contents to then delete.
+    Whether or not this has been run is roughly checked
+    based on presence of the pm directory
+
+    Parameters
+    ----------
+    beam_inv : dict
+        Inventory of the beam, from get_inventory
+
+    Returns
+    -------
+    final_scal : dict or None
+        'pm' directory, and 'cycles' as a list of
+        (label, last model or None, list of contents).
+        None if the pm directory was already removed
+    """
+    selfcal = beam_inv['selfcal']
+    if 'pm' not in selfcal or not selfcal['pm'].is_dir:
+        return None
+    scaldir = os.path.join(beam_inv['path'], 'selfcal')
+    final_scal = {'pm': os.path.join(scaldir, 'pm'),
+                  'cycles': []}
+    # then do last major cycle
+    major_selfcal_list = match_names(selfcal, '0[0-9]')
+    # and check that directories exist (could fail after pm)
+    if len(major_selfcal_list) >= 1:
+        last_scal = os.path.join(scaldir, major_selfcal_list[-1])
+        last_scal_inv = beam_inv['selfcal_last']
+        major_models = match_names(last_scal_inv, 'model_*')
+        # check for case that cycle started but no model produced
+        if len(major_models) >= 1:
+            last_model = os.path.join(last_scal, major_models[-1])
+        else:
+            last_model = None
+        last_scal_contents = [os.path.join(last_scal, name)
+                              for name in match_names(last_scal_inv, '*')]
+        final_scal['cycles'].append(('phase', last_model, last_scal_contents))
+    # then amplitude
+    amp_scal_inv = beam_inv['selfcal_amp']
+    if amp_scal_inv is not None:
+        amp_scal = os.path.join(scaldir, 'amp')
+        amp_models = match_names(amp_scal_inv, 'model_*')
+        if len(amp_models) >= 1:
+            last_amp_model = os.path.join(amp_scal, amp_models[-1])
         else:
-            if verbose is True:
-                print('Practice run only; deleting {}'.format(scdir))
+            last_amp_model = None
+        last_amp_contents = [os.path.join(amp_scal, name)
+                             for name in match_names(amp_scal_inv, '*')]
+        final_scal['cycles'].append(('amp', last_amp_model, last_amp_contents))
+
+    return final_scal
 
 
 def final_scal_cleanup(startdate=None, enddate=None,
-                       mode='happili-01', run=False, verbose=True):
+                       mode='happili-01', run=False, verbose=True,
+                       inventory=None, workers=DEFAULT_WORKERS,
+                       mount_workers=None, archive_workers=None,
+                       archive_format=DEFAULT_FORMAT):
     """
     Do final selfcal cleanup. This is keeping last model in last major cycle and amp cycle
     Plus removing the paramteric directory (pm)
@@ -355,112 +627,141 @@ def final_scal_cleanup(startdate=None, enddate=None,
     verbose : Boolean
         Print a record of what is (to be) deleted?
         Default is True
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned beam by beam if not given
+    workers : int
+        Number of parallel deletions per device
+        Default is DEFAULT_WORKERS
+    mount_workers : dict (optional)
+        Number of parallel deletions for specific mounts
+    archive_workers : int (optional)
+        Number of parallel archiving workers; default is one per core
+    archive_format : str
+        Archive format (see modules.archive), default is gztar
+
+    Returns
+    -------
+    result_list : list of ArchiveResult and DeleteResult
+        Outcome for each archive and deletion
     """
-    # first get obsid array
-    obsid_array = get_obsid_array(startdate=startdate, enddate=enddate)
-    # then get initial path for each beam / obsid combination
-    obs_beam_dir_list = []
-    for obsid in obsid_array:
-        for b in range(40):
-            obdir = get_obsid_beam_dir(obsid, b, mode=mode)
-            # test if beam exists before appending it
-            if os.path.isdir(obdir):
-                obs_beam_dir_list.append(obdir)
-    # now iterate through
-    for beamdir in obs_beam_dir_list:
-        # roughly check whether or not I hve run this based on presence of pm dir
-        # skip if already run
-        pm_scal = os.path.join(beamdir, "selfcal/pm")
-        if os.path.isdir(pm_scal):
-            # first delete parametric; easiest
-            if run is True:
-                try:
-                    shutil.rmtree(pm_scal)
-                    if verbose is True:
-                        print('Deleting {}'.format(pm_scal))
-                except:
-                    if verbose is True:
-                        print('Unable to delete {}'.format(pm_scal))
-            else:
+    # stream the pm directory, last models and cycle contents, beam by beam
+    # contents are only cleaned up if the model was archived
+    def item_iter():
+        for beam_inv in iter_inventory_beams(startdate=startdate, enddate=enddate,
+                                             mode=mode, inventory=inventory):
+            item_list = get_beam_work_items(beam_inv, categories=['scal_final'])
+            # skip if already run
+            if len(item_list) == 0:
                 if verbose is True:
-                    print('Practice run only; deleting {}'.format(pm_scal))
-            # then do last major cycle
-            major_selfcal_list = glob.glob(
-                os.path.join(beamdir, "selfcal/0[0-9]"))
-            # need to sort into order
-            major_selfcal_list.sort()
-            # and check that directories exist (could fail after pm)
-            if len(major_selfcal_list) >= 1:
-                last_scal = major_selfcal_list[-1]
-                major_models = glob.glob(os.path.join(last_scal, 'model_*'))
-                major_models.sort()
-                # check for case that cycle started but no model produced
-                if len(major_models) >= 1:
-                    last_model = major_models[-1]
-                else:
-                    last_model = None
-                last_scal_contents = glob.glob(last_scal + "/*")
-                if run is True:
-                    try:
-                        # gztar phse model
-                        if last_model is not None:
-                            shutil.make_archive(last_model, 'gztar', last_model)
-                            if verbose is True:
-                                print('gztar last phase selfcal model, {}'.format(last_model))
-                        # then clean up
-                        for scdir in last_scal_contents:
-                            try:
-                                shutil.rmtree(scdir)
-                                if verbose is True:
-                                    print('Deleting {}'.format(scdir))
-                            except:
-                                if verbose is True:
-                                    print('Unable to delete {}'.format(scdir))
-                    except:
-                        if verbose is True:
-                            print('Unable to gztar last phase selfcal model, {}'.format(last_model))
-                else:
-                    if verbose is True:
-                        if last_model is not None:
-                            print('Practice run only; gztar last phase selfcal model, {}'.format(last_model))
-                        for scdir in last_scal_contents:
-                            print('Practice run only; deleting {}'.format(scdir))
-            # then amplitude
-            amp_scal = os.path.join(beamdir, "selfcal/amp")
-            if os.path.isdir(amp_scal):
-                amp_models = glob.glob(os.path.join(amp_scal, 'model_*'))
-                amp_models.sort()
-                last_amp_model = amp_models[-1]
-                last_amp_contents = glob.glob(amp_scal+"/*")
-                if run is True:
-                    try:
-                        # gztar amp
-                        shutil.make_archive(last_amp_model, 'gztar', last_amp_model)
-                        if verbose is True:
-                            print('gztar last amp selfcal model, {}'.format(last_amp_model))
-                        # then clean up
-                        for scdir in last_amp_contents:
-                            try:
-                                shutil.rmtree(scdir)
-                                if verbose is True:
-                                    print('Deleting {}'.format(scdir))
-                            except:
-                                if verbose is True:
-                                    print('Unable to delete {}'.format(scdir))
-                    except:
-                        if verbose is True:
-                            print('Unable to gztar last amp selfcal model, {}'.format(last_amp_model))
-                else:
-                    print('Practice run only; gztar last amp selfcal model, {}'.format(last_amp_model))
-                    for scdir in last_amp_contents:
-                        print('Practice run only; deleting {}'.format(scdir))
-        else:
-            if verbose is True:
-                print('Parametric selfcal directory already removed; skipping cleanup for {}'.format(beamdir))
+                    print('Parametric selfcal directory already removed; skipping cleanup for {}'.format(beam_inv['path']))
+            for item in item_list:
+                yield item
+
+    result_list = [result for item, result in
+                   execute_work_items(item_iter(), run=run, verbose=verbose,
+                                      workers=workers,
+                                      mount_workers=mount_workers,
+                                      archive_workers=archive_workers,
+                                      archive_format=archive_format)]
+
+    return result_list
+
+
+# classes of continuum directory entries, with the glob pattern of each;
+# the patterns have distinct prefixes, so every name is in at most one class
+CONTINUUM_CLASSES = [('beam', 'beam*_0[0-9]'),
+                     ('map', 'map*_0[0-9]'),
+                     ('image', 'image_*_0[0-9]'),
+                     ('fits', 'image_*fits'),
+                     ('mask', 'mask_*_0[0-9]'),
+                     ('model', 'model_*_0[0-9]'),
+                     ('residual', 'residual_*_0[0-9]')]
+_continuum_pattern = re.compile('|'.join(
+    '(?P<{0}>{1})'.format(label, fnmatch.translate(pattern))
+    for label, pattern in CONTINUUM_CLASSES))
+_fits_pattern = re.compile('image_(.+?).fits')
+
+
+def classify_continuum(continuum):
+    """
+    Sort the entries of a continuum directory listing into classes
+
+    A single pass over the listing with one compiled pattern,
+    rather than a glob per class
+
+    Parameters
+    ----------
+    continuum : dict
+        Listing of the continuum directory, from scan_directory
+
+    Returns
+    -------
+    classes : dict
+        Set of names for each label in CONTINUUM_CLASSES
+    """
+    classes = dict((label, set()) for label, pattern in CONTINUUM_CLASSES)
+    for name in continuum:
+        m = _continuum_pattern.match(name)
+        if m is not None:
+            classes[m.lastgroup].add(name)
+
+    return classes
+
+
+def get_beam_continuum_intermediates(beam_inv):
+    """
+    Get the intermediate continuum files for a single beam
+
+    For every saved fits image (mf plus chunks), the matching mask and
+    model are compressed and the residual is kept; all other
+    masks, models and residuals, and all dirty beams, maps and
+    non-fits images are deleted
+
+    Parameters
+    ----------
+    beam_inv : dict
+        Inventory of the beam, from get_inventory
+
+    Returns
+    -------
+    zip_list : list (str)
+        List of files to be compressed
+    del_list : list (str)
+        List of files to be deleted
+    """
+    continuum = beam_inv['continuum']
+    contdir = os.path.join(beam_inv['path'], 'continuum')
+    classes = classify_continuum(continuum)
+    # Find NN to save, from the saved fits images
+    mask_zip_list = []
+    model_zip_list = []
+    residual_keep = set()
+    for image in sorted(classes['fits']):
+        pattern = _fits_pattern.search(image).group(1)
+        # make sure they exist, as directories
+        mask = "mask_{}".format(pattern)
+        model = "model_{}".format(pattern)
+        residual = "residual_{}".format(pattern)
+        if mask in continuum and continuum[mask].is_dir: mask_zip_list.append(mask)
+        if model in continuum and continuum[model].is_dir: model_zip_list.append(model)
+        if residual in continuum and continuum[residual].is_dir: residual_keep.add(residual)
+    # everything else of these classes is deleted
+    del_names = (sorted(classes['mask'] - set(mask_zip_list)) +
+                 sorted(classes['model'] - set(model_zip_list)) +
+                 sorted(classes['residual'] - residual_keep) +
+                 sorted(classes['beam']) + sorted(classes['map']) +
+                 sorted(classes['image']))
+
+    # join everything w/ zip & delete list
+    zip_list = [os.path.join(contdir, name)
+                for name in mask_zip_list + model_zip_list]
+    del_list = [os.path.join(contdir, name) for name in del_names]
+
+    return zip_list, del_list
 
 
 def get_continuum_intermediates(startdate=None, enddate=None,
-                                mode='happili-01'):
+                                mode='happili-01', inventory=None):
     """
     Get the intermediate continuum files
 
@@ -485,6 +786,8 @@ def get_continuum_intermediates(startdate=None, enddate=None,
     mode : string
         Running mode - happili-01 or happili-05
         Default is happili-01
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned beam by beam if not given
 
     Returns
     -------
@@ -494,70 +797,15 @@ def get_continuum_intermediates(startdate=None, enddate=None,
         List of files to be deleted
     """
 
-    # first get obsid array
-    obsid_array = get_obsid_array(startdate=startdate, enddate=enddate)
-
-    # then get initial path for each beam / obsid combination
-    obs_beam_dir_list = []
-    for obsid in obsid_array:
-        for b in range(40):
-            obdir = get_obsid_beam_dir(obsid, b, mode=mode)
-            if os.path.isdir(obdir):
-                obs_beam_dir_list.append(obdir)
-
     del_list = []
     zip_list = []
-    for beamdir in obs_beam_dir_list:
-        # print(beamdir)
-        # get all dirty beams
-        beam_list = glob.glob(os.path.join(beamdir, "continuum/beam*_0[0-9]"))
-        # get all first dirty images (maps)
-        map_list = glob.glob(os.path.join(beamdir, "continuum/map*_0[0-9]"))
-        # get images that aren't fits
-        image_list = glob.glob(os.path.join(beamdir, "continuum/image_*_0[0-9]"))
-        # Find NN to save; this if for mf plus chunks
-        # do this by looking at the saved fits images
-        fits_image_list = glob.glob(os.path.join(beamdir, "continuum/image_*fits"))
-        fits_image_list.sort()
-        # now iterate through patterns for each saved image
-        # setup lists to hold things
-        model_zip_list = []
-        mask_zip_list = []
-        residual_keep_list = []
-        for image in fits_image_list:
-            pattern = re.search('image_(.+?).fits', image).group(1)
-            # now add the relevant things with that pattern to the right lists
-            # make sure they exist first
-            mask = os.path.join(beamdir, "continuum/mask_{}".format(pattern))
-            model = os.path.join(beamdir, "continuum/model_{}".format(pattern))
-            residual = os.path.join(beamdir, "continuum/residual_{}".format(pattern))
-            if os.path.isdir(mask): mask_zip_list.append(mask)
-            if os.path.isdir(model): model_zip_list.append(model)
-            if os.path.isdir(residual): residual_keep_list.append(residual)
-        # Find all models, masks and residuals which are not in zip/keep list
-        # Do this by listing all and then checking against zip_list and keep_list
-        # start with models
-        model_del_list = glob.glob(os.path.join(beamdir, "continuum/model_*_0[0-9]"))
-        model_del_list.sort()
-        for model in model_zip_list:
-            if model in model_del_list:
-                model_del_list.remove(model)
-        # now masks
-        mask_del_list = glob.glob(os.path.join(beamdir, "continuum/mask_*_0[0-9]"))
-        mask_del_list.sort()
-        for mask in mask_zip_list:
-            if mask in mask_del_list:
-                mask_del_list.remove(mask)
-        # now residuals
-        residual_del_list = glob.glob(os.path.join(beamdir, "continuum/residual_*_0[0-9]"))
-        residual_del_list.sort()
-        for residual in residual_keep_list:
-            if residual in residual_del_list:
-                residual_del_list.remove(residual)
-
-        # join everything w/ zip & delete list
-        zip_list = zip_list + mask_zip_list + model_zip_list
-        del_list = del_list + mask_del_list + model_del_list + residual_del_list + beam_list + map_list + image_list
+    for item in iter_work_items(startdate=startdate, enddate=enddate,
+                                mode=mode, inventory=inventory,
+                                categories=['cont_inter']):
+        if item.action == 'archive':
+            zip_list.append(item.path)
+        elif item.requires is None:
+            del_list.append(item.path)
 
     return zip_list, del_list
 
@@ -565,7 +813,12 @@ def get_continuum_intermediates(startdate=None, enddate=None,
 def cleanup_continuum_intermediates(startdate=None, enddate=None,
                                     mode='happili-01',
                                     run=False,
-                                    verbose=True):
+                                    verbose=True,
+                                    inventory=None,
+                                    workers=DEFAULT_WORKERS,
+                                    mount_workers=None,
+                                    archive_workers=None,
+                                    archive_format=DEFAULT_FORMAT):
     """
     Cleanup intermediate continuum files :: Copied from delete_intermediate_scal_dirs
 
@@ -596,54 +849,163 @@ def cleanup_continuum_intermediates(startdate=None, enddate=None,
     verbose : Boolean
         Print a record of what is (to be) deleted?
         Default is True
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned beam by beam if not given
+    workers : int
+        Number of parallel deletions per device
+        Default is DEFAULT_WORKERS
+    mount_workers : dict (optional)
+        Number of parallel deletions for specific mounts
+    archive_workers : int (optional)
+        Number of parallel archiving workers; default is one per core
+    archive_format : str
+        Archive format (see modules.archive), default is gztar
+
+    Returns
+    -------
+    result_list : list of ArchiveResult and DeleteResult
+        Outcome for each archive and deletion
     """
-    # first get files for deletion and zipping, plus writing to fits
-    zip_list, del_list = get_continuum_intermediates(startdate=startdate, enddate=enddate, mode=mode)
+    # stream files for deletion and zipping, beam by beam
+    item_iter = iter_work_items(startdate=startdate, enddate=enddate,
+                                mode=mode, inventory=inventory,
+                                categories=['cont_inter'])
 
-    # then iterate through each list
-    # start with zip and fits, to avoid accidental deletion
-    # but also clean those up as you go
+    # zip the directories to keep, and clean up the originals
+    # only once they are zipped; delete everything else as it comes
     # print statement and delete, as set by flags
-    # zip the directories to keep
-    for contdir in zip_list:
-        if run is True:
-            # do a try/except
-            # because of permission issues on happili
-            try:
-                shutil.make_archive(contdir, 'gztar', contdir)
-                if verbose is True:
-                    print('gztar for {}'.format(contdir))
-            except:
-                if verbose is True:
-                    print('Unable to gztar file {}'.format(contdir))
-            # then clean up files if they are zipped/tarred
-            if os.path.exists(contdir+'.tar.gz'):
-                try:
-                    shutil.rmtree(contdir)
-                    print('gztar file exists, clean up original directory {}'.format(contdir))
-                except:
-                    if verbose is True:
-                        print('gztar file exists but unable to clean up original directory {}'.format(contdir))
-        else:
-            if verbose is True:
-                print('practice run only; gztar and then try to clean up {}'.format(contdir))
-    for contdir in del_list:
-        if run is True:
-            # do a try/except
-            # because may not have permission to delete data
-            try:
-                shutil.rmtree(contdir)
-                if verbose is True:
-                    print('Deleting {}'.format(contdir))
-            except:
-                if verbose is True:
-                    print('Unable to delete {}'.format(contdir))
-        else:
-            if verbose is True:
-                print('Practice run only; deleting {}'.format(contdir))
+    result_list = [result for item, result in
+                   execute_work_items(item_iter, run=run, verbose=verbose,
+                                      workers=workers,
+                                      mount_workers=mount_workers,
+                                      archive_workers=archive_workers,
+                                      archive_format=archive_format)]
 
+    return result_list
 
 
+def get_beam_work_items(beam_inv, categories=None, admin_list=None):
+    """
+    Get all cleanup work items for a single beam
+
+    Directories to keep are archived (gztar), and the original is then
+    deleted by an item that requires the archive. For the final selfcal
+    cleanup, the cycle contents all require the last model archive.
+    Targets that the scanned permissions show would fail are left out
+    (see modules.preflight).
 
+    Parameters
+    ----------
+    beam_inv : dict
+        Inventory of the beam, from get_inventory
+    categories : list (str) (optional)
+        Cleanup categories (scal_inter, scal_final, cont_inter, cal_vis)
+        Default is all categories
+    admin_list : list (optional)
+        Targets left out are appended as AdminTarget
 
+    Returns
+    -------
+    item_list : list of WorkItem
+        Work items for the beam, in order
+    """
+    if categories is None:
+        categories = ['scal_inter', 'scal_final', 'cont_inter', 'cal_vis']
+    obsid = beam_inv['obsid']
+    beam = beam_inv['beam']
+    item_list = []
+    if 'scal_inter' in categories:
+        for scdir in get_beam_scal_intermediate_dirs(beam_inv):
+            item_list.append(WorkItem(obsid, beam, 'scal_inter', 'delete', scdir, None))
+    if 'scal_final' in categories:
+        final_scal = get_beam_final_scal(beam_inv)
+        if final_scal is not None:
+            item_list.append(WorkItem(obsid, beam, 'scal_final', 'delete',
+                                      final_scal['pm'], None))
+            for label, last_model, last_contents in final_scal['cycles']:
+                if last_model is not None:
+                    item_list.append(WorkItem(obsid, beam, 'scal_final', 'archive',
+                                              last_model, None))
+                for scdir in last_contents:
+                    item_list.append(WorkItem(obsid, beam, 'scal_final', 'delete',
+                                              scdir, last_model))
+    if 'cont_inter' in categories:
+        zip_list, del_list = get_beam_continuum_intermediates(beam_inv)
+        for contdir in zip_list:
+            item_list.append(WorkItem(obsid, beam, 'cont_inter', 'archive', contdir, None))
+            item_list.append(WorkItem(obsid, beam, 'cont_inter', 'delete', contdir, contdir))
+        for contdir in del_list:
+            item_list.append(WorkItem(obsid, beam, 'cont_inter', 'delete', contdir, None))
+    if 'cal_vis' in categories:
+        for cvis in get_beam_cal_vis(beam_inv):
+            item_list.append(WorkItem(obsid, beam, 'cal_vis', 'delete', cvis, None))
+    item_list, held_list = check_work_items(beam_inv, item_list)
+    if admin_list is not None:
+        admin_list.extend(held_list)
+
+    return item_list
+
+
+def iter_work_items(startdate=None, enddate=None, mode='happili-01',
+                    inventory=None, categories=None, state=None,
+                    beam_list=None, beams=None, obsid_array=None, manifest=None,
+                    admin_list=None):
+    """
+    Stream cleanup work items, beam by beam
+
+    Without an inventory, beams are scanned as the items are consumed,
+    so work on the first obsid can start straight away
+
+    Parameters
+    ----------
+    startdate : str (optional)
+         Optional startdate in YYMMDD format
+    enddate : str (optional)
+         Optional enddate in YYMMDD format
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    inventory : OrderedDict (optional)
+        Inventory from get_inventory; scanned beam by beam if not given
+    categories : list (str) (optional)
+        Cleanup categories; default is all categories
+    state : sqlite3.Connection (optional)
+        Cleanup state index, used when scanning
+    beam_list : list (optional)
+        Each beam is appended as (obsid, beam, path) when it is planned
+    beams : list (int) (optional)
+        Only scan these beams; default is all beams
+    obsid_array : array (optional)
+        Obsids from get_obsid_array, e.g. for several date ranges;
+        found from startdate and enddate if not given
+    manifest : Manifest (optional)
+        Manifests (modules.manifest); obsids it does not allow are not
+        scanned, and its policies limit the categories of an obsid
+    admin_list : list (optional)
+        Targets that need an admin are appended as AdminTarget
 
+    Returns
+    -------
+    item : iterator of WorkItem
+        Work items, in obsid and beam order
+    """
+    if obsid_array is None and inventory is None:
+        obsid_array = get_obsid_array(startdate=startdate, enddate=enddate,
+                                      manifest=manifest)
+    for beam_inv in iter_inventory_beams(startdate=startdate, enddate=enddate,
+                                         mode=mode, inventory=inventory,
+                                         state=state, categories=categories,
+                                         beams=beams, obsid_array=obsid_array):
+        if beam_list is not None:
+            beam_list.append((beam_inv['obsid'], beam_inv['beam'], beam_inv['path']))
+        start = time.time()
+        beam_categories = categories
+        if manifest is not None:
+            beam_categories = manifest.get_categories(
+                beam_inv['obsid'], categories or list(CATEGORY_SUBDIRS))
+        item_list = get_beam_work_items(beam_inv, categories=beam_categories,
+                                        admin_list=admin_list)
+        record_phase('plan', start, time.time(), items=len(item_list),
+                     mount=get_path_mount(beam_inv['path']))
+        for item in item_list:
+            yield item
@@ -0,0 +1,268 @@
+#Inventory of the apertif data on happili
+
+from __future__ import print_function
+
+"""
+Inventory of the apertif data on happili
+
+Every obsid / beam is walked once with os.scandir,
+recording the contents of the selfcal, continuum and raw directories.
+The cleanup passes then plan from this inventory
+rather than probing and globbing the filesystem again.
+
+The owner and mode of every entry (from lstat) and of the listed
+directories themselves are kept, so permission problems can be found
+before anything is attempted (see modules.preflight).
+
+The inventory reflects the filesystem at the time of the scan.
+"""
+
+import os
+import fnmatch
+import time
+from collections import namedtuple, OrderedDict
+from modules.paths import get_mode_roots
+from modules.state import get_clean_subdirs, CATEGORY_SUBDIRS
+from modules.metrics import record_phase, get_path_mount
+
+# a single directory entry as seen during the scan;
+# uid, gid and mode from lstat, None if unknown
+Entry = namedtuple('Entry', ['name', 'is_dir', 'uid', 'gid', 'mode'],
+                   defaults=(None, None, None))
+
+
+def scan_directory(path):
+    """
+    List a directory once with os.scandir
+
+    Parameters
+    ----------
+    path : str
+        Directory to list
+
+    Returns
+    -------
+    listing : dict
+        Entry for each name in the directory, with its lstat owner and mode.
+        Empty if the directory does not exist or cannot be read
+    """
+    listing = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                    listing[entry.name] = Entry(entry.name, is_dir, st.st_uid,
+                                                st.st_gid, st.st_mode)
+                except OSError:
+                    listing[entry.name] = Entry(entry.name, is_dir)
+    except OSError:
+        pass
+
+    return listing
+
+
+def match_names(listing, pattern):
+    """
+    Find names in a listing matching a glob pattern
+
+    Follows glob.glob, so hidden names only match hidden patterns
+
+    Parameters
+    ----------
+    listing : dict
+        Directory listing from scan_directory
+    pattern : str
+        Glob pattern for a single path component
+
+    Returns
+    -------
+    name_list : list (str)
+        Sorted list of matching names
+    """
+    name_list = [name for name in listing
+                 if fnmatch.fnmatchcase(name, pattern)]
+    if not pattern.startswith('.'):
+        name_list = [name for name in name_list if not name.startswith('.')]
+    name_list.sort()
+
+    return name_list
+
+
+def scan_beam(obsid, beam, beamdir, skip_subdirs=None):
+    """
+    Scan a single obsid / beam directory
+
+    The selfcal, continuum and raw directories are listed.
+    If the parametric selfcal directory (pm) is still present,
+    the last major selfcal cycle and the amp cycle are also listed,
+    as these are needed for the final selfcal cleanup.
+
+    Parameters
+    ----------
+    obsid : str
+        Obsid provided as a string
+    beam : int
+        beam provided as an int
+    beamdir : str
+        path to obsid / beam
+    skip_subdirs : set (str) (optional)
+        Subdirectories known to be clean, which are not listed
+
+    Returns
+    -------
+    beam_inv : dict
+        Inventory of the beam
+    """
+    if skip_subdirs is None:
+        skip_subdirs = set()
+    listings = {}
+    dirs = {}
+    for subdir in ['selfcal', 'continuum', 'raw']:
+        if subdir in skip_subdirs:
+            listings[subdir] = {}
+        else:
+            listings[subdir] = scan_directory(os.path.join(beamdir, subdir))
+            try:
+                st = os.lstat(os.path.join(beamdir, subdir))
+                dirs[subdir] = Entry(subdir, True, st.st_uid, st.st_gid, st.st_mode)
+            except OSError:
+                pass
+    selfcal = listings['selfcal']
+    beam_inv = {'obsid': obsid,
+                'beam': beam,
+                'path': beamdir,
+                'selfcal': selfcal,
+                'continuum': listings['continuum'],
+                'raw': listings['raw'],
+                'selfcal_last': None,
+                'selfcal_amp': None,
+                'dirs': dirs,
+                'skipped': skip_subdirs}
+    if 'pm' in selfcal and selfcal['pm'].is_dir:
+        major_selfcal_list = match_names(selfcal, '0[0-9]')
+        if len(major_selfcal_list) >= 1:
+            beam_inv['selfcal_last'] = scan_directory(
+                os.path.join(beamdir, 'selfcal', major_selfcal_list[-1]))
+        if 'amp' in selfcal and selfcal['amp'].is_dir:
+            beam_inv['selfcal_amp'] = scan_directory(
+                os.path.join(beamdir, 'selfcal', 'amp'))
+
+    return beam_inv
+
+
+def iter_inventory(obsid_array, mode='happili-01', state=None,
+                   categories=None, beams=None):
+    """
+    Scan all beams of a set of obsids, one beam at a time
+
+    Rather than probing each of the 40 possible beam directories,
+    the obsid directory on each data root is listed once.
+    Beams are scanned as they are consumed, so cleanup of the first
+    beams can start before later obsids are scanned.
+
+    Parameters
+    ----------
+    obsid_array : array
+        Array of obsids as strings
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    state : sqlite3.Connection (optional)
+        Cleanup state index; beam directories that were cleaned
+        and are unchanged since are not listed
+    categories : list (str) (optional)
+        Cleanup categories of this run, used with state.
+        Default is all categories
+    beams : list (int) (optional)
+        Only scan these beams; default is all beams
+
+    Returns
+    -------
+    beam_inv : iterator of dict
+        Inventory of each beam, in obsid and beam order
+    """
+    root_list = get_mode_roots(mode=mode)
+    if categories is None:
+        categories = list(CATEGORY_SUBDIRS)
+    for obsid in obsid_array:
+        obsid = str(obsid)
+        for beam_root, root_beams in root_list:
+            if beams is not None:
+                root_beams = [b for b in root_beams if b in beams]
+                if len(root_beams) == 0:
+                    continue
+            mount = get_path_mount(beam_root)
+            start = time.time()
+            obsdir = os.path.join(beam_root, obsid)
+            listing = scan_directory(obsdir)
+            record_phase('scan', start, time.time(), items=0, mount=mount)
+            for b in root_beams:
+                name = '{0:02d}'.format(b)
+                if name in listing and listing[name].is_dir:
+                    start = time.time()
+                    beamdir = os.path.join(obsdir, name)
+                    skip_subdirs = None
+                    if state is not None:
+                        skip_subdirs = get_clean_subdirs(state, obsid, b, beamdir,
+                                                         categories)
+                    beam_inv = scan_beam(obsid, b, beamdir, skip_subdirs=skip_subdirs)
+                    record_phase('scan', start, time.time(), mount=mount)
+                    yield beam_inv
+
+
+def scan_inventory(obsid_array, mode='happili-01', state=None,
+                   categories=None, beams=None):
+    """
+    Scan all beams of a set of obsids
+
+    Parameters
+    ----------
+    obsid_array : array
+        Array of obsids as strings
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    state : sqlite3.Connection (optional)
+        Cleanup state index; beam directories that were cleaned
+        and are unchanged since are not listed
+    categories : list (str) (optional)
+        Cleanup categories of this run, used with state.
+        Default is all categories
+    beams : list (int) (optional)
+        Only scan these beams; default is all beams
+
+    Returns
+    -------
+    inventory : OrderedDict
+        Inventory of each beam, in beam order, for each obsid
+    """
+    inventory = OrderedDict((str(obsid), []) for obsid in obsid_array)
+    for beam_inv in iter_inventory(obsid_array, mode=mode, state=state,
+                                   categories=categories, beams=beams):
+        inventory[beam_inv['obsid']].append(beam_inv)
+
+    return inventory
+
+
+def iter_beams(inventory):
+    """
+    Iterate over all beams in an inventory
+
+    Parameters
+    ----------
+    inventory : OrderedDict
+        Inventory from scan_inventory
+
+    Returns
+    -------
+    beam_inv : iterator of dict
+        Inventory of each beam, in obsid and beam order
+    """
+    for obsid in inventory:
+        for beam_inv in inventory[obsid]:
+            yield beam_inv
@@ -0,0 +1,239 @@
+#Cleanup eligibility manifests for happili cleanup
+
+from __future__ import print_function
+
+"""
+Cleanup eligibility manifests for happili cleanup
+
+Whether an obsid may be cleaned depends on facts kept outside happili:
+whether it was sent to cold storage, and whether it is known to fail
+(e.g. the permission failures listed in the README). These are kept in
+manifest files, one taskid per line:
+- archived: taskids sent to cold storage; only these are cleaned
+- exclude: taskids never to clean
+- policy: a taskid followed by the categories to clean for it,
+  e.g. '210904041 cal_vis,cont_inter'
+Text after the taskid (or the categories) is ignored, as are empty
+lines and lines starting with #, and a leading '-' (as in README lists).
+
+The taskids are held in sorted integer arrays, and the obsids found on
+disk are checked against them by binary search, before any beam is
+scanned.
+"""
+
+import numpy as np
+from modules.state import CATEGORY_SUBDIRS
+
+
+def read_manifest(path, with_categories=False):
+    """
+    Read the taskids (and categories) from a manifest file
+
+    Parameters
+    ----------
+    path : str
+        Manifest file
+    with_categories : Boolean
+        Whether each taskid is followed by comma separated categories
+        Default is False
+
+    Returns
+    -------
+    taskids : list (str) or dict
+        Taskids; with categories, a dict of the categories of each taskid
+    """
+    taskids = {} if with_categories else []
+    with open(path) as f:
+        for n, line in enumerate(f):
+            line = line.strip()
+            if line.startswith('-'):
+                line = line[1:].strip()
+            if line == '' or line.startswith('#'):
+                continue
+            fields = line.split()
+            taskid = fields[0]
+            if len(taskid) != 9 or not taskid.isdigit():
+                raise ValueError('{0}, line {1}: {2} is not a taskid'.format(
+                    path, n + 1, taskid))
+            if not with_categories:
+                taskids.append(taskid)
+                continue
+            if len(fields) < 2:
+                raise ValueError('{0}, line {1}: no categories for {2}'.format(
+                    path, n + 1, taskid))
+            categories = [c for c in fields[1].split(',') if c != '']
+            for category in categories:
+                if category not in CATEGORY_SUBDIRS:
+                    raise ValueError('{0}, line {1}: unknown category {2}'.format(
+                        path, n + 1, category))
+            taskids[taskid] = categories
+
+    return taskids
+
+
+def _sorted_taskids(taskids):
+    return np.unique(np.array(list(taskids), dtype=np.int64))
+
+
+def is_in_sorted(values, sorted_array):
+    """
+    Check which values are in a sorted array, by binary search
+
+    Parameters
+    ----------
+    values : array
+        Integers to look up
+    sorted_array : array
+        Sorted integers
+
+    Returns
+    -------
+    found : array (bool)
+        Whether each value is in sorted_array
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(sorted_array) == 0:
+        return np.zeros(len(values), dtype=bool)
+    ind = np.searchsorted(sorted_array, values)
+    found = ind < len(sorted_array)
+    found[found] = sorted_array[ind[found]] == values[found]
+
+    return found
+
+
+class Manifest(object):
+    """
+    Which obsids may be cleaned, and which categories of each
+
+    Parameters
+    ----------
+    archived : list (str) (optional)
+        Taskids sent to cold storage; if given, only these are cleaned
+    exclude : list (str) (optional)
+        Taskids never to clean
+    policy : dict (optional)
+        Categories to clean for specific taskids
+    """
+
+    def __init__(self, archived=None, exclude=None, policy=None):
+        self.archived = None if archived is None else _sorted_taskids(archived)
+        self.exclude = _sorted_taskids(exclude or [])
+        self.policy = dict((str(taskid), list(categories))
+                           for taskid, categories in (policy or {}).items())
+
+    def get_eligible(self, obsid_array):
+        """
+        Check which obsids may be cleaned
+
+        Parameters
+        ----------
+        obsid_array : array
+            Obsids, as strings or integers
+
+        Returns
+        -------
+        eligible : array (bool)
+            Whether each obsid may be cleaned
+        """
+        obsid_int_array = np.asarray(obsid_array).astype(np.int64)
+        eligible = ~is_in_sorted(obsid_int_array, self.exclude)
+        if self.archived is not None:
+            eligible &= is_in_sorted(obsid_int_array, self.archived)
+
+        return eligible
+
+    def is_eligible(self, obsid):
+        """
+        Check whether a single obsid may be cleaned
+        """
+        return bool(self.get_eligible([int(obsid)])[0])
+
+    def get_categories(self, obsid, categories):
+        """
+        Get the categories to clean for an obsid
+
+        Parameters
+        ----------
+        obsid : str
+            Obsid provided as a string
+        categories : list (str)
+            Categories of the run
+
+        Returns
+        -------
+        obsid_categories : list (str)
+            Categories of the run that the policy of the obsid allows
+        """
+        if str(obsid) not in self.policy:
+            return categories
+        return [c for c in categories if c in self.policy[str(obsid)]]
+
+    def get_skipped(self, beam_list, categories):
+        """
+        Find the categories that the policies kept from being cleaned
+
+        Parameters
+        ----------
+        beam_list : list of (str, int, str)
+            Obsid, beam and path of each beam planned
+        categories : list (str)
+            Categories of the run
+
+        Returns
+        -------
+        skipped : set of (str, int, str)
+            Obsid, beam and category not cleaned
+        """
+        skipped = set()
+        for obsid, beam, beamdir in beam_list:
+            obsid_categories = self.get_categories(obsid, categories)
+            for category in categories:
+                if category not in obsid_categories:
+                    skipped.add((str(obsid), int(beam), category))
+
+        return skipped
+
+    def to_dict(self):
+        """
+        Get the manifest as JSON serialisable lists, e.g. for agents and plans
+        """
+        return {'archived': None if self.archived is None
+                else ['{0:09d}'.format(t) for t in self.archived],
+                'exclude': ['{0:09d}'.format(t) for t in self.exclude],
+                'policy': self.policy}
+
+
+def load_manifests(archived=None, exclude=None, policy=None):
+    """
+    Load manifest files
+
+    Parameters
+    ----------
+    archived : list (str) (optional)
+        Files of taskids sent to cold storage
+    exclude : list (str) (optional)
+        Files of taskids never to clean
+    policy : list (str) (optional)
+        Files of taskids with the categories to clean
+
+    Returns
+    -------
+    manifest : Manifest or None
+        Combined manifest; None if no files are given
+    """
+    if not archived and not exclude and not policy:
+        return None
+    archived_taskids = None
+    if archived:
+        archived_taskids = []
+        for path in archived:
+            archived_taskids.extend(read_manifest(path))
+    exclude_taskids = []
+    for path in exclude or []:
+        exclude_taskids.extend(read_manifest(path))
+    policy_taskids = {}
+    for path in policy or []:
+        policy_taskids.update(read_manifest(path, with_categories=True))
+
+    return Manifest(archived=archived_taskids, exclude=exclude_taskids,
+                    policy=policy_taskids)
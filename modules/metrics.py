@@ -0,0 +1,220 @@
+#Timing and throughput metrics for happili cleanup
+
+from __future__ import print_function
+
+"""
+Timing and throughput metrics for happili cleanup
+
+Each phase of a run (obsid discovery, scanning, planning, archiving,
+deletion) records its time, item count, bytes and errors, per mount
+where that applies. Work runs in parallel, so for each phase both the
+wall time (first start to last end) and the busy time (summed over
+items) are kept; throughput is bytes over wall time.
+
+The metrics can be written as a JSON summary, and in the Prometheus
+text format for the node_exporter textfile collector.
+"""
+
+import os
+import json
+import threading
+import time
+from collections import OrderedDict
+from modules.paths import get_mount
+
+# metric name prefix for Prometheus
+METRIC_PREFIX = 'happili_cleanup'
+
+_lock = threading.Lock()
+# (phase, mount) -> totals
+_metrics = OrderedDict()
+_mount_cache = {}
+
+
+def reset_metrics():
+    """
+    Clear all recorded metrics
+    """
+    with _lock:
+        _metrics.clear()
+
+
+def get_path_mount(path):
+    """
+    Find the mount of a path, for recording metrics per mount
+    """
+    with _lock:
+        return get_mount(path, _mount_cache)
+
+
+def record_phase(phase, start, end, items=1, nbytes=0, errors=0, mount=None):
+    """
+    Record work done in a phase of the run
+
+    Parameters
+    ----------
+    phase : str
+        Phase, e.g. discover, scan, plan, archive, delete
+    start : float
+        Start time of the work (time.time())
+    end : float
+        End time of the work
+    items : int
+        Number of items (obsids, beams, work items) done
+    nbytes : int
+        Bytes processed
+    errors : int
+        Number of errors
+    mount : str (optional)
+        Mount the work was done on; None for work not on a single mount
+    """
+    key = (phase, mount)
+    with _lock:
+        if key not in _metrics:
+            _metrics[key] = {'first': start, 'last': end, 'busy': 0.,
+                             'items': 0, 'nbytes': 0, 'errors': 0}
+        totals = _metrics[key]
+        totals['first'] = min(totals['first'], start)
+        totals['last'] = max(totals['last'], end)
+        totals['busy'] += end - start
+        totals['items'] += items
+        totals['nbytes'] += nbytes
+        totals['errors'] += errors
+
+
+def get_metrics():
+    """
+    Get the metrics recorded so far
+
+    Returns
+    -------
+    metric_list : list of dict
+        For each phase and mount: start and end time, wall and busy
+        seconds, items, bytes, bytes per second (over wall time) and errors
+    """
+    metric_list = []
+    with _lock:
+        for (phase, mount), totals in _metrics.items():
+            wall = totals['last'] - totals['first']
+            metric_list.append(OrderedDict([
+                ('phase', phase), ('mount', mount),
+                ('start', totals['first']), ('end', totals['last']),
+                ('wall_seconds', wall), ('busy_seconds', totals['busy']),
+                ('items', totals['items']), ('nbytes', totals['nbytes']),
+                ('bytes_per_second', totals['nbytes'] / wall if wall > 0 else 0.),
+                ('errors', totals['errors'])]))
+
+    return metric_list
+
+
+def merge_metrics(metric_list, node=None):
+    """
+    Add metrics recorded elsewhere, e.g. by an agent on another node
+
+    Parameters
+    ----------
+    metric_list : list of dict
+        Metrics from get_metrics
+    node : str (optional)
+        Node the metrics come from; their mounts are labelled node:mount,
+        as the same mount (e.g. /data) is on every node
+    """
+    for m in metric_list:
+        mount = m['mount']
+        if node is not None:
+            mount = node if mount is None else '{0}:{1}'.format(node, mount)
+        key = (m['phase'], mount)
+        with _lock:
+            if key not in _metrics:
+                _metrics[key] = {'first': m['start'], 'last': m['end'], 'busy': 0.,
+                                 'items': 0, 'nbytes': 0, 'errors': 0}
+            totals = _metrics[key]
+            totals['first'] = min(totals['first'], m['start'])
+            totals['last'] = max(totals['last'], m['end'])
+            totals['busy'] += m['busy_seconds']
+            totals['items'] += m['items']
+            totals['nbytes'] += m['nbytes']
+            totals['errors'] += m['errors']
+
+
+def print_metrics():
+    """
+    Print the metrics recorded so far, one line per phase and mount
+    """
+    print('{0:<10}{1:<16}{2:>10}{3:>10}{4:>10}{5:>14}{6:>12}{7:>8}'.format(
+        'phase', 'mount', 'wall s', 'busy s', 'items', 'bytes', 'MB/s', 'errors'))
+    for m in get_metrics():
+        print('{0:<10}{1:<16}{2:>10.2f}{3:>10.2f}{4:>10d}{5:>14d}{6:>12.1f}{7:>8d}'.format(
+            m['phase'], m['mount'] or '-', m['wall_seconds'], m['busy_seconds'],
+            m['items'], m['nbytes'], m['bytes_per_second'] / 1e6, m['errors']))
+
+
+def _write_atomic(path, text):
+    """
+    Write a file via a temporary name, so readers never see it half written
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+
+
+def write_json_summary(path, extra=None):
+    """
+    Write the metrics as a JSON summary
+
+    Parameters
+    ----------
+    path : str
+        File to write
+    extra : dict (optional)
+        Additional information on the run, e.g. its arguments
+    """
+    summary = OrderedDict([('time', time.time()), ('phases', get_metrics())])
+    if extra is not None:
+        summary.update(extra)
+    _write_atomic(path, json.dumps(summary, indent=2) + '\n')
+
+
+def format_prometheus():
+    """
+    Format the metrics in the Prometheus text exposition format
+
+    Returns
+    -------
+    text : str
+        Metrics, labelled by phase and mount
+    """
+    metric_list = get_metrics()
+    fields = [('wall_seconds', 'gauge', 'Wall time of the phase'),
+              ('busy_seconds', 'gauge', 'Time summed over items of the phase'),
+              ('items', 'gauge', 'Items done in the phase'),
+              ('nbytes', 'gauge', 'Bytes processed in the phase'),
+              ('bytes_per_second', 'gauge', 'Bytes processed per second of wall time'),
+              ('errors', 'gauge', 'Errors in the phase')]
+    lines = []
+    for field, kind, help_text in fields:
+        name = '{0}_{1}'.format(METRIC_PREFIX, 'bytes' if field == 'nbytes' else field)
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+        for m in metric_list:
+            lines.append('{0}{{phase="{1}",mount="{2}"}} {3}'.format(
+                name, m['phase'], m['mount'] or '', m[field]))
+    name = '{0}_last_run_timestamp_seconds'.format(METRIC_PREFIX)
+    lines.append('# HELP {0} Time the metrics were written'.format(name))
+    lines.append('# TYPE {0} gauge'.format(name))
+    lines.append('{0} {1}'.format(name, time.time()))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    """
+    Write the metrics for the node_exporter textfile collector
+
+    Parameters
+    ----------
+    path : str
+        File to write, e.g. <textfile directory>/happili_cleanup.prom
+    """
+    _write_atomic(path, format_prometheus())
@@ -0,0 +1,171 @@
+#Data layout of the happili nodes
+
+from __future__ import print_function
+
+"""
+Data layout of the happili nodes
+
+In happili-01 mode, beams are spread over the four nodes,
+which are accessed as /data, /data2, /data3 and /data4.
+In happili-05 mode, everything is local in /data.
+In local mode (used by the node agents, see modules.agent),
+each node only sees the beams on its own /data.
+
+All paths can be moved under a different root (e.g. a synthetic
+tree for benchmarks) with set_data_root, or with the
+HAPPILI_DATA_ROOT environment variable.
+"""
+
+import os
+
+# beams on the local /data of each node, in happili-01 layout
+NODE_BEAMS = {'happili-01': list(range(0, 10)),
+              'happili-02': list(range(10, 20)),
+              'happili-03': list(range(20, 30)),
+              'happili-04': list(range(30, 40))}
+
+# prefix of the /data* mounts; empty on the happili nodes
+_data_root = os.environ.get('HAPPILI_DATA_ROOT', '')
+
+
+def set_data_root(root=None):
+    """
+    Put the /data* mounts under a different root directory
+
+    Parameters
+    ----------
+    root : str (optional)
+        Directory holding data, data2, data3 and data4;
+        None or '' for the real mounts
+    """
+    global _data_root
+    if root is None:
+        root = ''
+    _data_root = root.rstrip('/')
+
+
+def get_data_root():
+    """
+    Get the root directory of the /data* mounts ('' for the real mounts)
+    """
+    return _data_root
+
+
+def get_beam_root(beam, mode='happili-01'):
+    """
+    Get the apertif root directory that holds a beam
+
+    Parameters
+    ----------
+    beam : int
+        beam provided as an int
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+
+    Returns
+    -------
+    beam_root : str
+        apertif root directory for the beam, e.g. /data2/apertif
+    """
+    if mode == 'happili-05' or mode == 'local':
+        beam_root = '/data/apertif'
+    else:
+        # if not happili-05 mode, default to happili-01 mode
+        if beam < 10:
+            beam_root = '/data/apertif'
+        elif beam < 20:
+            beam_root = '/data2/apertif'
+        elif beam < 30:
+            beam_root = '/data3/apertif'
+        else:
+            beam_root = '/data4/apertif'
+
+    return _data_root + beam_root
+
+
+def get_mode_roots(mode='happili-01'):
+    """
+    Get the apertif root directories used in a running mode,
+    together with the beams each of them holds
+
+    Parameters
+    ----------
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+
+    Returns
+    -------
+    root_list : list of (str, list of int)
+        Apertif root directory and the beams it holds, in beam order
+    """
+    root_list = []
+    for b in range(40):
+        beam_root = get_beam_root(b, mode=mode)
+        if len(root_list) == 0 or root_list[-1][0] != beam_root:
+            root_list.append((beam_root, []))
+        root_list[-1][1].append(b)
+
+    return root_list
+
+
+def get_fs_type(mount):
+    """
+    Find the filesystem type of a mount point, from /proc/mounts
+
+    Parameters
+    ----------
+    mount : str
+        Mount point, e.g. from get_mount
+
+    Returns
+    -------
+    fs_type : str or None
+        Filesystem type, e.g. xfs or nfs4; None if not known
+    """
+    fs_type = None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                # later mounts on the same point hide earlier ones
+                if len(fields) > 2 and fields[1].replace('\\040', ' ') == mount:
+                    fs_type = fields[2]
+    except OSError:
+        pass
+
+    return fs_type
+
+
+def get_mount(path, mount_cache=None):
+    """
+    Find the mount point a path is on
+
+    Parameters
+    ----------
+    path : str
+        Path to look up
+    mount_cache : dict (optional)
+        Cache of directory -> mount point, shared between calls
+
+    Returns
+    -------
+    mount : str
+        Mount point
+    """
+    if mount_cache is None:
+        mount_cache = {}
+    path = os.path.abspath(path)
+    checked = []
+    while path not in mount_cache:
+        if os.path.ismount(path) or path == os.path.dirname(path):
+            mount_cache[path] = path
+            break
+        checked.append(path)
+        path = os.path.dirname(path)
+    mount = mount_cache[path]
+    for p in checked:
+        mount_cache[p] = mount
+
+    return mount
@@ -0,0 +1,339 @@
+#Cleanup plans and resumable execution
+
+from __future__ import print_function
+
+"""
+Cleanup plans and resumable execution
+
+A plan is the full list of archive / delete work items from the planners,
+written to a compact gzipped, tab separated file. Executing a plan
+checkpoints every finished item to a journal next to it,
+so an interrupted run (screen died, node rebooted) resumes
+from where it stopped, without scanning again and without
+archiving again directories that were already archived
+(as long as their archive is still complete).
+"""
+
+import os
+import gzip
+import json
+import time
+from modules.executor import execute_work_items, WorkItem
+from modules.deletion import DEFAULT_WORKERS, is_target_gone
+from modules.archive import DEFAULT_FORMAT, DEFAULT_TARGET_RATIO, is_archive_complete
+from modules.preflight import AdminTarget
+from modules.compact import CompactPlan
+
+PLAN_VERSION = 1
+# seconds between syncing the journal to disk
+JOURNAL_SYNC_INTERVAL = 1.
+
+
+def get_journal_file(plan_file):
+    """
+    Get the journal file belonging to a plan
+    """
+    return plan_file + '.journal'
+
+
+def write_plan(plan_file, item_iter, beam_list=None, metadata=None, admin_list=None):
+    """
+    Write work items to a plan file, as they are planned
+
+    Parameters
+    ----------
+    plan_file : str
+        Plan file to write (gzipped)
+    item_iter : iterable of WorkItem
+        Work items, e.g. from functions.iter_work_items
+    beam_list : list (optional)
+        Beams (obsid, beam, path) filled in while planning,
+        stored for recording the cleanup state after execution
+    metadata : dict (optional)
+        Description of the plan (date range, mode, categories)
+    admin_list : list (optional)
+        Targets held back for an admin (AdminTarget), filled in while
+        planning, stored so they are reported and not recorded as
+        cleaned after execution
+
+    Returns
+    -------
+    n_items : int
+        Number of work items in the plan
+    """
+    header = {'version': PLAN_VERSION, 'created': time.time()}
+    if metadata is not None:
+        header.update(metadata)
+    n_items = 0
+    tmp_file = plan_file + '.tmp'
+    with gzip.open(tmp_file, 'wt') as f:
+        f.write('# {}\n'.format(json.dumps(header)))
+        for item in item_iter:
+            f.write('I\t{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(
+                item.obsid, item.beam, item.category, item.action, item.path,
+                '' if item.requires is None else item.requires))
+            n_items += 1
+        if beam_list is not None:
+            for obsid, beam, beamdir in beam_list:
+                f.write('B\t{0}\t{1}\t{2}\n'.format(obsid, beam, beamdir))
+        if admin_list is not None:
+            for target in admin_list:
+                f.write('A\t{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n'.format(*target))
+    # only a complete plan replaces an older one
+    os.rename(tmp_file, plan_file)
+    # a new plan starts a new journal
+    if os.path.exists(get_journal_file(plan_file)):
+        os.remove(get_journal_file(plan_file))
+
+    return n_items
+
+
+def read_plan_header(plan_file):
+    """
+    Read the description of a plan
+
+    Parameters
+    ----------
+    plan_file : str
+        Plan file
+
+    Returns
+    -------
+    header : dict
+        Version, creation time, and the metadata given when written
+    """
+    with gzip.open(plan_file, 'rt') as f:
+        line = f.readline()
+    header = json.loads(line[2:])
+    if header.get('version') != PLAN_VERSION:
+        raise ValueError('Unsupported plan version in {}'.format(plan_file))
+
+    return header
+
+
+def iter_plan(plan_file):
+    """
+    Read the work items of a plan, one at a time
+
+    Parameters
+    ----------
+    plan_file : str
+        Plan file
+
+    Returns
+    -------
+    index_item : iterator of (int, WorkItem)
+        Index in the plan and work item
+    """
+    index = 0
+    with gzip.open(plan_file, 'rt') as f:
+        for line in f:
+            if not line.startswith('I\t'):
+                continue
+            kind, obsid, beam, category, action, path, requires = \
+                line.rstrip('\n').split('\t')
+            yield index, WorkItem(obsid, int(beam), category, action, path,
+                                  requires if requires != '' else None)
+            index += 1
+
+
+def read_plan(plan_file):
+    """
+    Read all work items of a plan into memory, as a compact plan
+
+    Parameters
+    ----------
+    plan_file : str
+        Plan file
+
+    Returns
+    -------
+    plan : CompactPlan
+        Work items of the plan, in plan order
+    """
+    return CompactPlan.from_items(item for index, item in iter_plan(plan_file))
+
+
+def read_plan_beams(plan_file):
+    """
+    Read the beams a plan was made for
+
+    Parameters
+    ----------
+    plan_file : str
+        Plan file
+
+    Returns
+    -------
+    beam_list : list of (str, int, str)
+        Obsid, beam and path of each beam
+    """
+    beam_list = []
+    with gzip.open(plan_file, 'rt') as f:
+        for line in f:
+            if line.startswith('B\t'):
+                kind, obsid, beam, beamdir = line.rstrip('\n').split('\t')
+                beam_list.append((obsid, int(beam), beamdir))
+
+    return beam_list
+
+
+def read_plan_admin(plan_file):
+    """
+    Read the targets held back from a plan for an admin
+
+    Parameters
+    ----------
+    plan_file : str
+        Plan file
+
+    Returns
+    -------
+    admin_list : list of AdminTarget
+        Targets that need an admin
+    """
+    admin_list = []
+    with gzip.open(plan_file, 'rt') as f:
+        for line in f:
+            if line.startswith('A\t'):
+                kind, obsid, beam, category, path, owner, reason = \
+                    line.rstrip('\n').split('\t')
+                admin_list.append(AdminTarget(obsid, int(beam), category, path,
+                                              int(owner), reason))
+
+    return admin_list
+
+
+def read_journal(journal_file):
+    """
+    Read the items of a plan that already finished
+
+    A line that was only partly written when a run was interrupted is ignored
+
+    Parameters
+    ----------
+    journal_file : str
+        Journal of a plan
+
+    Returns
+    -------
+    done : set (int)
+        Index of every item that finished successfully
+    """
+    done = set()
+    if not os.path.exists(journal_file):
+        return done
+    with open(journal_file) as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            index, status = line.split('\t')[:2]
+            if status.strip() in ('ok', 'gone'):
+                done.add(int(index))
+
+    return done
+
+
+def get_status(item, result):
+    """
+    Get the journal status of a finished item
+
+    A deletion target that no longer exists is 'gone', which counts
+    as done (see deletion.is_target_gone)
+    """
+    if result.error is None:
+        return 'ok'
+    if item.action == 'delete' and is_target_gone(result):
+        return 'gone'
+
+    return 'fail'
+
+
+def execute_plan(plan_file, run=False, verbose=True, workers=DEFAULT_WORKERS,
+                 mount_workers=None, archive_workers=None,
+                 archive_format=DEFAULT_FORMAT, target_ratio=DEFAULT_TARGET_RATIO,
+                 trash=False, inode_order=None):
+    """
+    Execute a plan, resuming from its journal
+
+    Parameters
+    ----------
+    plan_file : str
+        Plan file, from write_plan
+    run : Boolean
+        Actually run and do archiving / deletion?
+        Without run, nothing is written to the journal
+        Default is False
+    verbose : Boolean
+        Print a record of what is (to be) done?
+        Default is True
+    workers : int
+        Number of parallel deletions per device
+        Default is DEFAULT_WORKERS
+    mount_workers : dict (optional)
+        Number of parallel deletions for specific mounts
+    archive_workers : int (optional)
+        Number of parallel archiving processes; default is one per core
+    archive_format : str
+        Archive format (see modules.archive), default is DEFAULT_FORMAT
+    target_ratio : float
+        Compression ratio to reach with the auto format
+    trash : Boolean
+        Move targets into the trash, leaving their removal to the reaper
+        Default is False
+    inode_order : Boolean (optional)
+        Visit directory entries in inode order; by default on local
+        filesystems only
+
+    Returns
+    -------
+    item_result : iterator of (WorkItem, ArchiveResult or DeleteResult)
+        Outcome of each item executed in this run, in order of completion
+    """
+    journal_file = get_journal_file(plan_file)
+    done = read_journal(journal_file)
+    if verbose is True and len(done) > 0:
+        print('Resuming {0}; {1} items already done'.format(plan_file, len(done)))
+    # archives made before the interruption
+    archived = set()
+    # index of the items in flight
+    in_flight = {}
+
+    def item_iter():
+        for index, item in iter_plan(plan_file):
+            if index in done:
+                if item.action != 'archive':
+                    continue
+                # only trust archives that are still complete
+                if is_archive_complete(item.path):
+                    archived.add(item.path)
+                    continue
+            in_flight[id(item)] = index
+            yield item
+
+    journal = None
+    if run is True:
+        journal = open(journal_file, 'a')
+    last_sync = time.time()
+    try:
+        for item, result in execute_work_items(item_iter(), run=run, verbose=verbose,
+                                               workers=workers,
+                                               mount_workers=mount_workers,
+                                               archive_workers=archive_workers,
+                                               archived=archived,
+                                               archive_format=archive_format,
+                                               target_ratio=target_ratio,
+                                               trash=trash, inode_order=inode_order):
+            index = in_flight.pop(id(item))
+            if journal is not None:
+                journal.write('{0}\t{1}\n'.format(index, get_status(item, result)))
+                journal.flush()
+                if time.time() - last_sync > JOURNAL_SYNC_INTERVAL:
+                    os.fsync(journal.fileno())
+                    last_sync = time.time()
+            yield item, result
+    finally:
+        if journal is not None:
+            journal.flush()
+            os.fsync(journal.fileno())
+            journal.close()
@@ -0,0 +1,246 @@
+#Permission pre-flight for happili cleanup
+
+from __future__ import print_function
+
+"""
+Permission pre-flight for happili cleanup
+
+Some targets cannot be removed by whoever runs the cleanup (see the
+failed taskids in the README): the directory holding them, or the
+target directory itself, belongs to another user and is not writable.
+Trying anyway walks into the tree, removes what it can, and leaves
+it half deleted.
+
+The scan already records the lstat owner and mode of every entry and
+of the directories listed, so each work item is checked against these
+before it is handed out. Targets that would fail are never attempted,
+and are reported per owner as needing an admin. Items that depend on
+them are held back too: a directory is not archived if its original
+cannot be deleted, and nothing waits on an archive that is not made.
+
+Only the target and the directory holding it are checked; anything
+deeper in the tree with different permissions is still reported by
+the deletion itself.
+"""
+
+import csv
+import os
+import pwd
+import stat
+from collections import namedtuple, OrderedDict
+
+# a target that needs an admin; owner is the uid
+# of the directory lacking permission
+AdminTarget = namedtuple('AdminTarget', ['obsid', 'beam', 'category', 'path',
+                                         'owner', 'reason'])
+
+_euid = None
+_groups = None
+
+
+def _get_identity():
+    global _euid, _groups
+    if _euid is None:
+        _euid = os.geteuid()
+        _groups = set(os.getgroups()) | {os.getegid()}
+    return _euid, _groups
+
+
+def get_user_name(uid, names=None):
+    """
+    Get the user name of a uid, or the uid if it has no name
+    """
+    if names is not None and uid in names:
+        return names[uid]
+    try:
+        name = pwd.getpwuid(uid).pw_name
+    except KeyError:
+        name = str(uid)
+    if names is not None:
+        names[uid] = name
+
+    return name
+
+
+def _can_modify(entry):
+    """
+    Check whether a directory allows its entries to be added and removed
+    """
+    euid, groups = _get_identity()
+    if euid == 0:
+        return True
+    if entry.uid == euid:
+        bits = stat.S_IWUSR | stat.S_IXUSR
+    elif entry.gid in groups:
+        bits = stat.S_IWGRP | stat.S_IXGRP
+    else:
+        bits = stat.S_IWOTH | stat.S_IXOTH
+    return entry.mode & bits == bits
+
+
+def _get_entries(beam_inv, path):
+    """
+    Find the scanned entries of a target and of the directory holding it
+
+    Returns
+    -------
+    parent : Entry or None
+        Directory holding the target; None if not scanned
+    target : Entry or None
+        Target itself; None if not scanned
+    """
+    rel = os.path.relpath(path, beam_inv['path']).split(os.sep)
+    if len(rel) == 2:
+        parent = beam_inv['dirs'].get(rel[0])
+        listing = beam_inv.get(rel[0])
+    elif len(rel) == 3 and rel[0] == 'selfcal':
+        parent = beam_inv['selfcal'].get(rel[1])
+        listing = beam_inv['selfcal_amp'] if rel[1] == 'amp' else beam_inv['selfcal_last']
+    else:
+        return None, None
+    target = None
+    if listing is not None:
+        target = listing.get(rel[-1])
+
+    return parent, target
+
+
+def check_removal(parent, target):
+    """
+    Check whether a target can be removed, from its scanned entries
+
+    Parameters
+    ----------
+    parent : Entry or None
+        Directory holding the target
+    target : Entry or None
+        Target itself
+
+    Returns
+    -------
+    problem : (int, str) or None
+        Owner of the directory lacking permission, and the reason;
+        None if removal should work (or nothing is known)
+    """
+    if parent is None or parent.mode is None:
+        return None
+    euid, groups = _get_identity()
+    if not _can_modify(parent):
+        return parent.uid, 'directory holding it is not writable'
+    if (target is not None and target.mode is not None and euid != 0 and
+            parent.mode & stat.S_ISVTX and euid not in (parent.uid, target.uid)):
+        return target.uid, 'sticky directory, owned by another user'
+    if (target is not None and target.mode is not None and
+            stat.S_ISDIR(target.mode) and not _can_modify(target)):
+        return target.uid, 'directory is not writable'
+
+    return None
+
+
+def check_work_items(beam_inv, item_list):
+    """
+    Split the work items of a beam into those that can be done
+    and those that need an admin
+
+    Parameters
+    ----------
+    beam_inv : dict
+        Inventory of the beam, from scan_beam
+    item_list : list of WorkItem
+        Work items of the beam
+
+    Returns
+    -------
+    ok_list : list of WorkItem
+        Work items to do, in order
+    admin_list : list of AdminTarget
+        Targets that would fail or depend on one that would
+    """
+    if 'dirs' not in beam_inv:
+        return item_list, []
+    problems = {}
+    for item in item_list:
+        parent, target = _get_entries(beam_inv, item.path)
+        if item.action == 'archive':
+            # the archive is written next to the directory
+            if parent is not None and parent.mode is not None and not _can_modify(parent):
+                problems[item] = (parent.uid, 'cannot write archive next to it')
+        else:
+            problem = check_removal(parent, target)
+            if problem is not None:
+                problems[item] = problem
+    if len(problems) == 0:
+        return item_list, []
+
+    # archives whose original cannot be deleted are not made,
+    # and nothing waits on an archive that is not made
+    delete_problems = dict((item.path, problems[item]) for item in item_list
+                           if item.action == 'delete' and item in problems)
+    blocked = {}
+    for item in item_list:
+        if item.action != 'archive':
+            continue
+        if item not in problems and item.path in delete_problems:
+            problems[item] = delete_problems[item.path]
+        if item in problems:
+            blocked[item.path] = problems[item][0]
+    for item in item_list:
+        if item.requires in blocked and item not in problems:
+            problems[item] = (blocked[item.requires],
+                              'waits on an archive that cannot be made')
+
+    ok_list = [item for item in item_list if item not in problems]
+    admin_list = [AdminTarget(item.obsid, item.beam, item.category, item.path,
+                              problems[item][0], problems[item][1])
+                  for item in item_list if item in problems]
+
+    return ok_list, admin_list
+
+
+def get_admin_failed(admin_list):
+    """
+    Get the obsid / beam / category combinations that were held back,
+    so they are not recorded as cleaned
+    """
+    return set((target.obsid, target.beam, target.category) for target in admin_list)
+
+
+def print_admin_report(admin_list):
+    """
+    Print the targets that need an admin, per owner
+    """
+    if len(admin_list) == 0:
+        return
+    names = {}
+    by_owner = OrderedDict()
+    for target in sorted(admin_list, key=lambda t: (t.owner, t.obsid, t.beam)):
+        by_owner.setdefault(target.owner, []).append(target)
+    print('')
+    print('Needs admin: {0} targets were not attempted'.format(len(admin_list)))
+    for owner, target_list in by_owner.items():
+        beams = OrderedDict()
+        for target in target_list:
+            beams.setdefault(target.obsid, set()).add(target.beam)
+        print('{0} ({1} targets): {2}'.format(
+            get_user_name(owner, names), len(target_list),
+            ', '.join('{0} beams {1}'.format(obsid, ','.join(
+                '{0:02d}'.format(b) for b in sorted(beams[obsid])))
+                for obsid in beams)))
+        reasons = OrderedDict()
+        for target in target_list:
+            reasons[target.reason] = reasons.get(target.reason, 0) + 1
+        for reason, count in reasons.items():
+            print('    {0}: {1}'.format(reason, count))
+
+
+def write_admin_report(path, admin_list):
+    """
+    Write the targets that need an admin as CSV
+    """
+    names = {}
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['owner', 'obsid', 'beam', 'category', 'path', 'reason'])
+        for target in admin_list:
+            writer.writerow([get_user_name(target.owner, names), target.obsid,
+                             target.beam, target.category, target.path, target.reason])
@@ -0,0 +1,281 @@
+#Live progress of happili cleanup runs
+
+from __future__ import print_function
+
+"""
+Live progress of happili cleanup runs
+
+Before a run starts, its work items are held as a compact plan
+(modules.compact), and the size of every target is found with the
+parallel walker of the space accounting. The plan then streams its work
+items into the executor. As work items finish, their bytes and counts
+are added per mount and per phase (archive, delete); a background
+thread reports at a fixed, low rate (every 10 s by default) the items
+and bytes done and remaining, the throughput over the last minute and
+an estimated time to finish. Recording a finished item only looks up
+its hash and adds to a few counters, so the run is not slowed down.
+
+The report is printed, or in quiet mode written to a status file
+that can be followed from another shell (cat, watch).
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+import numpy as np
+from modules.accounting import get_sizes, format_bytes, DEFAULT_WALK_WORKERS
+from modules.compact import ACTIONS
+from modules.metrics import get_path_mount
+from modules.plan import get_status
+
+# seconds between reports
+DEFAULT_INTERVAL = 10.
+# seconds over which the current throughput is measured
+RATE_WINDOW = 60.
+# targets sized at once
+SIZE_CHUNK = 10000
+
+
+def _item_hash(action, path):
+    return hash((action, path))
+
+
+def get_item_sizes(plan, workers=DEFAULT_WALK_WORKERS, chunk=SIZE_CHUNK):
+    """
+    Find the size of the target of every work item of a plan
+
+    Targets are sized a chunk at a time, so their paths are never
+    all held at once
+
+    Parameters
+    ----------
+    plan : CompactPlan
+        Work items of the run
+    workers : int
+        Number of walker threads
+    chunk : int
+        Number of work items sized at once
+
+    Returns
+    -------
+    item_bytes : array (int)
+        Bytes of the target of each work item, in plan order
+    """
+    item_bytes = np.zeros(len(plan), dtype=np.int64)
+    for first in range(0, len(plan), chunk):
+        last = min(first + chunk, len(plan))
+        path_list = [plan.get_path(i) for i in range(first, last)]
+        sizes = dict((size.path, size.nbytes) for size in
+                     get_sizes(list(OrderedDict.fromkeys(path_list)), workers=workers))
+        item_bytes[first:last] = [sizes[path] for path in path_list]
+
+    return item_bytes
+
+
+def format_duration(seconds):
+    """
+    Format seconds as H:MM:SS, or '-' if unknown
+    """
+    if seconds is None:
+        return '-'
+    seconds = int(round(seconds))
+
+    return '{0:d}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress(object):
+    """
+    Progress of a run, per mount and phase
+
+    Parameters
+    ----------
+    plan : CompactPlan
+        Work items of the run
+    item_bytes : array (int)
+        Size of the target of each work item, from get_item_sizes
+    interval : float
+        Seconds between reports
+    status_file : str (optional)
+        Write each report to this file (quiet mode), rather than printing it
+    """
+
+    def __init__(self, plan, item_bytes, interval=DEFAULT_INTERVAL, status_file=None):
+        self.interval = interval
+        self.status_file = status_file
+        # (mount, phase) -> [items, bytes, items done, bytes done, errors]
+        self.totals = OrderedDict()
+        # (mount, phase) -> deque of (time, bytes done)
+        self.history = {}
+        mount_codes, mount_list = plan.get_mounts()
+        key_codes = mount_codes.astype(np.int64) * len(ACTIONS) + plan.action
+        values, first, inverse = np.unique(key_codes, return_index=True,
+                                           return_inverse=True)
+        self.keys = [(mount_list[value // len(ACTIONS)], ACTIONS[value % len(ACTIONS)])
+                     for value in values]
+        item_count = np.bincount(inverse, minlength=len(values))
+        key_bytes = np.bincount(inverse, weights=item_bytes, minlength=len(values))
+        for k in np.argsort(first):
+            self.totals[self.keys[k]] = [int(item_count[k]), int(key_bytes[k]), 0, 0, 0]
+        # work items are found by the hash of their action and path
+        hashes = np.array([_item_hash(ACTIONS[plan.action[i]], plan.get_path(i))
+                           for i in range(len(plan))], dtype=np.int64)
+        order = np.argsort(hashes)
+        self.hashes = hashes[order]
+        self.item_key = inverse[order]
+        self.item_bytes = np.asarray(item_bytes)[order]
+        self.counted = np.zeros(len(plan), dtype=bool)
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _find(self, item):
+        h = _item_hash(item.action, item.path)
+        i = np.searchsorted(self.hashes, h)
+        if i < len(self.hashes) and self.hashes[i] == h and not self.counted[i]:
+            return i
+        return None
+
+    def update(self, item, result):
+        """
+        Count a finished work item
+        """
+        with self._lock:
+            i = self._find(item)
+            if i is None:
+                # not sized beforehand
+                key = (get_path_mount(item.path), item.action)
+                self.totals.setdefault(key, [0, 0, 0, 0, 0])
+                self.totals[key][0] += 1
+                nbytes = 0
+            else:
+                self.counted[i] = True
+                key = self.keys[self.item_key[i]]
+                nbytes = int(self.item_bytes[i])
+            totals = self.totals[key]
+            totals[2] += 1
+            totals[3] += nbytes
+            if get_status(item, result) == 'fail':
+                totals[4] += 1
+
+    def get_rows(self, now=None):
+        """
+        Get the progress so far
+
+        Parameters
+        ----------
+        now : float (optional)
+            Time of the report; default is now
+
+        Returns
+        -------
+        rows : list of dict
+            For each mount and phase: items and bytes (total and done),
+            errors, current throughput (bytes/s) and seconds left (or None)
+        """
+        if now is None:
+            now = time.time()
+        rows = []
+        with self._lock:
+            for key, (items, nbytes, items_done, bytes_done, errors) in self.totals.items():
+                history = self.history.setdefault(key, deque([(self.start_time, 0)]))
+                history.append((now, bytes_done))
+                while len(history) > 2 and history[1][0] < now - RATE_WINDOW:
+                    history.popleft()
+                then, bytes_then = history[0]
+                rate = (bytes_done - bytes_then) / (now - then) if now > then else 0.
+                eta = None
+                if items_done == items:
+                    eta = 0.
+                elif rate > 0:
+                    eta = (nbytes - bytes_done) / rate
+                rows.append(OrderedDict([
+                    ('mount', key[0]), ('phase', key[1]),
+                    ('items', items), ('items_done', items_done),
+                    ('nbytes', nbytes), ('bytes_done', bytes_done),
+                    ('errors', errors), ('rate', rate), ('eta', eta)]))
+
+        return rows
+
+    def format(self, now=None):
+        """
+        Format the progress so far as a table
+        """
+        if now is None:
+            now = time.time()
+        rows = self.get_rows(now)
+        etas = [row['eta'] for row in rows if row['eta'] is not None]
+        # mounts and phases run side by side; the slowest decides
+        eta = max(etas) if len(etas) > 0 else None
+        lines = ['Progress at {0}; running {1}, {2} left'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now)),
+            format_duration(now - self.start_time), format_duration(eta))]
+        lines.append('{0:<16}{1:<9}{2:>17}{3:>21}{4:>8}{5:>10}{6:>10}'.format(
+            'mount', 'phase', 'items done', 'bytes done', 'errors', 'MB/s', 'left'))
+        for row in rows:
+            lines.append('{0:<16}{1:<9}{2:>17}{3:>21}{4:>8d}{5:>10.1f}{6:>10}'.format(
+                row['mount'], row['phase'],
+                '{0}/{1}'.format(row['items_done'], row['items']),
+                '{0}/{1}'.format(format_bytes(row['bytes_done']), format_bytes(row['nbytes'])),
+                row['errors'], row['rate'] / 1e6, format_duration(row['eta'])))
+
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        """
+        Print the progress, or write it to the status file
+        """
+        text = self.format()
+        if self.status_file is not None:
+            # readers never see the file half written
+            with open(self.status_file + '.tmp', 'w') as f:
+                f.write(text)
+            os.rename(self.status_file + '.tmp', self.status_file)
+        else:
+            print(text)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def start(self):
+        """
+        Start reporting in the background
+        """
+        self.start_time = time.time()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop reporting, with a last report
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.report()
+
+    def iter_results(self, item_result):
+        """
+        Follow a stream of results, from start to end of the stream
+
+        Parameters
+        ----------
+        item_result : iterator of (WorkItem, result)
+            Results, e.g. from execute_work_items
+
+        Returns
+        -------
+        item_result : iterator of (WorkItem, result)
+            The same results, counted as they pass
+        """
+        self.start()
+        try:
+            for item, result in item_result:
+                self.update(item, result)
+                yield item, result
+        finally:
+            self.stop()
@@ -0,0 +1,319 @@
+#Persistent cleanup state for happili cleanup
+
+from __future__ import print_function
+
+"""
+Persistent cleanup state for happili cleanup
+
+Cleanup is re-run over overlapping date ranges.
+A small SQLite index records, for each obsid / beam / category,
+when it was cleaned and the mtime of the directory it lives in at that time.
+On a new run, a beam whose directories are unchanged since they were cleaned
+is skipped with a single indexed lookup and a stat per directory,
+rather than listing its tree again.
+
+The digest of every archive made is also kept, for later audits,
+as are per-directory totals of the usage report (see modules.usage).
+"""
+
+import json
+import os
+import time
+import sqlite3
+
+# default location of the state index
+DEFAULT_STATE_DIR = os.path.expanduser('~/.happili_cleanup')
+STATE_FILE = 'state.sqlite'
+
+# cleanup categories, and the beam subdirectory each of them works in
+CATEGORY_SUBDIRS = {'scal_inter': 'selfcal',
+                    'scal_final': 'selfcal',
+                    'cont_inter': 'continuum',
+                    'cal_vis': 'raw'}
+
+
+def open_state(state_dir=None):
+    """
+    Open (and if needed create) the state index
+
+    Parameters
+    ----------
+    state_dir : str (optional)
+        Directory holding the index, default is DEFAULT_STATE_DIR
+
+    Returns
+    -------
+    conn : sqlite3.Connection
+        Connection to the index
+    """
+    if state_dir is None:
+        state_dir = DEFAULT_STATE_DIR
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    conn = sqlite3.connect(os.path.join(state_dir, STATE_FILE))
+    conn.execute("""CREATE TABLE IF NOT EXISTS cleaned (
+                        obsid TEXT NOT NULL,
+                        beam INTEGER NOT NULL,
+                        category TEXT NOT NULL,
+                        cleaned_at REAL NOT NULL,
+                        dir_mtime REAL NOT NULL,
+                        PRIMARY KEY (obsid, beam, category))""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS archives (
+                        path TEXT PRIMARY KEY,
+                        archive TEXT NOT NULL,
+                        format TEXT NOT NULL,
+                        sha256 TEXT NOT NULL,
+                        nbytes INTEGER NOT NULL,
+                        archived_at REAL NOT NULL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS usage (
+                        path TEXT PRIMARY KEY,
+                        mtime INTEGER NOT NULL,
+                        subdirs TEXT NOT NULL,
+                        totals TEXT NOT NULL)""")
+    conn.commit()
+
+    return conn
+
+
+def get_dir_mtime(path):
+    """
+    Get mtime of a directory, or None if it does not exist
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def get_clean_subdirs(conn, obsid, beam, beamdir, categories):
+    """
+    Find the subdirectories of a beam that need no scanning
+
+    A subdirectory can be skipped if every requested category
+    working in it was cleaned, and its mtime is unchanged since.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the index
+    obsid : str
+        Obsid provided as a string
+    beam : int
+        beam provided as an int
+    beamdir : str
+        path to obsid / beam
+    categories : list (str)
+        Categories requested in this run
+
+    Returns
+    -------
+    clean_subdirs : set (str)
+        Subdirectories (selfcal, continuum, raw) to skip
+    """
+    rows = conn.execute("SELECT category, dir_mtime FROM cleaned "
+                        "WHERE obsid = ? AND beam = ?",
+                        (str(obsid), int(beam))).fetchall()
+    if len(rows) == 0:
+        return set()
+    cleaned = dict(rows)
+    clean_subdirs = set()
+    for subdir in set(CATEGORY_SUBDIRS[c] for c in categories):
+        subdir_categories = [c for c in categories if CATEGORY_SUBDIRS[c] == subdir]
+        if not all(c in cleaned for c in subdir_categories):
+            continue
+        mtime = get_dir_mtime(os.path.join(beamdir, subdir))
+        if mtime is not None and all(cleaned[c] == mtime for c in subdir_categories):
+            clean_subdirs.add(subdir)
+
+    return clean_subdirs
+
+
+def record_cleaned(conn, beam_list, categories, failed):
+    """
+    Record beams as cleaned, after a run
+
+    A beam is recorded for a category if none of that category's
+    archiving or deletion targets in the beam failed.
+    The directory mtime is taken now, after all cleanup passes.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the index
+    beam_list : list of (str, int, str)
+        Obsid, beam and path of each beam the run was planned for
+    categories : list (str)
+        Categories that were run
+    failed : set of (str, int, str)
+        Obsid, beam and category with a failed target,
+        or otherwise not cleaned
+
+    Returns
+    -------
+    n_recorded : int
+        Number of obsid / beam / category entries recorded
+    """
+    now = time.time()
+    rows = []
+    for obsid, beam, beamdir in beam_list:
+        mtimes = {}
+        for category in categories:
+            if (obsid, beam, category) in failed:
+                continue
+            subdir = CATEGORY_SUBDIRS[category]
+            if subdir not in mtimes:
+                mtimes[subdir] = get_dir_mtime(os.path.join(beamdir, subdir))
+            if mtimes[subdir] is None:
+                continue
+            rows.append((str(obsid), int(beam), category, now, mtimes[subdir]))
+    conn.executemany("INSERT OR REPLACE INTO cleaned "
+                     "(obsid, beam, category, cleaned_at, dir_mtime) "
+                     "VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+    return len(rows)
+
+
+def invalidate_state(conn, obsid=None, beam=None, category=None):
+    """
+    Remove entries from the index, so they are scanned again
+
+    Without arguments, the whole index is cleared (rebuilt on the next run)
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the index
+    obsid : str (optional)
+        Only remove entries for this obsid
+    beam : int (optional)
+        Only remove entries for this beam
+    category : str (optional)
+        Only remove entries for this category
+
+    Returns
+    -------
+    n_removed : int
+        Number of entries removed
+    """
+    query = "DELETE FROM cleaned"
+    conditions = []
+    values = []
+    if obsid is not None:
+        conditions.append("obsid = ?")
+        values.append(str(obsid))
+    if beam is not None:
+        conditions.append("beam = ?")
+        values.append(int(beam))
+    if category is not None:
+        conditions.append("category = ?")
+        values.append(category)
+    if len(conditions) > 0:
+        query += " WHERE " + " AND ".join(conditions)
+    n_removed = conn.execute(query, values).rowcount
+    conn.commit()
+
+    return n_removed
+
+
+def record_archives(conn, result_list):
+    """
+    Record the digests of archives made in a run
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the index
+    result_list : list of ArchiveResult
+        Archives made; those that failed are ignored
+
+    Returns
+    -------
+    n_recorded : int
+        Number of archives recorded
+    """
+    now = time.time()
+    rows = [(result.path, result.archive, result.format, result.digest,
+             result.nbytes, now)
+            for result in result_list if result.archived is True]
+    conn.executemany("INSERT OR REPLACE INTO archives "
+                     "(path, archive, format, sha256, nbytes, archived_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+    return len(rows)
+
+
+def get_archives(conn):
+    """
+    Get the archives recorded in the index
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the index
+
+    Returns
+    -------
+    archive_list : list of (str, str, str, str, int)
+        Archived directory, archive, format, SHA-256 and size
+    """
+    return conn.execute("SELECT path, archive, format, sha256, nbytes "
+                        "FROM archives ORDER BY path").fetchall()
+
+
+def load_usage_cache(conn, root):
+    """
+    Load the cached usage of the directories under a root
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the index
+    root : str
+        Directory that was walked
+
+    Returns
+    -------
+    cache : dict
+        (mtime_ns, subdirectory names, {uid: [bytes, files]})
+        of each directory, keyed by path
+    """
+    cache = {}
+    for path, mtime, subdirs, totals in conn.execute(
+            "SELECT path, mtime, subdirs, totals FROM usage "
+            "WHERE path = ? OR substr(path, 1, ?) = ?",
+            (root, len(root.rstrip('/')) + 1, root.rstrip('/') + '/')):
+        cache[path] = (mtime, json.loads(subdirs),
+                       dict((int(uid), total) for uid, total in json.loads(totals).items()))
+
+    return cache
+
+
+def save_usage_cache(conn, root, cache):
+    """
+    Replace the cached usage of the directories under a root
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        Connection to the index
+    root : str
+        Directory that was walked
+    cache : dict
+        Usage of each directory, as from load_usage_cache
+
+    Returns
+    -------
+    n_saved : int
+        Number of directories saved
+    """
+    conn.execute("DELETE FROM usage WHERE path = ? OR substr(path, 1, ?) = ?",
+                 (root, len(root.rstrip('/')) + 1, root.rstrip('/') + '/'))
+    conn.executemany("INSERT INTO usage (path, mtime, subdirs, totals) "
+                     "VALUES (?, ?, ?, ?)",
+                     ((path, mtime, json.dumps(subdirs), json.dumps(totals))
+                      for path, (mtime, subdirs, totals) in cache.items()))
+    conn.commit()
+
+    return len(cache)
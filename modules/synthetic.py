@@ -0,0 +1,193 @@
+#Synthetic apertif data for benchmarks
+
+from __future__ import print_function
+
+"""
+Synthetic apertif data for benchmarks
+
+Builds trees with the shape of the real data products
+(many small table files), so cleanup code can be timed
+without touching the happili data.
+"""
+
+import os
+import random
+from modules.paths import get_beam_root, get_data_root
+
+# subtables of a CASA measurement set
+MS_SUBTABLES = ['ANTENNA', 'DATA_DESCRIPTION', 'FEED', 'FIELD', 'FLAG_CMD',
+                'HISTORY', 'OBSERVATION', 'POINTING', 'POLARIZATION',
+                'PROCESSOR', 'SOURCE', 'SPECTRAL_WINDOW', 'STATE']
+# files making up a single CASA table
+TABLE_FILES = ['table.dat', 'table.f0', 'table.f0_TSM0', 'table.f1',
+               'table.info', 'table.lock']
+
+
+def write_file(path, size):
+    """
+    Write a file of a given size, with compressible content
+    """
+    with open(path, 'wb') as f:
+        f.write((b'apertif ' * (size // 8 + 1))[:size])
+
+
+def make_table(path, file_size=4096):
+    """
+    Make a single CASA-like table directory
+
+    Parameters
+    ----------
+    path : str
+        Table directory to create
+    file_size : int
+        Size of each table file in bytes
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in TABLE_FILES:
+        write_file(os.path.join(path, name), file_size)
+
+
+def make_ms_tree(path, file_size=4096, main_file_size=None):
+    """
+    Make a CASA measurement set like tree
+
+    Parameters
+    ----------
+    path : str
+        Measurement set to create, e.g. raw/3C147.MS
+    file_size : int
+        Size of each subtable file in bytes
+    main_file_size : int (optional)
+        Size of each main table file; default is file_size
+    """
+    if main_file_size is None:
+        main_file_size = file_size
+    make_table(path, file_size=main_file_size)
+    for subtable in MS_SUBTABLES:
+        make_table(os.path.join(path, subtable), file_size=file_size)
+
+
+def make_miriad_tree(path, file_size=4096):
+    """
+    Make a MIRIAD dataset like directory (image, model, mask)
+
+    Parameters
+    ----------
+    path : str
+        Dataset to create
+    file_size : int
+        Size of the image file in bytes
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    write_file(os.path.join(path, 'image'), file_size)
+    for name in ['header', 'history', 'mask']:
+        write_file(os.path.join(path, name), 512)
+
+
+def make_beam_tree(beamdir, rng, ncycles=4, nchunks=2, file_size=4096):
+    """
+    Make the data products of a single processed beam
+
+    selfcal has cycles 00 .. (with model / mask datasets),
+    pm and amp; continuum has the multi-frequency and chunk images
+    of several iterations, with only the last images as fits;
+    raw has calibrator measurement sets
+
+    Parameters
+    ----------
+    beamdir : str
+        Beam directory to create, e.g. <root>/data/apertif/190701001/00
+    rng : random.Random
+        Random generator, so trees can be reproduced
+    ncycles : int
+        Maximum number of selfcal / continuum cycles
+    nchunks : int
+        Number of continuum frequency chunks
+    file_size : int
+        Size of the image files in bytes
+    """
+    # selfcal cycles, not every beam got as far
+    n_scal = rng.randint(1, ncycles)
+    for cycle in range(n_scal):
+        cycledir = os.path.join(beamdir, 'selfcal', '{0:02d}'.format(cycle))
+        for minor in range(rng.randint(1, 3)):
+            for kind in ['model', 'mask', 'residual']:
+                make_miriad_tree(os.path.join(cycledir, '{0}_{1:02d}'.format(kind, minor)),
+                                 file_size=file_size)
+        make_miriad_tree(os.path.join(cycledir, 'map_00'), file_size=file_size)
+        make_miriad_tree(os.path.join(cycledir, 'beam_00'), file_size=file_size)
+    if rng.random() < 0.8:
+        pmdir = os.path.join(beamdir, 'selfcal', 'pm')
+        make_miriad_tree(os.path.join(pmdir, 'model_00'), file_size=file_size)
+        make_miriad_tree(os.path.join(pmdir, 'mask_00'), file_size=file_size)
+        write_file(os.path.join(pmdir, 'pm.log'), 512)
+        if rng.random() < 0.6:
+            ampdir = os.path.join(beamdir, 'selfcal', 'amp')
+            for minor in range(rng.randint(1, 2)):
+                make_miriad_tree(os.path.join(ampdir, 'model_{0:02d}'.format(minor)),
+                                 file_size=file_size)
+                make_miriad_tree(os.path.join(ampdir, 'mask_{0:02d}'.format(minor)),
+                                 file_size=file_size)
+    # continuum, multi-frequency and chunk images
+    contdir = os.path.join(beamdir, 'continuum')
+    for label in ['mf'] + ['chunk{}'.format(c) for c in range(nchunks)]:
+        n_cont = rng.randint(1, ncycles)
+        for cycle in range(n_cont):
+            for kind in ['image', 'mask', 'model', 'residual', 'beam', 'map']:
+                make_miriad_tree(os.path.join(contdir, '{0}_{1}_{2:02d}'.format(
+                    kind, label, cycle)), file_size=file_size)
+        write_file(os.path.join(contdir, 'image_{0}_{1:02d}.fits'.format(label, n_cont - 1)),
+                   file_size)
+    # calibrator and target visibilities
+    rawdir = os.path.join(beamdir, 'raw')
+    for name in ['3C147.MS', '3C286.MS', 'target.MS']:
+        make_ms_tree(os.path.join(rawdir, name), file_size=512,
+                     main_file_size=file_size)
+
+
+def make_happili_tree(root, obsids, beams=range(40), mode='happili-01',
+                      seed=1, ncycles=4, nchunks=2, file_size=4096):
+    """
+    Make a synthetic happili data tree
+
+    The layout follows modules.paths, so with set_data_root(root)
+    the cleanup code runs on it unchanged
+
+    Parameters
+    ----------
+    root : str
+        Directory to hold data, data2, data3 and data4
+    obsids : list (str)
+        Obsids to create, e.g. ['190701001']
+    beams : list (int)
+        Beams to create for each obsid; default all 40
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    seed : int
+        Seed of the random layout
+    ncycles : int
+        Maximum number of selfcal / continuum cycles
+    nchunks : int
+        Number of continuum frequency chunks
+    file_size : int
+        Size of the image files in bytes
+
+    Returns
+    -------
+    beam_list : list of (str, int, str)
+        Obsid, beam and path of each beam created
+    """
+    rng = random.Random(seed)
+    beam_list = []
+    for obsid in obsids:
+        for beam in beams:
+            beamdir = os.path.join(root + get_beam_root(beam, mode=mode)[len(get_data_root()):],
+                                   str(obsid), '{0:02d}'.format(beam))
+            make_beam_tree(beamdir, rng, ncycles=ncycles, nchunks=nchunks,
+                           file_size=file_size)
+            beam_list.append((str(obsid), beam, beamdir))
+
+    return beam_list
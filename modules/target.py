@@ -0,0 +1,309 @@
+#Free-space targets for happili cleanup
+
+from __future__ import print_function
+
+"""
+Free-space targets for happili cleanup
+
+When a mount fills up and the pipeline is blocked, the question is not
+which date range to clean but how to get e.g. /data2 below 85% quickly.
+Here the operator gives a target usage per mount. Beams on mounts
+already below their target are not scanned at all; the other beams
+are cleaned oldest obsid first (or largest first) until every mount
+is below its target, checked with os.statvfs as cleanup proceeds.
+Deletions handed out to the executor but not finished yet do not show
+in os.statvfs, so their size is counted as freed already.
+"""
+
+import os
+import time
+from modules.paths import get_mode_roots
+from modules.inventory import iter_inventory, scan_inventory, iter_beams
+from modules.functions import get_obsid_array, get_beam_work_items
+from modules.accounting import get_mount, get_sizes, get_space_report
+from modules.accounting import summarise_report
+from modules.metrics import record_phase
+from modules.state import CATEGORY_SUBDIRS
+
+# orders in which beams are cleaned
+TARGET_ORDERS = ['oldest', 'largest']
+
+
+def parse_mount_targets(mount_targets_str):
+    """
+    Parse per-mount usage targets from the command line
+
+    Parameters
+    ----------
+    mount_targets_str : str
+        Comma separated mount=percentage, e.g. '/data2=85,/data3=90'
+
+    Returns
+    -------
+    mount_targets : dict
+        Target usage (percentage) for each mount point
+    """
+    mount_targets = {}
+    if mount_targets_str is None:
+        return mount_targets
+    for item in mount_targets_str.split(','):
+        if item.strip() == '':
+            continue
+        mount, target = item.rsplit('=', 1)
+        mount_targets[get_mount(mount.strip())] = float(target.rstrip('%'))
+
+    return mount_targets
+
+
+def get_mount_usage(mount):
+    """
+    Get the usage of a mount, as a percentage, as df reports it
+
+    Parameters
+    ----------
+    mount : str
+        Mount point (or any path on it)
+
+    Returns
+    -------
+    usage : float
+        Percentage of the space available to users that is used
+    """
+    st = os.statvfs(mount)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    available = st.f_bavail * st.f_frsize
+    if used + available == 0:
+        return 0.
+
+    return 100. * used / (used + available)
+
+
+def get_bytes_over_target(mount, target):
+    """
+    Get the number of bytes to free to bring a mount to its target
+
+    Parameters
+    ----------
+    mount : str
+        Mount point
+    target : float
+        Target usage, as a percentage
+
+    Returns
+    -------
+    nbytes : int
+        Bytes above the target; zero or negative if below it
+    """
+    st = os.statvfs(mount)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    available = st.f_bavail * st.f_frsize
+
+    return int(used - target / 100. * (used + available))
+
+
+def get_target_beams(mount_targets, mode='happili-01', verbose=True):
+    """
+    Find the beams on mounts that are above their target
+
+    Parameters
+    ----------
+    mount_targets : dict
+        Target usage (percentage) for each mount point
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    verbose : Boolean
+        Print the usage of each mount?
+        Default is True
+
+    Returns
+    -------
+    beam_mounts : dict
+        Mount point of each beam to clean
+    """
+    beam_mounts = {}
+    mount_cache = {}
+    mount_usage = {}
+    for beam_root, beams in get_mode_roots(mode=mode):
+        mount = get_mount(beam_root, mount_cache)
+        if mount not in mount_targets:
+            continue
+        if mount not in mount_usage:
+            mount_usage[mount] = get_mount_usage(mount)
+            if verbose is True:
+                print('{0} at {1:.1f}%, target {2:.1f}%{3}'.format(
+                    mount, mount_usage[mount], mount_targets[mount],
+                    '; skipping' if mount_usage[mount] <= mount_targets[mount] else ''))
+        if mount_usage[mount] <= mount_targets[mount]:
+            continue
+        for b in beams:
+            beam_mounts[b] = mount
+
+    return beam_mounts
+
+
+class PendingBytes(object):
+    """
+    Bytes to be freed by deletions that were handed out, per mount
+
+    A deletion is counted from when it is handed out until its result
+    arrives, after which os.statvfs shows the space it freed. In a
+    practice run nothing is freed and no result is followed, so the
+    deletions stay counted.
+    """
+
+    def __init__(self):
+        self.mount_bytes = {}
+        self.item_bytes = {}
+
+    def add(self, mount, item_list):
+        """
+        Count the deletions of a beam as handed out
+        """
+        path_list = [item.path for item in item_list if item.action == 'delete']
+        self.mount_bytes.setdefault(mount, 0)
+        for path, size in zip(path_list, get_sizes(path_list)):
+            self.item_bytes[path] = (mount, size.nbytes)
+            self.mount_bytes[mount] += size.nbytes
+
+    def get(self, mount):
+        """
+        Get the bytes still to be freed on a mount
+        """
+        return self.mount_bytes.get(mount, 0)
+
+    def iter_results(self, item_result):
+        """
+        Follow a stream of results, no longer counting finished deletions
+
+        Parameters
+        ----------
+        item_result : iterator of (WorkItem, result)
+            Results, e.g. from execute_work_items
+
+        Returns
+        -------
+        item_result : iterator of (WorkItem, result)
+            The same results
+        """
+        for item, result in item_result:
+            if item.action == 'delete' and item.path in self.item_bytes:
+                mount, nbytes = self.item_bytes.pop(item.path)
+                self.mount_bytes[mount] -= nbytes
+            yield item, result
+
+
+def iter_target_work_items(mount_targets, startdate=None, enddate=None,
+                           mode='happili-01', order='oldest', categories=None,
+                           state=None, beam_list=None, verbose=True,
+                           obsid_array=None, manifest=None, admin_list=None,
+                           pending=None):
+    """
+    Stream cleanup work items until every mount is below its target
+
+    Before the items of each beam are handed out, the usage of its mount
+    is checked again, together with the size of the deletions handed out
+    but not finished (see PendingBytes), and beams on mounts that reached
+    their target are skipped. A beam is handed out in full, so a mount
+    may end up below its target by at most the last beam's deletions.
+
+    In a practice run nothing is freed, so the space freed is projected
+    from the size of the deletion targets instead.
+
+    Parameters
+    ----------
+    mount_targets : dict
+        Target usage (percentage) for each mount point
+    startdate : str (optional)
+         Optional startdate in YYMMDD format
+    enddate : str (optional)
+         Optional enddate in YYMMDD format
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    order : str
+        'oldest' cleans beams in obsid order, scanning them as needed;
+        'largest' scans all beams first and cleans the
+        beams with most reclaimable space first
+    categories : list (str) (optional)
+        Cleanup categories; default is all categories
+    state : sqlite3.Connection (optional)
+        Cleanup state index, used when scanning
+    beam_list : list (optional)
+        Each beam is appended as (obsid, beam, path) when it is planned
+    verbose : Boolean
+        Print when a mount reaches its target?
+        Default is True
+    obsid_array : array (optional)
+        Obsids from get_obsid_array, e.g. for several date ranges;
+        found from startdate and enddate if not given
+    manifest : Manifest (optional)
+        Manifests (modules.manifest); obsids it does not allow are not
+        scanned, and its policies limit the categories of an obsid
+    admin_list : list (optional)
+        Targets that need an admin are appended as AdminTarget
+    pending : PendingBytes (optional)
+        Deletions handed out; in a real run, the results of the items
+        must be passed through pending.iter_results. Without it, the
+        deletions handed out stay counted until the end
+
+    Returns
+    -------
+    item : iterator of WorkItem
+        Work items, in the requested order
+    """
+    if order not in TARGET_ORDERS:
+        raise ValueError('Unknown order {0}; use one of {1}'.format(
+            order, ', '.join(TARGET_ORDERS)))
+    beam_mounts = get_target_beams(mount_targets, mode=mode, verbose=verbose)
+    if len(beam_mounts) == 0:
+        return
+    if obsid_array is None:
+        obsid_array = get_obsid_array(startdate=startdate, enddate=enddate,
+                                      manifest=manifest)
+    beams = sorted(beam_mounts)
+
+    if order == 'oldest':
+        beam_iter = iter_inventory(obsid_array, mode=mode, state=state,
+                                   categories=categories, beams=beams)
+    else:
+        inventory = scan_inventory(obsid_array, mode=mode, state=state,
+                                   categories=categories, beams=beams)
+        summary = summarise_report(get_space_report(inventory, categories=categories),
+                                   level='beam')
+        beam_size = dict((key, sum(totals.values())) for key, totals in summary.items())
+        beam_iter = sorted(iter_beams(inventory), key=lambda beam_inv: -beam_size.get(
+            '{0}/{1:02d}'.format(beam_inv['obsid'], beam_inv['beam']), 0))
+
+    if pending is None:
+        pending = PendingBytes()
+    # mounts still above target
+    active = sorted(set(beam_mounts.values()))
+    for beam_inv in beam_iter:
+        mount = beam_mounts[beam_inv['beam']]
+        if mount not in active:
+            continue
+        if get_bytes_over_target(mount, mount_targets[mount]) - pending.get(mount) <= 0:
+            if verbose is True:
+                print('{0} reached target of {1:.1f}%'.format(mount, mount_targets[mount]))
+            active.remove(mount)
+            if len(active) == 0:
+                return
+            continue
+        start = time.time()
+        beam_categories = categories
+        if manifest is not None:
+            beam_categories = manifest.get_categories(
+                beam_inv['obsid'], categories or list(CATEGORY_SUBDIRS))
+        item_list = get_beam_work_items(beam_inv, categories=beam_categories,
+                                        admin_list=admin_list)
+        record_phase('plan', start, time.time(), items=len(item_list), mount=mount)
+        if beam_list is not None:
+            beam_list.append((beam_inv['obsid'], beam_inv['beam'], beam_inv['path']))
+        pending.add(mount, item_list)
+        for item in item_list:
+            yield item
+    if verbose is True:
+        for mount in active:
+            print('{0} still above target of {1:.1f}% after planning all beams'.format(
+                mount, mount_targets[mount]))
@@ -0,0 +1,360 @@
+#I/O rate limiting for happili cleanup
+
+from __future__ import print_function
+
+"""
+I/O rate limiting for happili cleanup
+
+Cleanup shares disks and NFS links with running Apercal reductions.
+Every deletion and archive operation can be limited per mount by
+token buckets: one for bytes per second (data read for archives) and
+one for metadata operations per second (unlink / rmdir for deletions,
+each member of an archive). Deleting does not move data, so deletions
+only take metadata tokens.
+
+With a latency threshold, the limits adapt: when a metadata operation
+takes longer than the threshold, the rates are halved (at most once a
+second), and they recover step by step while latency stays low.
+
+The limits are set per process with configure_throttle; setting them
+again changes the limits in use, also for operations already running.
+While archives are made, the archive processes split the bytes of a
+mount between them and take ARCHIVE_OPS_SHARE of its metadata
+operations; the deletions in the main process keep the rest.
+"""
+
+import threading
+import time
+from modules.paths import get_mount
+
+# lower limit of the adaptive rate, as a fraction of the configured rate
+MIN_FACTOR = 0.05
+# step in which the adaptive rate recovers, and the time between changes
+RECOVER_STEP = 0.05
+ADAPT_INTERVAL = 1.
+# fraction of the metadata operations of a mount for the archive processes
+# together; deletions are almost only metadata operations, archives few
+ARCHIVE_OPS_SHARE = 0.2
+
+_config = None
+_throttles = {}
+_mount_cache = {}
+_lock = threading.Lock()
+
+
+def parse_rate(rate_str):
+    """
+    Parse a rate from the command line, with an optional K, M or G suffix
+
+    Parameters
+    ----------
+    rate_str : str
+        Rate, e.g. '50M' or '2000'
+
+    Returns
+    -------
+    rate : float or None
+        Rate per second; None if rate_str is None or empty
+    """
+    if rate_str is None or rate_str.strip() == '':
+        return None
+    rate_str = rate_str.strip().upper()
+    scale = 1.
+    for suffix, factor in [('K', 1024.), ('M', 1024. ** 2), ('G', 1024. ** 3)]:
+        if rate_str.endswith(suffix):
+            rate_str = rate_str[:-1]
+            scale = factor
+    return float(rate_str) * scale
+
+
+def parse_mount_rates(mount_rates_str):
+    """
+    Parse per-mount rates from the command line
+
+    Parameters
+    ----------
+    mount_rates_str : str
+        Comma separated mount=bytes_rate[:ops_rate],
+        e.g. '/data2=20M:500,/data3=50M'
+
+    Returns
+    -------
+    mount_rates : dict
+        (bytes_rate, ops_rate) for each mount; None where not limited
+    """
+    mount_rates = {}
+    if mount_rates_str is None:
+        return mount_rates
+    for item in mount_rates_str.split(','):
+        if item.strip() == '':
+            continue
+        mount, rates = item.rsplit('=', 1)
+        rates = rates.split(':')
+        ops_rate = parse_rate(rates[1]) if len(rates) > 1 else None
+        mount_rates[mount.strip()] = (parse_rate(rates[0]), ops_rate)
+
+    return mount_rates
+
+
+class TokenBucket(object):
+    """
+    Token bucket, shared by threads
+
+    Taking more tokens than are available leaves the bucket in debt,
+    and the caller sleeps until the debt would be paid off,
+    so large requests (a whole block of data) are allowed
+    but the average rate is kept.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.base_rate = float(rate)
+        self.factor = 1.
+        self.rate = self.base_rate
+        # default burst of one second
+        self.burst = float(burst) if burst is not None else self.base_rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        """
+        Take n tokens, sleeping as needed
+
+        Returns
+        -------
+        wait : float
+            Seconds slept
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def set_factor(self, factor):
+        with self.lock:
+            self.factor = factor
+            self.rate = self.base_rate * factor
+
+    def set_rate(self, rate):
+        """
+        Change the rate, keeping the tokens gathered at the old rate
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.base_rate = float(rate)
+            self.rate = self.base_rate * self.factor
+            self.burst = self.base_rate
+            self.tokens = min(self.burst, self.tokens)
+
+
+class MountThrottle(object):
+    """
+    Limits of a single mount: bytes and metadata operations per second,
+    optionally adapting to the latency of metadata operations
+    """
+
+    def __init__(self, bytes_rate=None, ops_rate=None, latency=None):
+        self.bytes = TokenBucket(bytes_rate) if bytes_rate else None
+        self.ops = TokenBucket(ops_rate) if ops_rate else None
+        self.latency = latency
+        self.factor = 1.
+        self.changed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire_bytes(self, nbytes):
+        bucket = self.bytes
+        if bucket is not None and nbytes > 0:
+            bucket.acquire(nbytes)
+
+    def acquire_op(self):
+        bucket = self.ops
+        if bucket is not None:
+            bucket.acquire(1)
+
+    def set_rates(self, bytes_rate=None, ops_rate=None, latency=None):
+        """
+        Change the limits, in place for the threads that hold this throttle
+        """
+        with self.lock:
+            self.latency = latency
+            for name, rate in [('bytes', bytes_rate), ('ops', ops_rate)]:
+                bucket = getattr(self, name)
+                if not rate:
+                    setattr(self, name, None)
+                elif bucket is None:
+                    bucket = TokenBucket(rate)
+                    bucket.set_factor(self.factor)
+                    setattr(self, name, bucket)
+                else:
+                    bucket.set_rate(rate)
+
+    def observe(self, seconds):
+        """
+        Adapt the limits to the latency of a metadata operation
+        """
+        if self.latency is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.changed < ADAPT_INTERVAL:
+                return
+            if seconds > self.latency:
+                factor = max(MIN_FACTOR, self.factor * 0.5)
+            else:
+                factor = min(1., self.factor + RECOVER_STEP)
+            if factor == self.factor:
+                return
+            self.factor = factor
+            self.changed = now
+        for bucket in [self.bytes, self.ops]:
+            if bucket is not None:
+                bucket.set_factor(factor)
+
+
+def configure_throttle(bytes_rate=None, ops_rate=None, mount_rates=None,
+                       latency=None, bytes_share=1., ops_share=1.):
+    """
+    Set the I/O limits of this process
+
+    Throttles already handed out by get_throttle take the new limits.
+
+    Parameters
+    ----------
+    bytes_rate : float (optional)
+        Bytes per second per mount; None for no limit
+    ops_rate : float (optional)
+        Metadata operations per second per mount; None for no limit
+    mount_rates : dict (optional)
+        (bytes_rate, ops_rate) for specific mounts, overriding the defaults
+    latency : float (optional)
+        Latency (seconds) of a metadata operation above which the
+        limits back off; None for fixed limits
+    bytes_share : float
+        Fraction of the bytes per second of a mount for this process
+    ops_share : float
+        Fraction of the metadata operations per second of a mount
+        for this process
+    """
+    global _config
+    with _lock:
+        resolved = {}
+        for mount, rates in (mount_rates or {}).items():
+            resolved[get_mount(mount, _mount_cache)] = rates
+        if bytes_rate is None and ops_rate is None and len(resolved) == 0:
+            _config = None
+        else:
+            _config = {'bytes_rate': bytes_rate, 'ops_rate': ops_rate,
+                       'mount_rates': resolved, 'latency': latency,
+                       'bytes_share': bytes_share, 'ops_share': ops_share}
+        for mount, throttle in list(_throttles.items()):
+            if throttle is None:
+                # not limited before; looked up again when next used
+                del _throttles[mount]
+            elif _config is None:
+                throttle.set_rates()
+            else:
+                throttle.set_rates(*_get_rates(mount), latency=latency)
+
+
+def get_throttle_config():
+    """
+    Get the limits of this process, as arguments for configure_throttle
+
+    Returns
+    -------
+    config : dict or None
+        Keyword arguments for configure_throttle; None without limits
+    """
+    with _lock:
+        if _config is None:
+            return None
+        return dict(_config)
+
+
+def configure_throttle_share(config, bytes_share=1., ops_share=1.):
+    """
+    Set the limits of this process as a share of the limits in config,
+    e.g. those of the main process in a worker process
+    """
+    if config is None:
+        return
+    config = dict(config)
+    config['bytes_share'] *= bytes_share
+    config['ops_share'] *= ops_share
+    configure_throttle(**config)
+
+
+def _get_rates(mount):
+    """
+    Get the bytes and metadata operations per second of a mount;
+    called with _lock held
+    """
+    bytes_rate, ops_rate = _config['mount_rates'].get(
+        mount, (_config['bytes_rate'], _config['ops_rate']))
+
+    return (bytes_rate * _config['bytes_share'] if bytes_rate else None,
+            ops_rate * _config['ops_share'] if ops_rate else None)
+
+
+def get_throttle(path):
+    """
+    Get the limits for the mount a path is on
+
+    Parameters
+    ----------
+    path : str
+        Path to be deleted or archived
+
+    Returns
+    -------
+    throttle : MountThrottle or None
+        Limits of the mount; None if not limited
+    """
+    if _config is None:
+        return None
+    with _lock:
+        mount = get_mount(path, _mount_cache)
+        if mount not in _throttles:
+            bytes_rate, ops_rate = _get_rates(mount)
+            if bytes_rate is None and ops_rate is None:
+                _throttles[mount] = None
+            else:
+                _throttles[mount] = MountThrottle(bytes_rate, ops_rate,
+                                                  latency=_config['latency'])
+        return _throttles[mount]
+
+
+def throttled_op(throttle, function, *args, **kwargs):
+    """
+    Run a metadata operation within the limits, observing its latency
+    """
+    if throttle is None:
+        return function(*args, **kwargs)
+    throttle.acquire_op()
+    start = time.monotonic()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        throttle.observe(time.monotonic() - start)
+
+
+class ThrottledReader(object):
+    """
+    Read-only file object taking byte tokens for what is read
+    """
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.acquire_bytes(len(data))
+        return data
@@ -0,0 +1,311 @@
+#Rename-then-reap deletion for happili cleanup
+
+from __future__ import print_function
+
+"""
+Rename-then-reap deletion for happili cleanup
+
+Removing a large calibrator MS or selfcal cycle over NFS takes minutes,
+and the whole run waits for it. Instead, a target can be renamed into
+the .trash directory at the top of its data directory (e.g. /data2/.trash
+for /data2/apertif/...), on the same filesystem. That is a single
+metadata operation, after which the target is gone from the Apercal
+layout. A target that cannot be moved there (another filesystem, no
+trash directory) is deleted in place.
+
+The trash is emptied by a reaper, a separate process started when a run
+finishes, with a few workers per trash directory and its own metadata
+rate limit, so the space drains at a gentle pace after the run. Only one
+reaper works on a trash directory at a time (a lock file in it). Anything
+left in the trash, e.g. after a reboot, is removed by the next reaper,
+including targets that were partly removed.
+"""
+
+import argparse
+import errno
+import fcntl
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from modules.paths import get_data_root, get_mode_roots
+from modules.deletion import remove_tree, delete_target, DeleteResult
+from modules.throttle import configure_throttle, get_throttle, throttled_op
+from modules.metrics import record_phase, get_path_mount, print_metrics
+
+TRASH_NAME = '.trash'
+LOCK_NAME = '.reaper.lock'
+LOG_NAME = '.reaper.log'
+# parallel removals per trash directory
+DEFAULT_REAP_WORKERS = 2
+# metadata operations per second per mount for the reaper
+DEFAULT_REAP_RATE = 1000.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_counter = itertools.count()
+_trash_ready = set()
+_lock = threading.Lock()
+
+
+def get_trash_dir(path):
+    """
+    Get the trash directory for a target: .trash in the top directory
+    holding it, e.g. /data2/.trash for /data2/apertif/...
+    """
+    root = get_data_root()
+    path = os.path.abspath(path)
+    if root != '' and path.startswith(root + '/'):
+        path = path[len(root):]
+    top = path.lstrip('/').split('/')[0]
+
+    return '{0}/{1}/{2}'.format(root, top, TRASH_NAME)
+
+
+def get_trash_dirs(mode='happili-01'):
+    """
+    Get the trash directories used in a running mode
+
+    Parameters
+    ----------
+    mode : string
+        Running mode - happili-01, happili-05 or local
+        Default is happili-01
+
+    Returns
+    -------
+    trash_list : list (str)
+        Trash directory of each data directory, in beam order
+    """
+    trash_list = []
+    for beam_root, beams in get_mode_roots(mode=mode):
+        trash = get_trash_dir(beam_root)
+        if trash not in trash_list:
+            trash_list.append(trash)
+
+    return trash_list
+
+
+def _make_trash_dir(trash):
+    with _lock:
+        if trash in _trash_ready:
+            return
+    os.makedirs(trash, exist_ok=True)
+    with _lock:
+        _trash_ready.add(trash)
+
+
+def trash_target(path, device=None, verbose=True, inode_order=None):
+    """
+    Move a single target into the trash, or delete it in place if
+    it cannot be moved
+
+    Parameters
+    ----------
+    path : str
+        Target to delete
+    device : int (optional)
+        Device of the target, recorded in the result
+    verbose : Boolean
+        Print a record of what is moved?
+        Default is True
+    inode_order : Boolean (optional)
+        Remove entries in inode order, if the target is deleted in place
+
+    Returns
+    -------
+    result : DeleteResult
+        Outcome; bytes and files are counted by the reaper, not here
+    """
+    trash = get_trash_dir(path)
+    name = '{0:d}-{1:d}-{2:d}-{3}'.format(int(time.time()), os.getpid(),
+                                          next(_counter), os.path.basename(path))
+    try:
+        _make_trash_dir(trash)
+        throttled_op(get_throttle(path), os.rename, path, os.path.join(trash, name))
+    except OSError as e:
+        if e.errno in (errno.EXDEV, errno.EACCES, errno.EPERM, errno.EROFS) and \
+                os.path.lexists(path):
+            # no usable trash on this filesystem
+            return delete_target(path, device=device, verbose=verbose,
+                                 inode_order=inode_order)
+        if verbose is True and e.errno != errno.ENOENT:
+            print('Unable to delete {0} ({1})'.format(path, e))
+        return DeleteResult(path, device, False, str(e), 0, 0,
+                            {errno.errorcode.get(e.errno, str(e.errno)): 1})
+    if verbose is True:
+        print('Moving {0} to {1}'.format(path, trash))
+
+    return DeleteResult(path, device, True, None, 0, 0, {})
+
+
+def list_trash(trash):
+    """
+    List the entries waiting in a trash directory
+    """
+    try:
+        return sorted(name for name in os.listdir(trash) if not name.startswith('.'))
+    except OSError:
+        return []
+
+
+def reap_trash(trash, workers=DEFAULT_REAP_WORKERS, verbose=True):
+    """
+    Empty a trash directory, unless another reaper is working on it
+
+    New entries are picked up until the trash is empty, or until only
+    entries that failed to be removed are left
+
+    Parameters
+    ----------
+    trash : str
+        Trash directory
+    workers : int
+        Number of parallel removals
+    verbose : Boolean
+        Print a record of what is removed?
+        Default is True
+
+    Returns
+    -------
+    result : (int, int, list (str)) or None
+        Entries removed, bytes freed and entries that could not be
+        removed; None if another reaper holds the trash
+    """
+    try:
+        lock = open(os.path.join(trash, LOCK_NAME), 'a')
+    except OSError:
+        return 0, 0, list_trash(trash)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    n_reaped = 0
+    nbytes = 0
+    failed = set()
+    mount = get_path_mount(trash)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            while True:
+                name_list = [name for name in list_trash(trash) if name not in failed]
+                if len(name_list) == 0:
+                    break
+                path_list = [os.path.join(trash, name) for name in name_list]
+                start = time.time()
+                result_list = list(pool.map(remove_tree, path_list))
+                errors = 0
+                for name, result in zip(name_list, result_list):
+                    nbytes += result.nbytes
+                    errors += sum(result.errors.values())
+                    if result.deleted is True:
+                        n_reaped += 1
+                    else:
+                        failed.add(name)
+                        if verbose is True:
+                            print('Unable to remove {0} ({1})'.format(result.path,
+                                                                      result.error))
+                record_phase('reap', start, time.time(), items=len(result_list),
+                             nbytes=sum(r.nbytes for r in result_list),
+                             errors=errors, mount=mount)
+                if verbose is True:
+                    print('{0}: removed {1} of {2} entries'.format(
+                        trash, len(result_list) - len(failed & set(name_list)),
+                        len(result_list)))
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+    return n_reaped, nbytes, sorted(failed)
+
+
+def start_reaper(trash_list, workers=DEFAULT_REAP_WORKERS, ops_rate=DEFAULT_REAP_RATE):
+    """
+    Start a reaper process for the trash directories that hold anything
+
+    The reaper runs in its own session, so it carries on when the
+    run (or screen, or ssh session) that started it ends; it logs
+    to .reaper.log in the first trash directory
+
+    Parameters
+    ----------
+    trash_list : list (str)
+        Trash directories
+    workers : int
+        Number of parallel removals per trash directory
+    ops_rate : float (optional)
+        Metadata operations per second per mount; None for no limit
+
+    Returns
+    -------
+    process : subprocess.Popen or None
+        Reaper process; None if all trash directories are empty
+    """
+    trash_list = [trash for trash in trash_list if len(list_trash(trash)) > 0]
+    if len(trash_list) == 0:
+        return None
+    command = [sys.executable, '-m', 'modules.trash', '--workers', str(workers)]
+    if ops_rate is not None:
+        command += ['--ops_rate', str(ops_rate)]
+    with open(os.path.join(trash_list[0], LOG_NAME), 'a') as log:
+        process = subprocess.Popen(command + trash_list, cwd=REPO_DIR,
+                                   stdin=subprocess.DEVNULL, stdout=log,
+                                   stderr=subprocess.STDOUT, start_new_session=True)
+
+    return process
+
+
+def reap(trash_list, workers=DEFAULT_REAP_WORKERS, verbose=True):
+    """
+    Empty trash directories in parallel, one thread per directory
+
+    Returns
+    -------
+    results : dict
+        Result of reap_trash for each trash directory
+    """
+    results = {}
+
+    def reap_one(trash):
+        results[trash] = reap_trash(trash, workers=workers, verbose=verbose)
+
+    threads = [threading.Thread(target=reap_one, args=(trash,)) for trash in trash_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if verbose is True:
+        for trash in trash_list:
+            if results[trash] is None:
+                print('{}: another reaper is working on it'.format(trash))
+            else:
+                n_reaped, nbytes, failed = results[trash]
+                print('{0}: reaped {1} entries, {2} bytes; {3} left'.format(
+                    trash, n_reaped, nbytes, len(failed)))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Empty happili cleanup trash directories')
+    parser.add_argument("trash", nargs='+', help='Trash directories')
+    parser.add_argument("--workers", default=DEFAULT_REAP_WORKERS, type=int,
+                        help='Parallel removals per trash directory')
+    parser.add_argument("--ops_rate", default=None, type=float,
+                        help='Metadata operations per second per mount')
+    args = parser.parse_args()
+
+    configure_throttle(ops_rate=args.ops_rate)
+    print('{0} reaper {1} started on {2}'.format(
+        time.strftime('%Y-%m-%d %H:%M:%S'), os.getpid(), ', '.join(args.trash)))
+    sys.stdout.flush()
+    reap(args.trash, workers=args.workers)
+    print_metrics()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+#Per-user disk usage for happili
+
+from __future__ import print_function
+
+"""
+Per-user disk usage for happili
+
+Finding out who owns the space on happili meant running du for hours.
+Here the apertif directories on all /data* mounts are walked with a
+pool of os.scandir threads, adding up the disk usage and file count
+per owner (uid), per obsid and per category (the subdirectory of the
+beam: raw, selfcal, continuum, ...).
+
+The totals of each directory are cached in the state index, together
+with its mtime. On the next run, a directory with the same mtime is not
+listed again; only its subdirectories are checked. Files that change
+size in place do not change the mtime of their directory, so a full
+walk (refresh) is still needed from time to time.
+"""
+
+import csv
+import os
+import re
+import threading
+import time
+import queue
+from modules.paths import get_mode_roots, get_mount
+from modules.deletion import get_disk_usage
+from modules.accounting import format_bytes, DEFAULT_WALK_WORKERS
+from modules.metrics import record_phase
+from modules.state import load_usage_cache, save_usage_cache
+from modules.preflight import get_user_name
+
+# levels of the usage report
+USAGE_LEVELS = ['user', 'obsid', 'category']
+
+_obsid_pattern = re.compile(r'[1-2][0-9][0-1][0-9][0-3][0-9][0-9]{3}$')
+
+
+def walk_usage(root, cache=None, workers=DEFAULT_WALK_WORKERS):
+    """
+    Find the usage per owner of every directory under a root
+
+    Parameters
+    ----------
+    root : str
+        Directory to walk, e.g. /data2/apertif
+    cache : dict (optional)
+        Usage of each directory from a previous walk (load_usage_cache);
+        directories with an unchanged mtime are not listed again
+    workers : int
+        Number of walker threads
+        Default is DEFAULT_WALK_WORKERS
+
+    Returns
+    -------
+    usage : dict
+        (mtime_ns, subdirectory names, {uid: [bytes, files]})
+        of each directory, keyed by path; entries in a directory
+        (including its subdirectories) count towards that directory
+    n_listed : int
+        Number of directories listed, rather than taken from the cache
+    """
+    if cache is None:
+        cache = {}
+    usage = {}
+    n_listed = [0]
+    lock = threading.Lock()
+    work = queue.Queue()
+
+    def list_dir(path):
+        subdirs = []
+        totals = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                total = totals.setdefault(st.st_uid, [0, 0])
+                total[0] += get_disk_usage(st)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    work.put((entry.path, st.st_mtime_ns))
+                else:
+                    total[1] += 1
+        return subdirs, totals
+
+    def walk():
+        while True:
+            item = work.get()
+            if item is None:
+                work.task_done()
+                return
+            path, mtime = item
+            try:
+                cached = cache.get(path)
+                if cached is not None and cached[0] == mtime:
+                    subdirs, totals = cached[1], cached[2]
+                    for name in subdirs:
+                        subdir = os.path.join(path, name)
+                        try:
+                            work.put((subdir, os.lstat(subdir).st_mtime_ns))
+                        except OSError:
+                            pass
+                else:
+                    subdirs, totals = list_dir(path)
+                    with lock:
+                        n_listed[0] += 1
+                with lock:
+                    usage[path] = (mtime, subdirs, totals)
+            except OSError:
+                pass
+            work.task_done()
+
+    try:
+        work.put((root, os.lstat(root).st_mtime_ns))
+    except OSError:
+        return usage, 0
+    threads = [threading.Thread(target=walk) for i in range(max(1, workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    work.join()
+    for thread in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+
+    return usage, n_listed[0]
+
+
+def get_path_keys(root, path):
+    """
+    Find the obsid and category of a directory under an apertif root
+
+    Returns
+    -------
+    obsid : str
+        Obsid, or '-' outside obsid directories
+    category : str
+        Subdirectory of the beam (raw, selfcal, ...); 'other'
+        for anything not in a beam subdirectory
+    """
+    parts = os.path.relpath(path, root).split(os.sep)
+    if _obsid_pattern.match(parts[0]) is None:
+        return '-', 'other'
+    if len(parts) >= 3 and parts[1].isdigit():
+        return parts[0], parts[2]
+
+    return parts[0], 'other'
+
+
+def get_usage_report(mode='happili-01', state=None, refresh=False,
+                     workers=DEFAULT_WALK_WORKERS, verbose=True):
+    """
+    Find the disk usage per owner, obsid and category
+
+    Parameters
+    ----------
+    mode : string
+        Running mode - happili-01 or happili-05
+        Default is happili-01
+    state : sqlite3.Connection (optional)
+        State index holding the cache of directory totals;
+        without it, everything is walked
+    refresh : Boolean
+        Walk everything, and replace the cache
+        Default is False
+    workers : int
+        Number of walker threads
+    verbose : Boolean
+        Print how much of each root was listed?
+        Default is True
+
+    Returns
+    -------
+    rows : list of (int, str, str, str, int, int)
+        uid, mount, obsid, category, bytes and files
+    """
+    totals = {}
+    mount_cache = {}
+    roots = []
+    for beam_root, beams in get_mode_roots(mode=mode):
+        if beam_root not in roots:
+            roots.append(beam_root)
+    for root in roots:
+        start = time.time()
+        cache = None
+        if state is not None and refresh is not True:
+            cache = load_usage_cache(state, root)
+        usage, n_listed = walk_usage(root, cache=cache, workers=workers)
+        if state is not None:
+            save_usage_cache(state, root, usage)
+        mount = get_mount(root, mount_cache)
+        nbytes = 0
+        for path, (mtime, subdirs, dir_totals) in usage.items():
+            obsid, category = get_path_keys(root, path)
+            for uid, total in dir_totals.items():
+                key = (uid, mount, obsid, category)
+                if key not in totals:
+                    totals[key] = [0, 0]
+                totals[key][0] += total[0]
+                totals[key][1] += total[1]
+                nbytes += total[0]
+        record_phase('usage', start, time.time(), items=len(usage), nbytes=nbytes,
+                     mount=mount)
+        if verbose is True:
+            print('{0}: {1} directories, {2} listed, {3} from cache'.format(
+                root, len(usage), n_listed, len(usage) - n_listed))
+
+    rows = [key + tuple(total) for key, total in sorted(totals.items())]
+
+    return rows
+
+
+def summarise_usage(rows, level='user'):
+    """
+    Sum usage per user, and per obsid or category of each user
+
+    Parameters
+    ----------
+    rows : list
+        Rows from get_usage_report
+    level : str
+        One of user, obsid, category
+
+    Returns
+    -------
+    summary : list of (str, str, int, int)
+        User, obsid / category ('' for level user), bytes and files,
+        largest first
+    """
+    names = {}
+    totals = {}
+    for uid, mount, obsid, category, nbytes, nfiles in rows:
+        if level == 'user':
+            key = (get_user_name(uid, names), '')
+        elif level == 'obsid':
+            key = (get_user_name(uid, names), obsid)
+        else:
+            key = (get_user_name(uid, names), category)
+        if key not in totals:
+            totals[key] = [0, 0]
+        totals[key][0] += nbytes
+        totals[key][1] += nfiles
+
+    return sorted((key + tuple(total) for key, total in totals.items()),
+                  key=lambda row: (-row[2], row[0], row[1]))
+
+
+def print_usage_report(rows, levels=('user',), top=None):
+    """
+    Print ranked disk usage
+
+    Parameters
+    ----------
+    rows : list
+        Rows from get_usage_report
+    levels : list (str)
+        Levels to print, from user, obsid and category
+    top : int (optional)
+        Only print this many lines per level
+    """
+    for level in levels:
+        summary = summarise_usage(rows, level=level)
+        print('')
+        print('{0:>5} {1:<16}{2:<16}{3:>10}{4:>12}'.format(
+            'rank', 'user', '' if level == 'user' else level, 'size', 'files'))
+        for rank, (user, key, nbytes, nfiles) in enumerate(summary[:top]):
+            print('{0:>5} {1:<16}{2:<16}{3:>10}{4:>12d}'.format(
+                rank + 1, user, key, format_bytes(nbytes), nfiles))
+
+
+def write_usage_csv(path, rows):
+    """
+    Write the disk usage as CSV, one line per user, mount, obsid and category
+    """
+    names = {}
+    with open(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['uid', 'user', 'mount', 'obsid', 'category', 'bytes', 'files'])
+        for uid, mount, obsid, category, nbytes, nfiles in rows:
+            writer.writerow([uid, get_user_name(uid, names), mount, obsid, category,
+                             nbytes, nfiles])
@@ -0,0 +1,460 @@
+#Watching for finished beams on happili
+
+from __future__ import print_function
+
+"""
+Watching for finished beams on happili
+
+Rather than cleaning in a large sweep every few months, a long-running
+watcher cleans each beam once its processing is finished. New obsid and
+beam directories are noticed with Linux inotify (through ctypes), and
+write activity in the upper levels of each pending beam is followed.
+A beam is finished once its continuum image (continuum/image_*.fits)
+exists and nothing in its tree has been written for a quiet period;
+it is then cleaned with the same rules as the batch cleanup.
+
+inotify only sees changes made on the local machine, not those made
+over NFS by other nodes, so in happili-01 layout a watcher runs on each
+node for the beams on its own disk (local mode).
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import select
+import struct
+import time
+from modules.paths import get_mode_roots
+from modules.inventory import scan_beam, scan_directory, match_names
+from modules.state import get_clean_subdirs, record_cleaned, record_archives
+from modules.functions import get_beam_work_items
+from modules.executor import execute_work_items
+from modules.plan import get_status
+from modules.metrics import record_phase, get_path_mount
+from modules.preflight import get_admin_failed, print_admin_report
+from modules.trash import get_trash_dirs, start_reaper
+
+# inotify event flags, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# events on data roots and obsid directories: new directories
+NEW_DIR_MASK = IN_CREATE | IN_MOVED_TO | IN_ONLYDIR
+# events within a beam: any write activity
+ACTIVITY_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+                 IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+# levels of a beam tree that are watched (beam, selfcal, selfcal/00)
+WATCH_DEPTH = 2
+
+# file showing that processing of a beam got to the end
+READY_PATTERN = 'image_*.fits'
+# default quiet period, in seconds
+DEFAULT_QUIET_PERIOD = 3600.
+# seconds between readiness checks of a single beam
+CHECK_INTERVAL = 300.
+
+_event_header = struct.Struct('iIII')
+_obsid_pattern = re.compile(r'[1-2][0-9][0-1][0-9][0-3][0-9][0-9]{3}$')
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+class Inotify(object):
+    """
+    Minimal inotify instance, through ctypes
+    """
+
+    def __init__(self):
+        libc = _get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, 'inotify_init1: ' + os.strerror(e))
+
+    def add_watch(self, path, mask):
+        """
+        Watch a directory
+
+        Returns
+        -------
+        wd : int
+            Watch descriptor
+        """
+        wd = _get_libc().inotify_add_watch(self.fd, os.fsencode(path),
+                                           ctypes.c_uint32(mask))
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        _get_libc().inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """
+        Wait for events, for at most timeout seconds
+
+        Returns
+        -------
+        event_list : list of (int, int, str)
+            Watch descriptor, event flags and name of each event
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if len(readable) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        event_list = []
+        offset = 0
+        while offset + _event_header.size <= len(data):
+            wd, mask, cookie, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            event_list.append((wd, mask, name))
+        return event_list
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_newest_mtime(path):
+    """
+    Find the latest modification time in a directory tree
+
+    Symbolic links are not followed.
+
+    Returns
+    -------
+    mtime : float
+        Latest mtime of any file or directory; 0 if it cannot be read
+    """
+    newest = 0.
+    stack = [path]
+    while len(stack) > 0:
+        top = stack.pop()
+        try:
+            newest = max(newest, os.lstat(top).st_mtime)
+            with os.scandir(top) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+
+    return newest
+
+
+def is_beam_ready(beamdir, quiet_period, now=None):
+    """
+    Check whether the processing of a beam has finished
+
+    Parameters
+    ----------
+    beamdir : str
+        path to obsid / beam
+    quiet_period : float
+        Seconds without any write in the beam tree
+    now : float (optional)
+        Current time
+
+    Returns
+    -------
+    ready : Boolean
+        Whether the continuum image exists and the tree is quiet
+    newest : float or None
+        Latest mtime in the tree; None if there is no continuum image yet
+    """
+    if now is None:
+        now = time.time()
+    if len(match_names(scan_directory(os.path.join(beamdir, 'continuum')),
+                       READY_PATTERN)) == 0:
+        return False, None
+    newest = get_newest_mtime(beamdir)
+
+    return newest < now - quiet_period, newest
+
+
+def clean_beam(obsid, beam, beamdir, categories=None, state=None, run=False,
+               verbose=True, manifest=None, admin_list=None, **execute_kwargs):
+    """
+    Clean a single finished beam, as a batch run would
+
+    Parameters
+    ----------
+    obsid : str
+        Obsid provided as a string
+    beam : int
+        beam provided as an int
+    beamdir : str
+        path to obsid / beam
+    categories : list (str) (optional)
+        Cleanup categories; default is all categories
+    state : sqlite3.Connection (optional)
+        Cleanup state index, used when scanning and updated after cleaning
+    run : Boolean
+        Whether to actually run deletion
+        Default is False
+    verbose : Boolean
+        Print what is cleaned?
+        Default is True
+    manifest : Manifest (optional)
+        Manifests whose policies limit the categories of the obsid
+    admin_list : list (optional)
+        Targets that need an admin are appended as AdminTarget
+    execute_kwargs :
+        Further arguments for execute_work_items (workers, archive format, ...)
+
+    Returns
+    -------
+    n_items : int
+        Number of work items
+    failed : set of (str, int, str)
+        Obsid, beam and category with a failed target
+    """
+    if categories is None:
+        categories = ['scal_inter', 'scal_final', 'cont_inter', 'cal_vis']
+    start = time.time()
+    skip_subdirs = None
+    if state is not None:
+        skip_subdirs = get_clean_subdirs(state, obsid, beam, beamdir, categories)
+    beam_inv = scan_beam(obsid, beam, beamdir, skip_subdirs=skip_subdirs)
+    mount = get_path_mount(beamdir)
+    record_phase('scan', start, time.time(), mount=mount)
+    start = time.time()
+    skipped = set()
+    beam_categories = categories
+    if manifest is not None:
+        beam_categories = manifest.get_categories(obsid, categories)
+        skipped = manifest.get_skipped([(obsid, beam, beamdir)], categories)
+    held_list = []
+    item_list = get_beam_work_items(beam_inv, categories=beam_categories,
+                                    admin_list=held_list)
+    record_phase('plan', start, time.time(), items=len(item_list), mount=mount)
+    skipped |= get_admin_failed(held_list)
+    if admin_list is not None:
+        admin_list.extend(held_list)
+
+    failed = set()
+    archive_results = []
+    for item, result in execute_work_items(item_list, run=run, verbose=verbose,
+                                           **execute_kwargs):
+        if get_status(item, result) == 'fail':
+            failed.add((item.obsid, item.beam, item.category))
+        if item.action == 'archive' and result.archived is True:
+            archive_results.append(result)
+    if state is not None and run is True:
+        record_cleaned(state, [(obsid, beam, beamdir)], categories, failed | skipped)
+        record_archives(state, archive_results)
+
+    return len(item_list), failed
+
+
+class BeamWatcher(object):
+    """
+    Follow new beams with inotify, and clean them once finished
+
+    Parameters
+    ----------
+    mode : string
+        Running mode - happili-01, happili-05 or local
+    beams : list (int) (optional)
+        Only watch these beams; default is all beams
+    obsid_array : array (optional)
+        Existing obsids whose beams are also cleaned once finished;
+        otherwise only obsids and beams created from now on.
+        New obsids are only followed if the manifest (if any, in
+        clean_kwargs) allows them
+    quiet_period : float
+        Seconds without writes after which a beam counts as finished
+    reaper : dict (optional)
+        Arguments for trash.start_reaper; if given, a reaper is started
+        after beams were cleaned, for targets moved into the trash
+        (trash in clean_kwargs)
+    clean_kwargs :
+        Further arguments for clean_beam
+    """
+
+    def __init__(self, mode='happili-01', beams=None, obsid_array=None,
+                 quiet_period=DEFAULT_QUIET_PERIOD, verbose=True, reaper=None,
+                 **clean_kwargs):
+        self.inotify = Inotify()
+        self.quiet_period = quiet_period
+        self.verbose = verbose
+        self.reaper = reaper
+        self.trash_list = get_trash_dirs(mode=mode)
+        self.clean_kwargs = clean_kwargs
+        # watch descriptor -> (kind, root beams, obsid, beam, depth, path)
+        self.watches = {}
+        # (obsid, beam) -> [path, last activity, last check]
+        self.pending = {}
+        for beam_root, root_beams in get_mode_roots(mode=mode):
+            if beams is not None:
+                root_beams = [b for b in root_beams if b in beams]
+            if len(root_beams) == 0:
+                continue
+            self._watch(beam_root, 'root', root_beams)
+            for obsid in (obsid_array if obsid_array is not None else []):
+                self._add_obsid(beam_root, root_beams, str(obsid), now=0.)
+
+    def _watch(self, path, kind, root_beams, obsid=None, beam=None, depth=0):
+        mask = ACTIVITY_MASK if kind == 'beam' else NEW_DIR_MASK
+        try:
+            wd = self.inotify.add_watch(path, mask)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                print('No inotify watches left for {}; raise '
+                      'fs.inotify.max_user_watches'.format(path))
+            return
+        self.watches[wd] = (kind, root_beams, obsid, beam, depth, path)
+
+    def _add_obsid(self, beam_root, root_beams, obsid, now):
+        manifest = self.clean_kwargs.get('manifest')
+        if manifest is not None and not manifest.is_eligible(obsid):
+            return
+        obsdir = os.path.join(beam_root, obsid)
+        self._watch(obsdir, 'obsid', root_beams, obsid=obsid)
+        listing = scan_directory(obsdir)
+        for name in sorted(listing):
+            if listing[name].is_dir and name.isdigit() and int(name) in root_beams:
+                self._add_beam(os.path.join(obsdir, name), root_beams, obsid,
+                               int(name), now)
+
+    def _add_beam(self, beamdir, root_beams, obsid, beam, now):
+        if (obsid, beam) in self.pending:
+            return
+        self.pending[(obsid, beam)] = [beamdir, now, 0.]
+        self._watch_tree(beamdir, root_beams, obsid, beam, 0)
+
+    def _watch_tree(self, path, root_beams, obsid, beam, depth):
+        self._watch(path, 'beam', root_beams, obsid=obsid, beam=beam, depth=depth)
+        if depth >= WATCH_DEPTH:
+            return
+        listing = scan_directory(path)
+        for name in sorted(listing):
+            if listing[name].is_dir:
+                self._watch_tree(os.path.join(path, name), root_beams, obsid, beam,
+                                 depth + 1)
+
+    def _drop_beam(self, obsid, beam):
+        del self.pending[(obsid, beam)]
+        for wd, watch in list(self.watches.items()):
+            if watch[0] == 'beam' and watch[2] == obsid and watch[3] == beam:
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def handle_events(self, event_list, now):
+        """
+        Follow new obsid / beam directories and activity in pending beams
+        """
+        for wd, mask, name in event_list:
+            if mask & IN_Q_OVERFLOW:
+                # events were lost; count every pending beam as active
+                for key in self.pending:
+                    self.pending[key][1] = now
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+            kind, root_beams, obsid, beam, depth, path = self.watches[wd]
+            is_new_dir = (mask & IN_ISDIR) and (mask & (IN_CREATE | IN_MOVED_TO))
+            if kind == 'root':
+                if is_new_dir and _obsid_pattern.match(name) is not None:
+                    self._add_obsid(path, root_beams, name, now)
+            elif kind == 'obsid':
+                if is_new_dir and name.isdigit() and int(name) in root_beams:
+                    self._add_beam(os.path.join(path, name), root_beams, obsid,
+                                   int(name), now)
+            elif (obsid, beam) in self.pending:
+                self.pending[(obsid, beam)][1] = now
+                if is_new_dir and depth < WATCH_DEPTH:
+                    self._watch_tree(os.path.join(path, name), root_beams, obsid,
+                                     beam, depth + 1)
+
+    def check_pending(self, now):
+        """
+        Clean the pending beams that have finished
+
+        Returns
+        -------
+        cleaned : list of (str, int)
+            Obsid and beam of each beam cleaned
+        """
+        cleaned = []
+        for (obsid, beam), (beamdir, active, checked) in sorted(self.pending.items()):
+            if now - active < self.quiet_period or now - checked < CHECK_INTERVAL:
+                continue
+            self.pending[(obsid, beam)][2] = now
+            if not os.path.isdir(beamdir):
+                self._drop_beam(obsid, beam)
+                continue
+            ready, newest = is_beam_ready(beamdir, self.quiet_period, now=now)
+            if ready is not True:
+                if newest is not None:
+                    # writes below the watched levels
+                    self.pending[(obsid, beam)][1] = newest
+                continue
+            self._drop_beam(obsid, beam)
+            admin_list = []
+            n_items, failed = clean_beam(obsid, beam, beamdir, verbose=self.verbose,
+                                         admin_list=admin_list, **self.clean_kwargs)
+            if self.verbose is True:
+                print('Cleaned {0} beam {1:02d}: {2} work items; failures in '
+                      '{3} categories'.format(obsid, beam, n_items, len(failed)))
+            print_admin_report(admin_list)
+            cleaned.append((obsid, beam))
+        if len(cleaned) > 0 and self.reaper is not None:
+            # only one reaper works on a trash directory at a time
+            start_reaper(self.trash_list, **self.reaper)
+
+        return cleaned
+
+    def run(self, poll=60., until=None):
+        """
+        Watch and clean until interrupted (or until a given time)
+
+        Parameters
+        ----------
+        poll : float
+            Maximum seconds between checks of the pending beams
+        until : float (optional)
+            Time at which to stop
+        """
+        try:
+            while until is None or time.time() < until:
+                timeout = poll if until is None else max(0., min(poll, until - time.time()))
+                event_list = self.inotify.read_events(timeout=timeout)
+                now = time.time()
+                self.handle_events(event_list, now)
+                self.check_pending(now)
+        finally:
+            self.inotify.close()
@@ -0,0 +1,217 @@
+# Benchmark happili cleanup on synthetic data
+
+from __future__ import print_function
+
+"""
+Command line script to benchmark happili cleanup
+
+Builds synthetic happili trees under a scratch root
+and times the cleanup code on them:
+- pipeline: scanning, planning per function, the memory and sorting
+  of the plan as a list and as a CompactPlan, archiving and deletion
+- remove: removal of measurement sets, shutil.rmtree vs remove_tree
+- order: removal and archiving of measurement sets,
+  in directory listing (or name) order vs inode order
+Results are printed, and can be written as JSON
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from modules.paths import set_data_root
+from modules.synthetic import make_ms_tree, make_happili_tree
+from modules.deletion import remove_tree
+from modules.archive import archive_dirs, archive_dir, ARCHIVE_FORMATS, DEFAULT_FORMAT
+from modules.executor import execute_work_items
+from modules.functions import get_inventory, iter_work_items
+from modules.functions import get_cal_vis, get_scal_intermediate_dirs
+from modules.functions import get_continuum_intermediates
+from modules.compact import CompactPlan
+from modules.paths import get_mount, get_fs_type
+
+SUITES = ['pipeline', 'remove', 'order']
+
+parser = argparse.ArgumentParser(
+    description='Benchmark happili cleanup on synthetic data')
+parser.add_argument("--root", default=None, type=str,
+                    help='Scratch directory for synthetic data, '
+                         'default a new temporary directory')
+parser.add_argument("--suites", default=','.join(SUITES), type=str,
+                    help='Comma separated benchmarks to run, from ' + ','.join(SUITES))
+parser.add_argument("--ntrees", default=20, type=int,
+                    help='Number of measurement sets per timing (remove)')
+parser.add_argument("--nobsids", default=2, type=int,
+                    help='Number of synthetic obsids (pipeline)')
+parser.add_argument("--nbeams", default=40, type=int,
+                    help='Number of beams per obsid (pipeline)')
+parser.add_argument("--mode", default='happili-01', type=str,
+                    help='Layout of the synthetic tree, happili-01 or happili-05')
+parser.add_argument("--seed", default=1, type=int,
+                    help='Seed of the synthetic tree layout')
+parser.add_argument("--archive_format", default=DEFAULT_FORMAT,
+                    choices=list(ARCHIVE_FORMATS) + ['auto'],
+                    help='Format of archives (pipeline)')
+parser.add_argument("--drop_caches", action='store_true',
+                    help='Drop the page cache before each timing (needs root), '
+                         'so metadata and data are read from disk (order)')
+parser.add_argument("--output", default=None, type=str,
+                    help='Write results as JSON to this file')
+args = parser.parse_args()
+
+root = args.root
+if root is None:
+    root = tempfile.mkdtemp(prefix='happili_bench_')
+suites = args.suites.split(',')
+
+results = []
+
+
+def record(suite, phase, method, items, seconds, nbytes=None):
+    results.append({'suite': suite, 'phase': phase, 'method': method,
+                    'items': items, 'seconds': seconds, 'nbytes': nbytes})
+    print('{0:<10} {1:<10} {2:<28} {3:6d} items in {4:.3f} s'.format(
+        suite, phase, method, items, seconds))
+
+
+def get_list_nbytes(item_list):
+    # list, tuples and their strings; small ints are shared
+    nbytes = sys.getsizeof(item_list)
+    for item in item_list:
+        nbytes += sys.getsizeof(item)
+        nbytes += sum(sys.getsizeof(field) for field in item if isinstance(field, str))
+    return nbytes
+
+
+def drop_caches():
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except OSError as e:
+        print('Unable to drop the page cache ({})'.format(e))
+
+
+def make_ms_set(name):
+    path_list = []
+    for i in range(args.ntrees):
+        path = os.path.join(root, name, '3C{0:03d}.MS'.format(i))
+        make_ms_tree(path)
+        path_list.append(path)
+    return path_list
+
+
+if 'pipeline' in suites:
+    treedir = os.path.join(root, 'tree')
+    obsids = ['1907{0:02d}{1:03d}'.format(1 + i // 10, 1 + i % 10)
+              for i in range(args.nobsids)]
+    start = time.time()
+    beam_list = make_happili_tree(treedir, obsids, beams=range(args.nbeams),
+                                  mode=args.mode, seed=args.seed)
+    record('pipeline', 'generate', 'make_happili_tree', len(beam_list),
+           time.time() - start)
+    set_data_root(treedir)
+
+    # scanning, once for all cleanup passes
+    start = time.time()
+    inventory = get_inventory(mode=args.mode)
+    record('pipeline', 'scan', 'get_inventory',
+           sum(len(beams) for beams in inventory.values()), time.time() - start)
+
+    # planning per function, each scanning for itself
+    for function in [get_cal_vis, get_scal_intermediate_dirs,
+                     get_continuum_intermediates]:
+        start = time.time()
+        planned = function(mode=args.mode)
+        if isinstance(planned, tuple):
+            n_planned = sum(len(p) for p in planned)
+        else:
+            n_planned = len(planned)
+        record('pipeline', 'plan', function.__name__, n_planned, time.time() - start)
+    start = time.time()
+    item_list = list(iter_work_items(mode=args.mode, inventory=inventory))
+    record('pipeline', 'plan', 'iter_work_items', len(item_list), time.time() - start,
+           nbytes=get_list_nbytes(item_list))
+    start = time.time()
+    plan = CompactPlan.from_items(item_list)
+    record('pipeline', 'plan', 'CompactPlan.from_items', len(plan), time.time() - start,
+           nbytes=plan.nbytes)
+
+    # sorting and counting per mount, oldest obsid first
+    start = time.time()
+    mount_cache = {}
+    sorted_list = sorted(item_list, key=lambda item: (get_mount(item.path, mount_cache),
+                                                      item.obsid, item.beam))
+    counts = {}
+    for item in sorted_list:
+        key = (get_mount(item.path, mount_cache), item.category)
+        counts[key] = counts.get(key, 0) + 1
+    record('pipeline', 'sort', 'list', len(sorted_list), time.time() - start)
+    start = time.time()
+    sorted_plan = plan.sort(keys=('mount', 'obsid', 'beam'))
+    for mount in sorted_plan.count('mount'):
+        sorted_plan.select(mounts=[mount]).count('category')
+    record('pipeline', 'sort', 'CompactPlan', len(sorted_plan), time.time() - start)
+
+    # archiving
+    archive_list = [item.path for item in item_list if item.action == 'archive']
+    start = time.time()
+    archive_results = archive_dirs(archive_list, archive_format=args.archive_format)
+    record('pipeline', 'archive', 'archive_dirs ' + args.archive_format,
+           len(archive_list), time.time() - start,
+           nbytes=sum(os.path.getsize(r.archive) for r in archive_results
+                      if r.archived is True))
+
+    # deletion, with the archives already made
+    delete_list = [item for item in item_list if item.action == 'delete']
+    start = time.time()
+    delete_results = [result for item, result in execute_work_items(
+        delete_list, run=True, verbose=False,
+        archived=set(r.path for r in archive_results if r.archived is True))]
+    record('pipeline', 'delete', 'execute_work_items', len(delete_list),
+           time.time() - start, nbytes=sum(r.nbytes for r in delete_results))
+
+    set_data_root(None)
+    shutil.rmtree(treedir)
+
+if 'remove' in suites:
+    # removal of measurement sets: shutil.rmtree vs remove_tree
+    for name, remove in [('shutil.rmtree', shutil.rmtree),
+                         ('remove_tree', remove_tree)]:
+        path_list = make_ms_set(name.replace('.', '_'))
+        start = time.time()
+        for path in path_list:
+            remove(path)
+        record('remove', 'delete', name, len(path_list), time.time() - start)
+
+if 'order' in suites:
+    # the same work in listing / name order and in inode order,
+    # on a fresh set of measurement sets each time
+    print('Filesystem of {0}: {1}'.format(root, get_fs_type(get_mount(root))))
+    for inode_order, order_name in [(False, 'listing order'), (True, 'inode order')]:
+        path_list = make_ms_set('remove_' + order_name.split()[0])
+        if args.drop_caches:
+            drop_caches()
+        start = time.time()
+        result_list = [remove_tree(path, inode_order=inode_order) for path in path_list]
+        record('order', 'delete', 'remove_tree ' + order_name, len(path_list),
+               time.time() - start, nbytes=sum(r.nbytes for r in result_list))
+    for inode_order, order_name in [(False, 'name order'), (True, 'inode order')]:
+        path_list = make_ms_set('archive_' + order_name.split()[0])
+        if args.drop_caches:
+            drop_caches()
+        start = time.time()
+        result_list = [archive_dir(path, 1, args.archive_format, inode_order)
+                       for path in path_list]
+        record('order', 'archive', 'archive_dir ' + order_name, len(path_list),
+               time.time() - start, nbytes=sum(r.nbytes_read for r in result_list))
+
+if args.output is not None:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+if args.root is None:
+    shutil.rmtree(root)
@@ -13,10 +13,36 @@ e.g., raw calibrator files
 """
 
 import argparse
-from modules.functions import delete_intermediate_scal_dirs
-from modules.functions import cleanup_continuum_intermediates
-from modules.functions import delete_cal_vis
-from modules.functions import final_scal_cleanup
+import atexit
+import cProfile
+import sys
+from modules.functions import get_inventory, get_obsid_array
+from modules.functions import iter_work_items, parse_date_ranges, parse_taskids
+from modules.executor import execute_work_items
+from modules.deletion import parse_mount_workers, DEFAULT_WORKERS
+from modules.state import open_state, invalidate_state, record_cleaned
+from modules.state import record_archives, get_archives
+from modules.accounting import get_space_report, print_space_report
+from modules.target import parse_mount_targets, iter_target_work_items, TARGET_ORDERS
+from modules.target import PendingBytes
+from modules.archive import ARCHIVE_FORMATS, DEFAULT_FORMAT, DEFAULT_TARGET_RATIO
+from modules.archive import verify_archive
+from modules.throttle import configure_throttle, parse_rate, parse_mount_rates
+from modules.agent import get_agent_request, run_agents, print_agent_summaries
+from modules.agent import AGENT_COMMAND
+from modules.paths import NODE_BEAMS
+from modules.manifest import Manifest, load_manifests
+from modules.preflight import get_admin_failed, print_admin_report, write_admin_report
+from modules.watch import BeamWatcher, DEFAULT_QUIET_PERIOD
+from modules.metrics import print_metrics, write_json_summary, write_prometheus
+from modules.metrics import merge_metrics
+from modules.plan import write_plan, execute_plan, read_plan_header, read_plan_beams
+from modules.plan import read_plan_admin, read_plan, iter_plan
+from modules.plan import read_journal, get_journal_file, get_status
+from modules.progress import Progress, get_item_sizes, DEFAULT_INTERVAL
+from modules.compact import CompactPlan, print_plan_summary, GROUP_KEYS
+from modules.trash import get_trash_dirs, start_reaper, reap
+from modules.trash import DEFAULT_REAP_WORKERS, DEFAULT_REAP_RATE
 
 parser = argparse.ArgumentParser(
     description='Clean up Apercal data products on happili')
@@ -24,6 +50,25 @@ parser.add_argument("--startdate", help='Start date, YYMMDD',
                     type=str, default=None)
 parser.add_argument("--enddate", help='End date, YYMMDD',
                     type=str, default=None)
+parser.add_argument("--ranges", default=None, type=str,
+                    help='Comma separated date ranges to clean in one run, '
+                         'e.g. 190701-190731,190906,190907-190930')
+parser.add_argument("--taskids", default=None, type=str,
+                    help='Comma separated taskids to clean, '
+                         'in addition to any date ranges')
+parser.add_argument("--exclude_taskids", default=None, type=str,
+                    help='Comma separated taskids never to clean')
+parser.add_argument("--cutoff", default=None, type=str,
+                    help='Last taskid that can be cleaned, '
+                         'e.g. the last one sent to cold storage')
+parser.add_argument("--archived_manifest", default=None, type=str,
+                    help='Comma separated files of taskids sent to cold '
+                         'storage; only these are cleaned')
+parser.add_argument("--exclude_manifest", default=None, type=str,
+                    help='Comma separated files of taskids never to clean')
+parser.add_argument("--policy_manifest", default=None, type=str,
+                    help='Comma separated files of taskids, each followed '
+                         'by the categories to clean for it')
 parser.add_argument("--scal_inter", default=True, type=bool,
                     help='Clean up intermediate selfcal files')
 parser.add_argument("--cont_inter", default=True, type=bool,
@@ -36,27 +81,412 @@ parser.add_argument("--verbose", default=True, type=bool,
                     help='Verbose printing of file deletion')
 parser.add_argument("--run", default=False, type=bool,
                     help='Whether to actually run deletion')
+parser.add_argument("--workers", default=DEFAULT_WORKERS, type=int,
+                    help='Parallel deletions per device')
+parser.add_argument("--mount_workers", default=None, type=str,
+                    help='Parallel deletions for specific mounts, '
+                         'e.g. /data2=8,/data3=8')
+parser.add_argument("--archive_workers", default=None, type=int,
+                    help='Parallel archiving workers, default one per core; '
+                         'with fewer, each archive is compressed on several cores')
+parser.add_argument("--archive_format", default=DEFAULT_FORMAT,
+                    choices=list(ARCHIVE_FORMATS) + ['auto'],
+                    help='Format of archived models and masks; auto samples '
+                         'the first directories and picks the fastest format '
+                         'reaching --target_ratio')
+parser.add_argument("--target_ratio", default=DEFAULT_TARGET_RATIO, type=float,
+                    help='Compressed over uncompressed size to reach '
+                         'with --archive_format auto')
+parser.add_argument("--inode_order", default='auto', choices=['auto', 'on', 'off'],
+                    help='Visit directory entries in inode order when deleting '
+                         'and archiving, for less seeking; auto is on for '
+                         'local filesystems (ext4, xfs, ...)')
+parser.add_argument("--trash", action='store_true',
+                    help='Move targets into the .trash of their data directory, '
+                         'and remove them afterwards with a background reaper '
+                         '(not with --free_target)')
+parser.add_argument("--reap_workers", default=DEFAULT_REAP_WORKERS, type=int,
+                    help='Parallel removals per trash directory of the reaper')
+parser.add_argument("--reap_rate", default=DEFAULT_REAP_RATE, type=float,
+                    help='Limit metadata operations of the reaper per mount, '
+                         'per second; 0 for no limit')
+parser.add_argument("--reap", action='store_true',
+                    help='Empty the trash directories now, and exit')
+parser.add_argument("--io_rate", default=None, type=str,
+                    help='Limit data read for archiving, per mount, '
+                         'in bytes/s with optional K/M/G suffix, e.g. 50M')
+parser.add_argument("--ops_rate", default=None, type=str,
+                    help='Limit metadata operations (unlink, rmdir, '
+                         'archive members) per mount, per second')
+parser.add_argument("--mount_rates", default=None, type=str,
+                    help='Limits for specific mounts, bytes/s[:ops/s], '
+                         'e.g. /data2=20M:500,/data3=50M')
+parser.add_argument("--adaptive_latency", default=None, type=float,
+                    help='Back off the limits when a metadata operation '
+                         'takes longer than this many milliseconds')
+parser.add_argument("--agents", default=None, type=str,
+                    help='Clean up with an agent on each of these nodes '
+                         '(comma separated, or all), working on local disk')
+parser.add_argument("--agent_command", default=AGENT_COMMAND, type=str,
+                    help='Command starting an agent, with {node} and {repo}')
+parser.add_argument("--watch", action='store_true',
+                    help='Keep running, and clean each new beam once its '
+                         'processing has finished')
+parser.add_argument("--quiet_period", default=DEFAULT_QUIET_PERIOD / 60., type=float,
+                    help='Minutes without writes after which a beam with '
+                         'a continuum image counts as finished (watch)')
+parser.add_argument("--node", default=None, choices=sorted(NODE_BEAMS),
+                    help='Node this runs on; only watch the beams on its '
+                         'own disk (watch), or empty its own trash (reap)')
+parser.add_argument("--state_dir", default=None, type=str,
+                    help='Directory of the cleanup state index, '
+                         'default ~/.happili_cleanup')
+parser.add_argument("--no_state", action='store_true',
+                    help='Do not use the cleanup state index')
+parser.add_argument("--rebuild_state", action='store_true',
+                    help='Clear the cleanup state index and rescan everything')
+parser.add_argument("--invalidate_state", default=None, type=str,
+                    help='Comma separated taskids to rescan')
+parser.add_argument("--audit_archives", action='store_true',
+                    help='Check every archive in the state index against '
+                         'its recorded digest, and exit')
+parser.add_argument("--admin_report", default=None, type=str,
+                    help='Write the targets that need an admin, '
+                         'and were not attempted, to this CSV file')
+parser.add_argument("--no_sizes", action='store_true',
+                    help='Skip space accounting in a practice run')
+parser.add_argument("--size_levels", default='mount,obsid', type=str,
+                    help='Levels of the practice run space report, '
+                         'from mount,obsid,beam')
+parser.add_argument("--write_plan", default=None, type=str,
+                    help='Only plan, writing all work items to this plan file')
+parser.add_argument("--execute_plan", default=None, type=str,
+                    help='Execute (or resume) a plan file, without scanning')
+parser.add_argument("--plan_summary", default=None, type=str,
+                    help='Print the number of work items of the plan per '
+                         'level, from ' + ','.join(GROUP_KEYS) +
+                         ' (with --write_plan or --execute_plan)')
+parser.add_argument("--free_target", default=None, type=str,
+                    help='Clean only until mounts are below a usage target, '
+                         'e.g. /data2=85,/data3=90; deletions in flight count '
+                         'as freed, so a mount ends at most one beam below it')
+parser.add_argument("--target_order", default='oldest', choices=TARGET_ORDERS,
+                    help='Order of cleanup with --free_target: '
+                         'oldest obsid or largest beam first')
+parser.add_argument("--progress", action='store_true',
+                    help='Report items and bytes done and left, throughput '
+                         'and time left per mount and phase; all targets are '
+                         'planned and sized before any is cleaned')
+parser.add_argument("--progress_file", default=None, type=str,
+                    help='Write the progress report to this file instead of '
+                         'printing it, and do not print each item '
+                         '(implies --progress)')
+parser.add_argument("--progress_interval", default=DEFAULT_INTERVAL, type=float,
+                    help='Seconds between progress reports')
+parser.add_argument("--metrics_json", default=None, type=str,
+                    help='Write per-phase timing and throughput as JSON to this file')
+parser.add_argument("--metrics_prom", default=None, type=str,
+                    help='Write per-phase metrics in Prometheus text format '
+                         'to this file, for the node_exporter textfile collector')
+parser.add_argument("--profile", default=None, type=str,
+                    help='Dump cProfile output for the whole run to this file')
 args = parser.parse_args()
 
+# moving into the trash frees no space until the reaper has run,
+# so the mounts would never get below their target
+if args.trash is True and args.free_target is not None:
+    parser.error('--trash cannot be combined with --free_target')
+# with a progress file the run is quiet; the report tells how it goes
+if args.progress_file is not None:
+    args.verbose = False
+
 print(args)
 
+profiler = None
+if args.profile is not None:
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+
+def finish():
+    # also runs when only writing a plan
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    print_metrics()
+    if args.metrics_json is not None:
+        write_json_summary(args.metrics_json, extra={'args': vars(args)})
+    if args.metrics_prom is not None:
+        write_prometheus(args.metrics_prom)
+
+
+atexit.register(finish)
+
+mount_workers = parse_mount_workers(args.mount_workers)
+
+# traversal order when deleting and archiving; None decides per mount
+inode_order = {'auto': None, 'on': True, 'off': False}[args.inode_order]
+
+# reaper settings, for targets moved into the trash
+reaper = {'workers': args.reap_workers, 'ops_rate': args.reap_rate or None}
+
+# empty the trash in the foreground, e.g. after a reboot
+if args.reap is True:
+    configure_throttle(ops_rate=reaper['ops_rate'])
+    reap(get_trash_dirs(mode='local' if args.node is not None else args.mode),
+         workers=args.reap_workers)
+    sys.exit(0)
+
+# limit I/O, so running reductions are not starved
+configure_throttle(bytes_rate=parse_rate(args.io_rate),
+                   ops_rate=parse_rate(args.ops_rate),
+                   mount_rates=parse_mount_rates(args.mount_rates),
+                   latency=None if args.adaptive_latency is None
+                   else args.adaptive_latency / 1000.)
+
+# cleanup categories of this run
+categories = []
 if args.scal_inter is True:
-    delete_intermediate_scal_dirs(startdate=args.startdate,
-                                  enddate=args.enddate,
-                                  mode=args.mode,
-                                  run=args.run,
-                                  verbose=args.verbose)
-    final_scal_cleanup(startdate=args.startdate, enddate=args.enddate, mode=args.mode,
-                       run=args.run, verbose=args.verbose)
+    categories = categories + ['scal_inter', 'scal_final']
 if args.cont_inter is True:
-    cleanup_continuum_intermediates(startdate=args.startdate,
-                                    enddate=args.enddate,
-                                    mode=args.mode,
-                                    run=args.run,
-                                    verbose=args.verbose)
+    categories = categories + ['cont_inter']
 if args.cal_vis is True:
-    delete_cal_vis(startdate=args.startdate, enddate=args.enddate, mode=args.mode,
-                   run=args.run, verbose=args.verbose)
+    categories = categories + ['cal_vis']
+
+# manifests of which obsids, and which categories of them, can be cleaned
+manifest = load_manifests(
+    archived=args.archived_manifest.split(',') if args.archived_manifest else None,
+    exclude=args.exclude_manifest.split(',') if args.exclude_manifest else None,
+    policy=args.policy_manifest.split(',') if args.policy_manifest else None)
+
+# obsids of this run: date ranges and taskids, up to the cutoff
+selection = {'startdate': args.startdate, 'enddate': args.enddate,
+             'ranges': parse_date_ranges(args.ranges),
+             'include': parse_taskids(args.taskids),
+             'exclude': parse_taskids(args.exclude_taskids),
+             'cutoff': args.cutoff}
+
+# with agents, every node scans and cleans its own disk;
+# only the policy is sent, and summaries come back
+if args.agents is not None:
+    if args.agents == 'all':
+        nodes = sorted(NODE_BEAMS)
+    else:
+        nodes = [node.strip() for node in args.agents.split(',')]
+    request = get_agent_request(selection=selection, categories=categories,
+                                run=args.run, verbose=args.verbose, workers=args.workers,
+                                mount_workers=mount_workers,
+                                archive_workers=args.archive_workers,
+                                archive_format=args.archive_format,
+                                target_ratio=args.target_ratio,
+                                bytes_rate=parse_rate(args.io_rate),
+                                ops_rate=parse_rate(args.ops_rate),
+                                mount_rates=parse_mount_rates(args.mount_rates),
+                                latency=None if args.adaptive_latency is None
+                                else args.adaptive_latency / 1000.,
+                                state=args.no_state is not True,
+                                state_dir=args.state_dir, manifest=manifest,
+                                trash=args.trash, reap_workers=args.reap_workers,
+                                reap_rate=reaper['ops_rate'], inode_order=inode_order)
+    summaries = run_agents(nodes, request, command=args.agent_command)
+    print_agent_summaries(summaries)
+    # metrics of the agents, per node, for --metrics_json and --metrics_prom
+    for summary in summaries:
+        merge_metrics(summary.get('metrics', []), node=summary['node'])
+    sys.exit(0)
+
+# open the state index, so beams already cleaned are skipped
+state = None
+if args.no_state is not True:
+    state = open_state(state_dir=args.state_dir)
+    if args.rebuild_state is True:
+        print('Cleared {} entries from state index'.format(invalidate_state(state)))
+    if args.invalidate_state is not None:
+        for taskid in args.invalidate_state.split(','):
+            print('Cleared {0} entries for {1} from state index'.format(
+                invalidate_state(state, obsid=taskid.strip()), taskid.strip()))
+
+# check archives against the digests taken when they were written
+if args.audit_archives is True:
+    if state is None:
+        print('Auditing archives needs the state index')
+        sys.exit(1)
+    n_bad = 0
+    archive_list = get_archives(state)
+    for path, archive, archive_format, sha256, nbytes in archive_list:
+        error = verify_archive(path, sha256=sha256)
+        if error is not None:
+            n_bad += 1
+            print('{0}: {1}'.format(archive, error))
+    print('Audited {0} archives; {1} do not match their record'.format(
+        len(archive_list), n_bad))
+    sys.exit(0)
+
+# watch for new beams, and clean each once it is finished
+if args.watch is True:
+    mode = args.mode
+    beams = None
+    if args.node is not None:
+        mode = 'local'
+        beams = NODE_BEAMS[args.node]
+    # beams of obsids already there are only cleaned if selected
+    obsid_array = None
+    if any(value for value in selection.values()):
+        obsid_array = get_obsid_array(manifest=manifest, **selection)
+    watcher = BeamWatcher(mode=mode, beams=beams, obsid_array=obsid_array,
+                          quiet_period=args.quiet_period * 60.,
+                          verbose=args.verbose, categories=categories,
+                          state=state, run=args.run, manifest=manifest,
+                          workers=args.workers,
+                          mount_workers=mount_workers,
+                          archive_workers=args.archive_workers,
+                          archive_format=args.archive_format,
+                          target_ratio=args.target_ratio, trash=args.trash,
+                          inode_order=inode_order,
+                          reaper=reaper if args.trash is True else None)
+    print('Watching for finished beams')
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+# work items to report progress on, held as a compact plan
+# and sized before they are executed
+progress_plan = None
+with_progress = args.progress is True or args.progress_file is not None
+
+if args.execute_plan is not None:
+    # the plan fixes what is cleaned; no scanning needed
+    admin_list = read_plan_admin(args.execute_plan)
+    header = read_plan_header(args.execute_plan)
+    categories = header['categories']
+    if header.get('manifest') is not None:
+        manifest = Manifest(**header['manifest'])
+    beam_list = read_plan_beams(args.execute_plan)
+    if args.plan_summary is not None:
+        print_plan_summary(read_plan(args.execute_plan),
+                           levels=args.plan_summary.split(','))
+    if with_progress is True:
+        done = read_journal(get_journal_file(args.execute_plan))
+        progress_plan = CompactPlan.from_items(item for index, item in
+                                               iter_plan(args.execute_plan)
+                                               if index not in done)
+    item_result = execute_plan(args.execute_plan, run=args.run,
+                               verbose=args.verbose,
+                               workers=args.workers,
+                               mount_workers=mount_workers,
+                               archive_workers=args.archive_workers,
+                               archive_format=args.archive_format,
+                               target_ratio=args.target_ratio,
+                               trash=args.trash, inode_order=inode_order)
+else:
+    # obsids are listed once, for all ranges of the run
+    obsid_array = get_obsid_array(manifest=manifest, **selection)
+
+    # in a practice run, report how much space would be freed
+    # this needs the full inventory up front
+    inventory = None
+    if ((args.run is not True or args.write_plan is not None) and
+            args.no_sizes is not True and args.free_target is None):
+        inventory = get_inventory(mode=args.mode, state=state, categories=categories,
+                                  obsid_array=obsid_array)
+        print_space_report(get_space_report(inventory, categories=categories,
+                                            manifest=manifest,
+                                            archive_format=args.archive_format,
+                                            target_ratio=args.target_ratio),
+                           levels=args.size_levels.split(','))
+
+    # plan beam by beam, scanning each obsid / beam once for all cleanup passes,
+    # and execute the work items as they come
+    beam_list = []
+    admin_list = []
+    if args.free_target is not None:
+        # clean only until each mount is below its target,
+        # counting deletions in flight as freed
+        target_pending = PendingBytes()
+        item_iter = iter_target_work_items(parse_mount_targets(args.free_target),
+                                           obsid_array=obsid_array, mode=args.mode,
+                                           order=args.target_order,
+                                           categories=categories, state=state,
+                                           beam_list=beam_list, manifest=manifest,
+                                           admin_list=admin_list, pending=target_pending)
+    else:
+        item_iter = iter_work_items(obsid_array=obsid_array,
+                                    mode=args.mode, inventory=inventory,
+                                    categories=categories, state=state,
+                                    beam_list=beam_list, manifest=manifest,
+                                    admin_list=admin_list)
+    if args.write_plan is not None:
+        metadata = dict(selection, mode=args.mode, categories=categories,
+                        manifest=None if manifest is None else manifest.to_dict())
+        n_items = write_plan(args.write_plan, item_iter, beam_list=beam_list,
+                             metadata=metadata, admin_list=admin_list)
+        print('Wrote {0} work items for {1} beams to {2}'.format(
+            n_items, len(beam_list), args.write_plan))
+        if args.plan_summary is not None:
+            print_plan_summary(read_plan(args.write_plan),
+                               levels=args.plan_summary.split(','))
+        print_admin_report(admin_list)
+        if args.admin_report is not None:
+            write_admin_report(args.admin_report, admin_list)
+        sys.exit(0)
+    if with_progress is True:
+        if args.free_target is not None:
+            # how much is cleaned depends on the space freed as it goes
+            print('No progress report with --free_target')
+        else:
+            progress_plan = CompactPlan.from_items(item_iter)
+            item_iter = progress_plan.iter_items()
+    item_result = execute_work_items(item_iter, run=args.run,
+                                     verbose=args.verbose,
+                                     workers=args.workers,
+                                     mount_workers=mount_workers,
+                                     archive_workers=args.archive_workers,
+                                     archive_format=args.archive_format,
+                                     target_ratio=args.target_ratio,
+                                     trash=args.trash, inode_order=inode_order)
+    if args.free_target is not None and args.run is True:
+        item_result = target_pending.iter_results(item_result)
+
+if progress_plan is not None:
+    progress = Progress(progress_plan, get_item_sizes(progress_plan),
+                        interval=args.progress_interval, status_file=args.progress_file)
+    item_result = progress.iter_results(item_result)
+
+n_items = 0
+failed = set()
+archive_results = []
+for item, result in item_result:
+    n_items += 1
+    # targets already gone (e.g. removed before a resumed run was
+    # interrupted) count as done, as in the journal
+    if get_status(item, result) == 'fail':
+        failed.add((item.obsid, item.beam, item.category))
+    if item.action == 'archive' and result.archived is True:
+        archive_results.append(result)
+print('{0} work items for {1} beams; failures in {2} beam/category combinations'.format(
+    n_items, len(beam_list), len(failed)))
 
+# targets that were not attempted, per owner
+print_admin_report(admin_list)
+if args.admin_report is not None:
+    write_admin_report(args.admin_report, admin_list)
 
+# record what was cleaned, so the next run can skip it;
+# categories kept by a policy were not cleaned
+if state is not None and args.run is True:
+    skipped = set()
+    if manifest is not None:
+        skipped = manifest.get_skipped(beam_list, categories)
+    skipped |= get_admin_failed(admin_list)
+    print('Recorded {} cleaned obsid/beam/category entries'.format(
+        record_cleaned(state, beam_list, categories, failed | skipped)))
+    print('Recorded digests of {} archives'.format(
+        record_archives(state, archive_results)))
 
+# the space of targets moved into the trash is freed in the background
+if args.trash is True and args.run is True:
+    process = start_reaper(get_trash_dirs(mode=args.mode), **reaper)
+    if process is not None:
+        print('Started reaper {} to empty the trash'.format(process.pid))
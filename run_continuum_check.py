@@ -0,0 +1,121 @@
+# Check the continuum planner on synthetic data
+
+from __future__ import print_function
+
+"""
+Command line script to check the continuum planner
+
+Builds synthetic happili trees under a scratch root and plans the
+continuum cleanup of every beam twice: with classify_continuum (a
+single pass with one compiled pattern) and with the previous logic,
+one glob per class. The masks and models to compress and the entries
+to delete must be the same for every beam. Differences are printed,
+and the exit status is 1 if there are any.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+from modules.paths import set_data_root
+from modules.synthetic import make_happili_tree
+from modules.inventory import iter_beams, match_names
+from modules.functions import get_inventory, get_beam_continuum_intermediates
+
+parser = argparse.ArgumentParser(
+    description='Check the continuum planner against the previous logic '
+                'on synthetic data')
+parser.add_argument("--root", default=None, type=str,
+                    help='Scratch directory for synthetic data, '
+                         'default a new temporary directory')
+parser.add_argument("--ntrees", default=4, type=int,
+                    help='Number of synthetic trees, each with its own seed '
+                         'and number of cycles and chunks')
+parser.add_argument("--nbeams", default=40, type=int,
+                    help='Number of beams per tree')
+parser.add_argument("--mode", default='happili-01', type=str,
+                    help='Layout of the synthetic trees, happili-01 or happili-05')
+args = parser.parse_args()
+
+root = args.root
+if root is None:
+    root = tempfile.mkdtemp(prefix='happili_check_')
+
+
+def get_glob_continuum_intermediates(beam_inv):
+    """
+    Plan the continuum cleanup of a beam as before classify_continuum,
+    with one glob per class
+    """
+    continuum = beam_inv['continuum']
+    contdir = os.path.join(beam_inv['path'], 'continuum')
+    beam_list = match_names(continuum, 'beam*_0[0-9]')
+    map_list = match_names(continuum, 'map*_0[0-9]')
+    image_list = match_names(continuum, 'image_*_0[0-9]')
+    fits_image_list = match_names(continuum, 'image_*fits')
+    model_zip_list = []
+    mask_zip_list = []
+    residual_keep_list = []
+    for image in fits_image_list:
+        pattern = re.search('image_(.+?).fits', image).group(1)
+        mask = "mask_{}".format(pattern)
+        model = "model_{}".format(pattern)
+        residual = "residual_{}".format(pattern)
+        if mask in continuum and continuum[mask].is_dir: mask_zip_list.append(mask)
+        if model in continuum and continuum[model].is_dir: model_zip_list.append(model)
+        if residual in continuum and continuum[residual].is_dir: residual_keep_list.append(residual)
+    model_del_list = match_names(continuum, "model_*_0[0-9]")
+    for model in model_zip_list:
+        if model in model_del_list:
+            model_del_list.remove(model)
+    mask_del_list = match_names(continuum, "mask_*_0[0-9]")
+    for mask in mask_zip_list:
+        if mask in mask_del_list:
+            mask_del_list.remove(mask)
+    residual_del_list = match_names(continuum, "residual_*_0[0-9]")
+    for residual in residual_keep_list:
+        if residual in residual_del_list:
+            residual_del_list.remove(residual)
+
+    zip_list = [os.path.join(contdir, name)
+                for name in mask_zip_list + model_zip_list]
+    del_list = [os.path.join(contdir, name)
+                for name in (mask_del_list + model_del_list + residual_del_list +
+                             beam_list + map_list + image_list)]
+
+    return zip_list, del_list
+
+
+n_beams = 0
+n_diff = 0
+for tree in range(args.ntrees):
+    treedir = os.path.join(root, 'tree{}'.format(tree))
+    make_happili_tree(treedir, ['190701{0:03d}'.format(tree + 1)],
+                      beams=range(args.nbeams), mode=args.mode, seed=tree + 1,
+                      ncycles=2 + tree % 5, nchunks=tree % 4, file_size=64)
+    set_data_root(treedir)
+    for beam_inv in iter_beams(get_inventory(mode=args.mode)):
+        n_beams += 1
+        old_zip, old_del = get_glob_continuum_intermediates(beam_inv)
+        new_zip, new_del = get_beam_continuum_intermediates(beam_inv)
+        for label, old, new in [('compress', old_zip, new_zip),
+                                ('delete', old_del, new_del)]:
+            if old != new:
+                n_diff += 1
+                print('{0}: {1} differs'.format(beam_inv['path'], label))
+                for name in sorted(set(old) - set(new)):
+                    print('    only before: {}'.format(name))
+                for name in sorted(set(new) - set(old)):
+                    print('    only now: {}'.format(name))
+                if set(old) == set(new):
+                    print('    same entries, in another order')
+    set_data_root(None)
+    shutil.rmtree(treedir)
+
+if args.root is None:
+    shutil.rmtree(root)
+print('Checked the continuum plan of {0} beams; {1} differences'.format(n_beams, n_diff))
+if n_diff > 0:
+    sys.exit(1)
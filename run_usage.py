@@ -0,0 +1,60 @@
+# Report disk usage per user on happili
+
+from __future__ import print_function
+
+"""
+Command line script to report disk usage on happili
+
+Adds up the space used per user, and per obsid and category of each
+user, over the apertif directories of all /data* mounts, so the right
+people can be contacted. Directories unchanged since the last run are
+taken from a cache in the state index.
+"""
+
+import argparse
+from modules.paths import set_data_root
+from modules.state import open_state
+from modules.accounting import DEFAULT_WALK_WORKERS
+from modules.usage import get_usage_report, print_usage_report, write_usage_csv
+from modules.usage import USAGE_LEVELS
+from modules.metrics import print_metrics
+
+parser = argparse.ArgumentParser(
+    description='Report disk usage per user on happili')
+parser.add_argument("--mode", default='happili-01', type=str,
+                    help='Running on happili-01 or happili-05')
+parser.add_argument("--levels", default='user,obsid', type=str,
+                    help='Levels of the report, from ' + ','.join(USAGE_LEVELS))
+parser.add_argument("--top", default=20, type=int,
+                    help='Number of lines per level; 0 for all')
+parser.add_argument("--csv", default=None, type=str,
+                    help='Write the usage per user, mount, obsid and category '
+                         'to this CSV file')
+parser.add_argument("--workers", default=DEFAULT_WALK_WORKERS, type=int,
+                    help='Parallel directory walkers')
+parser.add_argument("--state_dir", default=None, type=str,
+                    help='Directory of the state index holding the cache')
+parser.add_argument("--no_state", action='store_true',
+                    help='Walk everything, without a cache')
+parser.add_argument("--refresh", action='store_true',
+                    help='Walk everything, and replace the cache')
+parser.add_argument("--data_root", default=None, type=str,
+                    help='Directory holding the data directories, '
+                         'for testing on synthetic data')
+args = parser.parse_args()
+
+if args.data_root is not None:
+    set_data_root(args.data_root)
+
+state = None
+if args.no_state is not True:
+    state = open_state(state_dir=args.state_dir)
+
+rows = get_usage_report(mode=args.mode, state=state, refresh=args.refresh,
+                        workers=args.workers)
+print_usage_report(rows, levels=args.levels.split(','),
+                   top=args.top if args.top > 0 else None)
+if args.csv is not None:
+    write_usage_csv(args.csv, rows)
+print('')
+print_metrics()